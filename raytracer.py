@@ -0,0 +1,678 @@
+import os
+import sys
+import importlib
+import contextlib
+import time
+import numpy as np
+
+# week7 / week8 のレイトレーサーを画面全体まとめて NumPy で計算するエンジン
+# 各スクリプトの getPixelColor(x, y) と同じ計算を (H, W, 3) の配列に対して行う
+
+ID_BACKGROUND = -1	# 何とも交差しない画素の物体ID
+ID_FLOOR = -2	# 床に当たった画素の物体ID
+ID_MESH = -3	# 三角形メッシュに当たった画素の物体ID
+
+BOARD_Z_LIMIT = -3000.0	# 床の奥行きの限界 (Board.getIntersect と同じ値)
+FILTER_MIN_WIDTH = 1.0e-6	# 格子模様を平均する幅がこれより狭ければ (格子の大きさに対する比) 平均しない
+
+g_Precision = np.dtype(os.environ.get("RAYTRACER_PRECISION", "float64"))	# 計算に使う浮動小数点数の型 (float64 か float32)
+
+# 影や反射のレイを交点からずらす量。float64 では各スクリプトと同じ 0.001 を使う
+# float32 ではシーンの大きさに対する丸め誤差 (座標の ulp) より十分大きくなるように広げる
+EPSILON = 0.001
+FLOAT32_EPSILON_SCALE = 2.0 ** -16
+
+# 種類ごとに追跡したレイの数 (ベンチマーク用。配列ごとに1回足すだけなので常に数える)
+g_RayCounts = {"primary": 0, "shadow": 0, "reflection": 0}
+
+# レイの数を 0 に戻す
+def resetRayCounts():
+	for kind in g_RayCounts:
+		g_RayCounts[kind] = 0
+
+# 画素ごとのレイの統計 (Scene.stats に設定した raytracer_stats.RayStats) を数える範囲を絞り込む
+# subset: いまのレイのうちの一部、kind: レイの種類、pixels: 画素の番号。統計をとらないときは何もしない
+NO_STATS = contextlib.nullcontext()
+
+def statsScope(scene, subset=None, kind=None, pixels=None):
+	if scene.stats is None:
+		return NO_STATS
+	return scene.stats.scope(subset, kind, pixels)
+
+# いまのレイについて、レイの数と交差判定の回数を画素ごとの統計に足す
+def countStats(scene, rays=0, tests=0):
+	if scene.stats is not None:
+		scene.stats.count(rays, tests)
+
+# 3次元ベクトルの配列 (..., 3) どうしの内積
+# 1組ずつの v.dot(w) と丸め誤差まで一致するように matmul で計算する
+def dot(a, b):
+	a, b = np.broadcast_arrays(a, b)
+	return np.matmul(a[..., np.newaxis, :], b[..., :, np.newaxis])[..., 0, 0]
+
+# ベクトルの配列 (..., 3) をそれぞれ長さ1に正規化する
+def normalize(v):
+	norm = np.sqrt(dot(v, v))[..., np.newaxis]
+	return np.divide(v, norm, out=v.copy(), where=norm > 0.0)
+
+# ベクトル化エンジンで扱うシーン
+# 球の中心・半径・色は連続した配列 (structure of arrays) として保持する
+class Scene:
+	def __init__(self, spheres, board=None, lightDirection=(-2., -4., -2.),
+			viewpoint=(0., 0., 0.), distance=1000, shininess=32, kd=0.8, ks=0.8,
+			iin=1.0, ia=0.2, floorColors=((0.8, 0.8, 0.8),), checkerSize=None,
+			shadow=False, reflectionWeight=None, background=(0., 0., 0.), floorFilter=False, dtype=None):
+		spheres = list(spheres)
+		self.centers = np.array([s.center for s in spheres], dtype=np.float64).reshape(-1, 3)
+		self.radii = np.array([s.radius for s in spheres], dtype=np.float64)
+		self.colors = np.array([s.color for s in spheres], dtype=np.float64).reshape(-1, 3)
+		self.boardY = None if board is None else float(board.y)	# 床の y 座標 (None なら床なし)
+		self.lightDirection = np.array(lightDirection, dtype=np.float64)	# 入射光の進行方向
+		self.viewpoint = np.array(viewpoint, dtype=np.float64)	# 視点位置
+		self.distance = float(distance)	# 視点と投影面との距離
+		self.cameraRotation = None	# カメラの向き (行が右・上・後ろの単位ベクトルの 3x3 行列)。None なら投影面は z = -distance に固定
+		self.shininess = shininess	# 鏡面反射の指数
+		self.kd = kd	# 拡散反射定数
+		self.ks = ks	# 鏡面反射定数
+		self.iin = iin	# 入射光の強さ
+		self.ia = ia	# 環境光
+		self.floorColors = np.array(floorColors, dtype=np.float64).reshape(-1, 3)	# 床の色 (格子模様なら2色)
+		self.checkerSize = checkerSize	# 格子の大きさ (None なら単色)
+		self.shadow = shadow	# 床に球の影を落とすか
+		self.reflectionWeight = reflectionWeight	# 球面で床を映り込ませる重み (None なら反射なし)
+		self.background = np.array(background, dtype=np.float64)	# 背景色
+		self.floorFilter = floorFilter	# 一次レイが当たった床の格子模様を画素の範囲で平均するか (False なら Board.getColorVec と同じ)
+		self.bvh = None	# 球の BVH (raytracer_bvh.BVH)。None なら全ての球を順に調べる
+		self.shadowMask = None	# 床の影のマスク (raytracer_shadowmask.ShadowMask)。None なら影のレイを飛ばす
+		self.packets = None	# 一次レイのパケット追跡 (raytracer_packet.PacketTracer)。None ならレイごとに調べる
+		self.reflections = None	# 多重反射 (raytracer_wavefront.Wavefront)。None なら床の映り込みを1回だけ加える
+		self.stats = None	# 画素ごとのレイの統計 (raytracer_stats.RayStats)。None なら数えない
+		self.mesh = None	# 三角形メッシュ (raytracer_mesh.Mesh)。None ならメッシュなし
+		self.softShadow = None	# 大きさのある光源による柔らかい影 (raytracer_softshadow.SoftShadow)。None なら影のレイは1本
+		self.lights = None	# 光源の一覧 (raytracer_lights.LightList)。None なら lightDirection の平行光源1つで、影は床にだけ落とす
+		self.materials = None	# 材質の表 (raytracer_lights.MaterialTable)。None なら球は kd, ks, shininess、床は鏡面反射なし
+		self.materialIds = None	# 球ごとの材質の番号 (materials の行)。None なら全て 0
+		self.floorMaterial = 0	# 床の材質の番号 (materials の行)
+		self.setPrecision(dtype or g_Precision)
+
+	# 計算に使う浮動小数点数の型を変え、シーンの配列とレイをずらす量をそれに合わせる
+	def setPrecision(self, dtype):
+		self.dtype = np.dtype(dtype)
+		for name in ["centers", "radii", "colors", "lightDirection", "viewpoint", "floorColors", "background"]:
+			setattr(self, name, np.asarray(getattr(self, name), dtype=self.dtype))
+		if self.cameraRotation is not None:
+			self.cameraRotation = np.asarray(self.cameraRotation, dtype=self.dtype)
+
+		self.epsilon = EPSILON
+		if self.dtype != np.float64:
+			# 交点の座標が取りうる最大の大きさ (球・床・投影面) に比例させる
+			extent = [self.distance, np.abs(self.viewpoint).max()]
+			if len(self.radii) > 0:
+				extent.append((np.abs(self.centers).max(axis=1) + self.radii).max())
+			if self.boardY is not None:
+				extent += [abs(self.boardY), -BOARD_Z_LIMIT]
+			self.epsilon = max(EPSILON, float(max(extent)) * FLOAT32_EPSILON_SCALE)
+
+	# 光源方向 (光の進行方向の逆ベクトル)
+	def getLightDir(self):
+		L = -self.lightDirection
+		norm = np.sqrt(L.dot(L))
+		return L / norm if norm > 0.0 else L
+
+# 球の中心・半径・色の配列から直接シーンを作る (大量の球を Sphere オブジェクトなしで扱う)
+def makeScene(centers, radii, colors, boardY=None, **kwargs):
+	scene = Scene([], None, **kwargs)
+	scene.centers = np.asarray(centers, dtype=scene.dtype).reshape(-1, 3)
+	scene.radii = np.asarray(radii, dtype=scene.dtype)
+	scene.colors = np.asarray(colors, dtype=scene.dtype).reshape(-1, 3)
+	scene.boardY = None if boardY is None else float(boardY)
+	scene.setPrecision(scene.dtype)	# 球と床に合わせて epsilon を求め直す
+	return scene
+
+# 投影面上の点 (x, y, -distance) の配列 (..., 3) を、視点からその点へ向かう (正規化前の) ベクトルにする
+# カメラの向きが設定されていれば、投影面は視点に対して置かれ、カメラと一緒に回る
+def getCameraRays(scene, points):
+	if scene.cameraRotation is None:
+		return points - scene.viewpoint
+	return points @ scene.cameraRotation
+
+# スクリーン座標 xs, ys (同じ形の配列) を通るレイの方向を求める
+def getPrimaryRays(scene, xs, ys):
+	ray = np.empty(np.shape(xs) + (3,), dtype=scene.dtype)
+	ray[..., 0] = xs
+	ray[..., 1] = ys
+	ray[..., 2] = -scene.distance
+	return normalize(getCameraRays(scene, ray))
+
+# 画面の行 rows = (開始, 終了) と列 cols = (開始, 終了) の範囲のスクリーン座標
+# 行 0 が y = -halfHeight、列 0 が x = -halfWidth にあたる (下の行から順に並ぶ)
+# pixelSize: 1画素の大きさ (スクリーン座標の単位)。1 より大きいと少ない画素で同じ範囲を描く
+def getScreenGrid(halfWidth, halfHeight, dx=0.0, dy=0.0, rows=None, cols=None, pixelSize=1.0):
+	rows = rows or (0, 2 * halfHeight + 1)
+	cols = cols or (0, 2 * halfWidth + 1)
+	xs = (np.arange(cols[0], cols[1], dtype=np.float64) - halfWidth + dx) * pixelSize
+	ys = (np.arange(rows[0], rows[1], dtype=np.float64) - halfHeight + dy) * pixelSize
+	return np.meshgrid(xs, ys)
+
+# 1つの球とレイの配列との交点の t を求める (Sphere.getIntersect と同じ式)
+# 交わらないレイには -1 を返す
+def intersectSphere(center, radius, p, v):
+	A = dot(v, v)
+	B = 2.0 * dot(v, p - center)
+	if np.result_type(p, v) == np.float32:
+		# float32 では |p|^2 と |center|^2 の打ち消し合いで誤差が大きくなるので p - center から求める
+		C = dot(p - center, p - center) - radius * radius
+	else:
+		C = dot(p, p) - 2.0 * dot(p, center) + dot(center, center) - radius * radius
+	D = B * B - 4 * A * C	# 判別式
+
+	hit = D > 0.0
+	sqrtD = np.sqrt(np.where(hit, D, 0.0))
+	t1 = (-B - sqrtD) / (2.0 * A)
+	t2 = (-B + sqrtD) / (2.0 * A)
+	t = np.where(t1 >= 0.0, t1, t2)
+	return np.where(hit, t, -1.0)
+
+# 全ての球について最も近い交点を求める
+# 戻り値は (t, 球の番号)。交わらないレイは t = inf, 番号 = -1
+def intersectSpheres(scene, p, v):
+	if scene.bvh is not None:
+		if scene.stats is None:
+			return scene.bvh.intersect(p, v)
+		tests = np.zeros(np.shape(v)[:-1], dtype=np.int64)
+		result = scene.bvh.intersect(p, v, tests)
+		countStats(scene, tests=tests)
+		return result
+
+	countStats(scene, tests=len(scene.radii))
+	shape = np.shape(v)[:-1]
+	min_t = np.full(shape, np.inf, dtype=scene.dtype)
+	index = np.full(shape, -1, dtype=np.int64)
+
+	for i in range(len(scene.radii)):
+		t = intersectSphere(scene.centers[i], scene.radii[i], p, v)
+		closer = (t > 0.0) & (t < min_t)
+		min_t = np.where(closer, t, min_t)
+		index = np.where(closer, i, index)
+	return min_t, index
+
+# メッシュとの最も近い交点 (t, 三角形の番号)。交わらないレイは t = inf, 番号 = -1
+def intersectMesh(scene, p, v):
+	if scene.stats is None:
+		return scene.mesh.intersect(p, v)
+	tests = np.zeros(np.shape(v)[:-1], dtype=np.int64)
+	result = scene.mesh.intersect(p, v, tests)
+	countStats(scene, tests=tests)
+	return result
+
+# レイが光源方向のどれかの球 (とメッシュ) に遮られるか (影の判定)
+# maxT: 光源までの距離 (点光源)。これより奥の球は遮らない。None なら無限遠
+def isOccluded(scene, p, v, maxT=None):
+	g_RayCounts["shadow"] += int(np.prod(np.shape(v)[:-1]))
+	occluded = isOccludedBySpheres(scene, p, v, maxT)
+	if scene.mesh is not None:
+		tests = None if scene.stats is None else np.zeros(np.shape(v)[:-1], dtype=np.int64)
+		occluded = occluded | scene.mesh.occluded(p, v, tests, maxT)
+		countStats(scene, tests=0 if tests is None else tests)
+	return occluded
+
+def isOccludedBySpheres(scene, p, v, maxT=None):
+	if scene.bvh is not None:
+		if scene.stats is None:
+			return scene.bvh.occluded(p, v, maxT=maxT)
+		tests = np.zeros(np.shape(v)[:-1], dtype=np.int64)
+		result = scene.bvh.occluded(p, v, tests, maxT)
+		countStats(scene, rays=1, tests=tests)
+		return result
+
+	countStats(scene, rays=1, tests=len(scene.radii))
+	occluded = np.zeros(np.shape(v)[:-1], dtype=bool)
+	for i in range(len(scene.radii)):
+		t = intersectSphere(scene.centers[i], scene.radii[i], p, v)
+		occluded |= (t > 0.0) if maxT is None else (t > 0.0) & (t < maxT)
+	return occluded
+
+# 床とレイの配列との交点の t を求める (Board.getIntersect と同じ判定)
+def intersectBoard(scene, p, v):
+	if scene.boardY is None:
+		return np.full(np.shape(v)[:-1], -1.0, dtype=scene.dtype)
+
+	countStats(scene, tests=1)
+	vy = v[..., 1]
+	horizontal = np.abs(vy) < 1.0e-6	# 水平なRayは交わらない
+	t = (scene.boardY - p[..., 1]) / np.where(horizontal, 1.0, vy)
+	z_intersect = p[..., 2] + t * v[..., 2]
+	return np.where(horizontal | (z_intersect < BOARD_Z_LIMIT), -1.0, t)
+
+# x と z の配列から床の色を返す (Board.getColorVec と同じ格子模様)
+# footprint (..., 2) を渡すと、x, z 方向にその幅の範囲で格子模様を平均した色を返す (箱型フィルタ)
+def getFloorColors(scene, x, z, footprint=None):
+	if scene.checkerSize is None:
+		return np.broadcast_to(scene.floorColors[0], np.shape(x) + (3,))
+
+	if footprint is not None:
+		# 格子の偶奇を +1 (偶数) / -1 (奇数) とすると、その積の平均が x, z の平均の積になる
+		sx = getCheckerAverage(x / scene.checkerSize, footprint[..., 0] / scene.checkerSize)
+		sz = getCheckerAverage(z / scene.checkerSize, footprint[..., 1] / scene.checkerSize)
+		even = (0.5 + 0.5 * sx * sz)[..., np.newaxis]	# 1色目の割合
+		return even * scene.floorColors[0] + (1.0 - even) * scene.floorColors[1]
+
+	grid_x = np.floor_divide(x, scene.checkerSize)
+	grid_z = np.floor_divide(z, scene.checkerSize)
+	even = np.mod(grid_x + grid_z, 2) == 0
+	return np.where(even[..., np.newaxis], scene.floorColors[0], scene.floorColors[1])
+
+# floor(u) が偶数なら +1、奇数なら -1 の関数を、u を中心とした幅 w の範囲で平均した値
+# 不定積分が三角波 -2|u/2 - floor(u/2) - 1/2| になることを使って閉じた式で求める
+def getCheckerAverage(u, w):
+	def triangle(a):
+		half = 0.5 * a
+		return np.abs(half - np.floor(half) - 0.5)
+
+	exact = np.where(np.mod(np.floor(u), 2) == 0, 1.0, -1.0)
+	wide = w > FILTER_MIN_WIDTH
+	w = np.where(wide, w, 1.0)
+	average = 2.0 * (triangle(u - 0.5 * w) - triangle(u + 0.5 * w)) / w
+	return np.where(wide, average, exact)
+
+# 一次レイが床に当たった点 point (..., 3) に写る1画素の幅 (床の x, z 方向)
+# 画素の横・縦の隣を通るレイとの差 (ray differentials) で画素が床に写る平行四辺形を求め、それを囲む幅を返す
+def getFloorFootprint(scene, point, pixelSize):
+	if scene.cameraRotation is None:
+		rotation = np.eye(3)
+		depth = scene.distance + scene.viewpoint[2]	# 視点から投影面 z = -distance までの奥行き
+	else:
+		rotation = scene.cameraRotation
+		depth = scene.distance
+	offset = point - scene.viewpoint
+	# 視点から point へのベクトルは、視点から投影面上の点へのベクトルを scale 倍したもの
+	scale = -dot(offset, rotation[2]) / depth
+	width = 0.0
+	for axis in rotation[:2]:
+		# 投影面上で axis 方向に pixelSize 動かしたときの、床の上の点の動き
+		step = scale[..., np.newaxis] * pixelSize * (axis - axis[1] * offset / offset[..., 1:2])
+		width = width + np.abs(step[..., [0, 2]])
+	return width
+
+# 交点 point (N, 3) から見た光源の一覧 [(光源方向, 強さ (RGB), 光源までの距離 (平行光源なら None)), ...]
+# scene.lights が None なら lightDirection の平行光源1つ
+def getLights(scene, point):
+	if scene.lights is None:
+		return [(scene.getLightDir(), np.full(3, scene.iin, dtype=scene.dtype), None)]
+	return scene.lights.getLights(point)
+
+# 交点から全ての光源への影のレイをまとめて1回で追跡し、光源ごとに光が届くか (光源の数, N) を返す
+# 光源が裏側にある交点には影のレイを飛ばさない (光は届かない)
+# scene.softShadow があるときは光の届く割合 (0.0 から 1.0) を返す
+def getLightVisibility(scene, point, normal, lights):
+	if scene.softShadow is not None:
+		return scene.softShadow.getVisibility(scene, point, normal, lights)
+	visible = np.zeros((len(lights), len(point)), dtype=bool)
+	owners, origins, directions, limits = [], [], [], []
+	for light_dir, _, distance in lights:
+		light_dir = np.broadcast_to(light_dir, point.shape)
+		facing = np.flatnonzero(dot(normal, light_dir) > 0.0)
+		owners.append(facing)
+		origins.append(point[facing] + scene.epsilon * light_dir[facing])	# 微小量だけずらす
+		directions.append(light_dir[facing])
+		limits.append(np.full(len(facing), np.inf) if distance is None else distance[facing] - scene.epsilon)
+
+	index = np.concatenate(owners)
+	if len(index) == 0:
+		return visible
+	with statsScope(scene, index, "shadow"):
+		blocked = isOccluded(scene, np.concatenate(origins), np.concatenate(directions), np.concatenate(limits))
+	start = 0
+	for k, facing in enumerate(owners):
+		visible[k, facing] = ~blocked[start:start + len(facing)]
+		start += len(facing)
+	return visible
+
+# フォンモデルの照明計算 (球と床で共通)
+# point, normal, ray: 交点・法線・視線の配列 (N, 3)、albedo: 物体の色 (N, 3)
+# kd, ks: 拡散・鏡面反射定数 (数か (N, 1) の配列)、shininess: 鏡面反射の指数 (数か (N,) の配列)
+# 光源ごとに拡散反射光と鏡面反射光を足し合わせ、環境光を加えた色を返す (1.0 で打ち切る前の値)
+# 計算量は光源の数に比例する。shadows が True なら影のレイで遮られた光源の寄与を除く
+def shadePhong(scene, point, normal, ray, albedo, kd, ks, shininess, shadows=False):
+	lights = getLights(scene, point)
+	visible = getLightVisibility(scene, point, normal, lights) if shadows else None
+	use_specular = np.any(np.asarray(ks) != 0.0)
+	view_dir = normalize(-ray) if use_specular else None
+
+	diffuse = None
+	specular = None
+	for k, (light_dir, intensity, _) in enumerate(lights):
+		if visible is not None and visible.dtype == bool:
+			intensity = np.where(visible[k][..., np.newaxis], intensity, 0.0)
+		elif visible is not None:
+			intensity = intensity * visible[k][..., np.newaxis]	# 柔らかい影
+
+		# 拡散反射光
+		n_dot_l = dot(normal, light_dir)
+		Id = kd * intensity * np.maximum(0.0, n_dot_l)[..., np.newaxis]
+		diffuse = Id if diffuse is None else diffuse + Id
+
+		# 反射ベクトル R = 2(N・L)N - L と視線方向から鏡面反射光を求める
+		if use_specular:
+			reflect_vec = 2.0 * n_dot_l[..., np.newaxis] * normal - light_dir
+			cos_alpha = np.maximum(0.0, dot(reflect_vec, view_dir))
+			Is = ks * intensity * (cos_alpha ** shininess)[..., np.newaxis]
+			specular = Is if specular is None else specular + Is
+
+	I = diffuse * albedo
+	if specular is not None:
+		I = I + specular
+	return I + scene.ia
+
+# 球の交点の色をフォンモデルで計算する (1.0 で打ち切る前の値)
+# scene.lights があるときは、scene.shadow で球にも影を落とす
+def shadeSpheres(scene, index, intersection, ray):
+	normal = normalize(intersection - scene.centers[index])	# 球の法線ベクトル
+	if scene.materials is None:
+		kd, ks, shininess = scene.kd, scene.ks, scene.shininess
+	else:
+		kd, ks, shininess = scene.materials.lookup(0 if scene.materialIds is None else scene.materialIds[index])
+	shadows = scene.shadow and scene.lights is not None
+	return shadePhong(scene, intersection, normal, ray, scene.colors[index], kd, ks, shininess, shadows)
+
+# メッシュの交点の色をフォンモデルで計算する (影を含み、1.0 で打ち切った値)
+# 法線は頂点法線の補間で、三角形の裏側から見たときは視点の側に向ける
+def shadeMesh(scene, triangle, intersection, ray):
+	normal = scene.mesh.getNormals(triangle, intersection)
+	normal = np.where((dot(normal, ray) > 0.0)[..., np.newaxis], -normal, normal)
+	if scene.materials is None or scene.mesh.material is None:
+		kd, ks, shininess = scene.kd, scene.ks, scene.shininess
+	else:
+		kd, ks, shininess = scene.materials.lookup(scene.mesh.material)
+	albedo = np.broadcast_to(scene.mesh.color, intersection.shape)
+	return np.minimum(shadePhong(scene, intersection, normal, ray, albedo, kd, ks, shininess, scene.shadow), 1.0)
+
+# 床の交点の色を計算する (影を含み、1.0 で打ち切った値)
+# footprint: 格子模様を平均する範囲 (getFloorColors)。None なら交点の色をそのまま使う
+# ray: 交点への視線 (床の材質に鏡面反射があるときに使う)
+def shadeFloor(scene, intersection, footprint=None, ray=None):
+	floor_color = getFloorColors(scene, intersection[..., 0], intersection[..., 2], footprint)
+	normal = np.broadcast_to(np.array([0.0, 1.0, 0.0], dtype=scene.dtype), intersection.shape)	# 床の法線は上向き
+	if scene.materials is None:
+		kd, ks, shininess = scene.kd, 0.0, scene.shininess	# 床は鏡面反射しない
+	else:
+		kd, ks, shininess = scene.materials.lookup(scene.floorMaterial)
+
+	if scene.lights is not None:
+		# 光源ごとに影のレイを飛ばす
+		return np.minimum(shadePhong(scene, intersection, normal, ray, floor_color, kd, ks, shininess, scene.shadow), 1.0)
+
+	I = shadePhong(scene, intersection, normal, ray, floor_color, kd, ks, shininess)
+	if scene.shadow and scene.softShadow is not None:
+		# 光の届く割合に応じて、影の中 (0.5 倍) と外の間を補間する
+		visible = getLightVisibility(scene, intersection, normal, getLights(scene, intersection))[0]
+		I = I * (0.5 + 0.5 * visible)[..., np.newaxis]
+	elif scene.shadow:
+		light_dir = scene.getLightDir()
+		with statsScope(scene, kind="shadow"):
+			if scene.shadowMask is not None and scene.mesh is None:	# 影のマスクは球の影だけを持つ
+				in_shadow = scene.shadowMask.isShadowed(scene, intersection)
+			else:
+				shadow_origin = intersection + scene.epsilon * light_dir	# 微小量だけずらす
+				in_shadow = isOccluded(scene, shadow_origin, np.broadcast_to(light_dir, intersection.shape))
+		I = np.where(in_shadow[..., np.newaxis], I * 0.5, I)
+
+	return np.minimum(I, 1.0)
+
+# 球面で反射したレイが床に当たる場合の映り込みを加える
+def addFloorReflection(scene, I, intersection, ray, normal):
+	reflect_ray = normalize(ray - 2.0 * dot(ray, normal)[..., np.newaxis] * normal)
+	reflect_origin = intersection + scene.epsilon * reflect_ray
+	g_RayCounts["reflection"] += len(reflect_ray)
+	countStats(scene, rays=1)
+
+	t_floor = intersectBoard(scene, reflect_origin, reflect_ray)
+	hit = t_floor > 0.0
+	if not np.any(hit):
+		return I
+
+	w = scene.reflectionWeight
+	floor_point = reflect_origin[hit] + t_floor[hit][..., np.newaxis] * reflect_ray[hit]
+	with statsScope(scene, hit):
+		reflection_color = (I[hit] + shadeFloor(scene, floor_point, ray=reflect_ray[hit])) / 2.0
+	I = I.copy()
+	I[hit] = (1.0 - w) * I[hit] + w * reflection_color
+	return I
+
+# レイの配列 (..., 3) をまとめて追跡し、色と当たった物体IDを返す
+# pixelSize: 一次レイのときの1画素の大きさ。scene.floorFilter が有効なら、床の格子模様をこの範囲で平均する
+def traceRaysWithIds(scene, origin, rays, sphereHits=None, pixelSize=None):
+	shape = rays.shape[:-1]
+	v = rays.reshape(-1, 3)
+	p = np.broadcast_to(origin, v.shape)
+
+	colors = np.empty(v.shape, dtype=scene.dtype)
+	colors[:] = scene.background
+	ids = np.full(len(v), ID_BACKGROUND, dtype=np.int64)
+	g_RayCounts["primary"] += len(v)
+	countStats(scene, rays=1)
+
+	# 球との交点 (sphereHits があれば求め済みの (t, 球の番号) を使う)
+	if sphereHits is None:
+		min_t, index = intersectSpheres(scene, p, v)
+	else:
+		min_t, index = [a.reshape(-1) for a in sphereHits]
+	# メッシュが球より手前にあるレイ
+	on_mesh = np.zeros(len(v), dtype=bool)
+	if scene.mesh is not None:
+		t_mesh, triangle = intersectMesh(scene, p, v)
+		on_mesh = t_mesh < min_t
+		index = np.where(on_mesh, -1, index)
+
+	on_sphere = index >= 0
+	if np.any(on_sphere):
+		ray = v[on_sphere]
+		intersection = p[on_sphere] + min_t[on_sphere][..., np.newaxis] * ray
+		I = shadeSpheres(scene, index[on_sphere], intersection, ray)
+		if scene.reflectionWeight is not None:
+			normal = normalize(intersection - scene.centers[index[on_sphere]])
+			with statsScope(scene, on_sphere, "reflection"):
+				if scene.reflections is not None:
+					I = scene.reflections.shade(scene, I, intersection, ray, normal)
+				else:
+					I = addFloorReflection(scene, I, intersection, ray, normal)
+		colors[on_sphere] = np.minimum(I, 1.0)
+		ids[on_sphere] = index[on_sphere]
+
+	# 球に当たらなかったレイと床との交点 (メッシュに当たったレイは床の方が手前なら床)
+	rest = np.flatnonzero(~on_sphere)
+	with statsScope(scene, rest):
+		t = intersectBoard(scene, p[rest], v[rest])
+	on_floor = t > 0.0
+	if scene.mesh is not None:
+		on_floor &= ~on_mesh[rest] | (t < t_mesh[rest])
+		on_mesh[rest[on_floor]] = False
+		if np.any(on_mesh):
+			ray = v[on_mesh]
+			intersection = p[on_mesh] + t_mesh[on_mesh][..., np.newaxis] * ray
+			with statsScope(scene, on_mesh):
+				colors[on_mesh] = shadeMesh(scene, triangle[on_mesh], intersection, ray)
+			ids[on_mesh] = ID_MESH
+	floor = rest[on_floor]
+	if len(floor) > 0:
+		intersection = p[floor] + t[on_floor][..., np.newaxis] * v[floor]
+		footprint = None
+		if scene.floorFilter and pixelSize is not None:
+			footprint = getFloorFootprint(scene, intersection, pixelSize)
+		with statsScope(scene, floor):
+			colors[floor] = shadeFloor(scene, intersection, footprint, v[floor])
+		ids[floor] = ID_FLOOR
+
+	return colors.reshape(shape + (3,)), ids.reshape(shape)
+
+# レイの配列 (..., 3) をまとめて追跡し、色を返す
+def traceRays(scene, origin, rays):
+	return traceRaysWithIds(scene, origin, rays)[0]
+
+# スクリーン座標 xs, ys を通る一次レイを追跡し、(色, 物体ID) を返す
+# パケット追跡が有効で画面の格子 (rows, cols) のときは、球との交点をパケットごとに求める
+# pixelSize: 1つのサンプルが受け持つ画面上の幅 (床の格子模様の平均に使う)
+def tracePrimaryRays(scene, xs, ys, pixelSize=1.0):
+	rays = getPrimaryRays(scene, xs, ys)
+	pixels = None if scene.stats is None else scene.stats.getPixels(xs, ys)
+	with statsScope(scene, kind="primary", pixels=pixels):
+		hits = None
+		if scene.packets is not None and np.ndim(xs) == 2:
+			hits = scene.packets.intersect(scene, xs, ys, rays)
+		return traceRaysWithIds(scene, scene.viewpoint, rays, hits, pixelSize)
+
+# スーパーサンプリングのずらし量 (week8_task4 の 3x3 と同じ順序)
+AA_OFFSETS = [(dx, dy) for dy in [-1./3., 0., 1./3.] for dx in [-1./3., 0., 1./3.]]
+
+# 画面の一部 (rows, cols の範囲) を描画する。範囲を省略すると画面全体
+def renderRegion(scene, halfWidth, halfHeight, antiAliasing=False, rows=None, cols=None, pixelSize=1.0):
+	if not antiAliasing:
+		xs, ys = getScreenGrid(halfWidth, halfHeight, rows=rows, cols=cols, pixelSize=pixelSize)
+		return tracePrimaryRays(scene, xs, ys, pixelSize)[0]
+
+	# 3x3 スーパーサンプリング
+	color_sum = None
+	for dx, dy in AA_OFFSETS:
+		xs, ys = getScreenGrid(halfWidth, halfHeight, dx, dy, rows, cols, pixelSize)
+		colors = tracePrimaryRays(scene, xs, ys, pixelSize / 3.0)[0]
+		color_sum = colors if color_sum is None else color_sum + colors
+	return color_sum / 9.0
+
+# 画面全体を描画し (2*halfHeight+1, 2*halfWidth+1, 3) の画像を返す
+# 画像の行は y = -halfHeight から順に並ぶ (glDrawPixels と同じ向き)
+# pixelSize を指定すると、スクリーン座標で (halfWidth, halfHeight) * pixelSize の範囲を描く (縮小した解像度での描画)
+def renderFrame(scene, halfWidth, halfHeight, antiAliasing=False, pixelSize=1.0):
+	if scene.stats is None:
+		return renderRegion(scene, halfWidth, halfHeight, antiAliasing, pixelSize=pixelSize)
+
+	scene.stats.beginFrame(2 * halfHeight + 1, 2 * halfWidth + 1, pixelSize)
+	image = renderRegion(scene, halfWidth, halfHeight, antiAliasing, pixelSize=pixelSize)
+	scene.stats.endFrame()
+	return image
+
+# n x n の格子状にずらしたサンプル位置 (n = 3 のとき AA_OFFSETS と同じ値・順序)
+def getGridOffsets(n):
+	steps = [(i - (n - 1) / 2.0) / n for i in range(n)]
+	return [(dx, dy) for dy in steps for dx in steps]
+
+# 隣の画素と色の差が contrast を超えるか、当たった物体が違う画素を選ぶ
+def findEdgePixels(colors, ids, contrast):
+	edge = np.zeros(ids.shape, dtype=bool)
+	for axis in (0, 1):
+		color_step = np.abs(np.diff(colors, axis=axis)).max(axis=-1) > contrast
+		id_step = np.diff(ids, axis=axis) != 0
+		step = color_step | id_step
+		# 差のある2画素の両方を選ぶ
+		if axis == 0:
+			edge[:-1] |= step
+			edge[1:] |= step
+		else:
+			edge[:, :-1] |= step
+			edge[:, 1:] |= step
+	return edge
+
+# 適応的アンチエイリアシング
+# まず画素の中心で1回ずつ追跡し、輪郭・格子の境目・影の境界など周囲と差のある画素だけを
+# gridSize x gridSize のサンプルで計算し直す。戻り値は (画像, 統計)
+# rows: (開始行, 終了行) を渡すとその行だけを計算する (段階的描画の最後の段階用)
+# 隣の画素との差を調べるため上下1行ずつ余分に追跡するので、画面全体を計算したときと同じ結果になる
+def renderAdaptive(scene, halfWidth, halfHeight, contrast=0.05, gridSize=3, rows=None):
+	height = 2 * halfHeight + 1
+	band = rows or (0, height)
+	traced = (max(0, band[0] - 1), min(height, band[1] + 1))
+	if scene.stats is not None and rows is None:
+		scene.stats.beginFrame(height, 2 * halfWidth + 1)
+	xs, ys = getScreenGrid(halfWidth, halfHeight, rows=traced)
+	colors, ids = tracePrimaryRays(scene, xs, ys)
+	edge = findEdgePixels(colors, ids, contrast)
+	inner = slice(band[0] - traced[0], band[1] - traced[0])
+	xs, ys, colors, edge = xs[inner], ys[inner], colors[inner], edge[inner]
+
+	px, py = xs[edge], ys[edge]
+	offsets = getGridOffsets(gridSize)
+	color_sum = None
+	for dx, dy in offsets:
+		if dx == 0.0 and dy == 0.0:
+			samples = colors[edge]	# 中心のサンプルは1回目の結果を使う
+		else:
+			samples = tracePrimaryRays(scene, px + dx, py + dy, 1.0 / gridSize)[0]
+		color_sum = samples if color_sum is None else color_sum + samples
+
+	image = colors.copy()
+	image[edge] = color_sum / float(len(offsets))
+
+	refined = int(np.count_nonzero(edge))
+	reused = 1 if gridSize % 2 == 1 else 0
+	stats = {
+		"pixels": edge.size,
+		"refined": refined,
+		"samples": edge.size + refined * (len(offsets) - reused),
+		"fixedSamples": edge.size * len(AA_OFFSETS),
+	}
+	if scene.stats is not None and rows is None:
+		scene.stats.endFrame()
+	return image, stats
+
+# 適応的アンチエイリアシングの統計を1行の文字列にする
+def getAdaptiveReportText(stats):
+	return (f"Adaptive AA: refined {stats['refined']} / {stats['pixels']} pixels "
+		f"({100.0 * stats['refined'] / stats['pixels']:.1f}%), {stats['samples']} samples "
+		f"(fixed 3x3: {stats['fixedSamples']}, {stats['fixedSamples'] / stats['samples']:.2f}x fewer)")
+
+# 画像を連続した float32 または uint8 のフレームバッファ (H, W, 3) に変換する
+def toFramebuffer(image, dtype=np.float32):
+	if np.dtype(dtype) == np.uint8:
+		return np.ascontiguousarray(np.clip(image, 0.0, 1.0) * 255.0 + 0.5, dtype=np.uint8)
+	return np.ascontiguousarray(image, dtype=dtype)
+
+# 比較用に getPixelColor を1画素ずつ呼んで同じ形の画像を作る (rows, cols は renderRegion と同じ)
+def renderReference(getPixelColor, halfWidth, halfHeight, antiAliasing=False, rows=None, cols=None):
+	rows = rows or (0, 2 * halfHeight + 1)
+	cols = cols or (0, 2 * halfWidth + 1)
+	image = np.zeros((rows[1] - rows[0], cols[1] - cols[0], 3), dtype=np.float64)
+	for row in range(rows[1] - rows[0]):
+		y = rows[0] + row - halfHeight
+		for col in range(cols[1] - cols[0]):
+			x = cols[0] + col - halfWidth
+			if antiAliasing:
+				color_sum = np.zeros(3)
+				for dx, dy in AA_OFFSETS:
+					color_sum += getPixelColor(x + dx, y + dy)
+				image[row, col] = color_sum / 9.0
+			else:
+				image[row, col] = getPixelColor(x, y)
+	return image
+
+# 2つの画像の画素ごとの最大誤差と、誤差が tolerance を超える画素数を返す
+def compareFrames(a, b, tolerance=1.0e-9):
+	error = np.abs(a - b).max(axis=-1)
+	return float(error.max()), int(np.count_nonzero(error > tolerance))
+
+# スクリプトを読み込み、光の向きを __main__ と同じように正規化する
+def loadTracer(name):
+	module = importlib.import_module(name)
+	L = module.g_LightDirection
+	module.g_LightDirection = L / np.sqrt(L.dot(L))
+	return module
+
+# 使い方: python raytracer.py week8_task3 [halfWidth halfHeight]
+# ベクトル化エンジンと getPixelColor の結果を画素ごとに比較する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_task3"
+	halfWidth = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+	halfHeight = int(sys.argv[3]) if len(sys.argv) > 3 else halfWidth
+	module = loadTracer(name)
+	antiAliasing = getattr(module, "g_AntiAliasing", False)
+
+	start = time.perf_counter()
+	image = renderFrame(module.getScene(), halfWidth, halfHeight, antiAliasing)
+	vector_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	reference = renderReference(module.getPixelColor, halfWidth, halfHeight, antiAliasing)
+	scalar_time = time.perf_counter() - start
+
+	max_error, mismatches = compareFrames(image, reference)
+	print(f"{name}: {image.shape[1]}x{image.shape[0]} AA={'ON' if antiAliasing else 'OFF'}")
+	print(f"  vectorized {vector_time * 1000:.1f} ms, getPixelColor {scalar_time * 1000:.1f} ms")
+	print(f"  max error {max_error:.3g}, mismatched pixels {mismatches}")
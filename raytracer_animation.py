@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import raytracer
+import raytracer_bench
+import raytracer_image
+import raytracer_parallel
+
+# カメラの軌道 (周回・キーフレーム) に沿った連番画像の一括描画
+# フレームを複数のワーカープロセスに振り分ける。シーン (球の配列・BVH・影のマスクなど) は
+# ワーカーごとに1回だけ作り、フレームごとには視点とカメラの向きだけを変える
+# 出力先にすでにある画像のフレームは飛ばすので、途中で止めた描画を続きから再開できる
+
+FRAME_PATTERN = "frame_{:04d}.png"	# 連番画像のファイル名
+
+# 視点 eye から注視点 target を見るカメラの向き (行が右・上・後ろの単位ベクトル)
+# eye から -z 方向を見るときは単位行列になり、カメラの向きがないシーンと同じ画像になる
+def getLookAtRotation(eye, target, up=(0., 1., 0.)):
+	back = raytracer.normalize(np.asarray(eye, dtype=np.float64) - np.asarray(target, dtype=np.float64))
+	right = raytracer.normalize(np.cross(up, back))
+	return np.array([right, np.cross(back, right), back])
+
+# 注視点 target のまわりを水平に回るカメラの軌道
+class OrbitPath:
+	def __init__(self, target, radius, frames, height=0.0, startAngle=0.0, turns=1.0):
+		self.target = np.array(target, dtype=np.float64)	# 注視点 (回転の中心)
+		self.radius = float(radius)	# 回転の半径 (xz 平面上)
+		self.frames = int(frames)	# フレーム数
+		self.height = float(height)	# 注視点から見た視点の高さ
+		self.startAngle = float(startAngle)	# 最初のフレームの角度 [度] (0 なら注視点の +z 側)
+		self.turns = float(turns)	# 全フレームで回る回数 (1 なら最後のフレームの次が最初のフレームに戻る)
+
+	# フレーム frame の (視点, 注視点)
+	def getCamera(self, frame):
+		angle = np.radians(self.startAngle) + 2.0 * np.pi * self.turns * frame / self.frames
+		offset = np.array([self.radius * np.sin(angle), self.height, self.radius * np.cos(angle)])
+		return self.target + offset, self.target
+
+# キーフレームの間を直線で補間するカメラの軌道
+# keys: {"frame": 番号, "eye": [x, y, z], "target": [x, y, z]} のリスト
+class KeyframePath:
+	def __init__(self, keys):
+		keys = sorted(keys, key=lambda key: key["frame"])
+		if not keys:
+			raise ValueError("keyframe path needs at least one key")
+		self.keyFrames = np.array([key["frame"] for key in keys], dtype=np.float64)
+		self.eyes = np.array([key["eye"] for key in keys], dtype=np.float64).reshape(-1, 3)
+		self.targets = np.array([key["target"] for key in keys], dtype=np.float64).reshape(-1, 3)
+		self.frames = int(self.keyFrames[-1]) + 1
+
+	# フレーム frame の (視点, 注視点)
+	def getCamera(self, frame):
+		eye = np.array([np.interp(frame, self.keyFrames, self.eyes[:, i]) for i in range(3)])
+		target = np.array([np.interp(frame, self.keyFrames, self.targets[:, i]) for i in range(3)])
+		return eye, target
+
+# JSON ファイルからカメラの軌道を読み込む
+#   {"type": "orbit", "target": [...], "radius": r, "frames": n, "height": h, "startAngle": a, "turns": t}
+#   {"type": "keyframes", "keys": [{"frame": 0, "eye": [...], "target": [...]}, ...]}
+def loadPath(path):
+	with open(path) as f:
+		data = json.load(f)
+	kind = data.pop("type", "keyframes")
+	if kind == "orbit":
+		return OrbitPath(**data)
+	if kind == "keyframes":
+		return KeyframePath(data["keys"])
+	raise ValueError(f"{path}: unknown camera path type {kind!r}")
+
+# シーンの球を囲む周回軌道 (最初のフレームが元の視点の近くになるように、球の中心の平均を注視点にする)
+def getDefaultOrbit(scene, frames):
+	target = np.asarray(scene.centers, dtype=np.float64).mean(axis=0) if len(scene.radii) > 0 else np.array([0., 0., -scene.distance])
+	eye = np.asarray(scene.viewpoint, dtype=np.float64)
+	offset = eye - target
+	return OrbitPath(target, np.hypot(offset[0], offset[2]), frames, height=offset[1],
+		startAngle=np.degrees(np.arctan2(offset[0], offset[2])))
+
+# シーンのカメラを (視点, 注視点) に動かす
+def setCamera(scene, eye, target):
+	scene.viewpoint = np.asarray(eye, dtype=np.float64)
+	scene.cameraRotation = getLookAtRotation(eye, target)
+	scene.setPrecision(scene.dtype)	# 配列の型と、float32 のときの epsilon を視点に合わせ直す
+
+# ワーカープロセスごとに1回だけ作るシーン
+g_Scene = None
+g_AntiAliasing = False
+
+# ワーカープロセスの初期化: スクリプトかシーンファイルからシーンを作る
+def initWorker(name, antiAliasing):
+	global g_Scene, g_AntiAliasing
+	tracer, g_Scene = raytracer_bench.loadCase(name)
+	g_AntiAliasing = antiAliasing if antiAliasing is not None else bool(getattr(tracer, "g_AntiAliasing", False))
+
+# 1フレームを描画して PNG に保存する (ワーカープロセスで実行される)
+# 書き終わってから名前を付け替えるので、途中で止めても書きかけの画像は残らない
+def renderAnimationFrame(job):
+	frame, eye, target, halfWidth, halfHeight, path = job
+	start = time.perf_counter()
+	setCamera(g_Scene, eye, target)
+	image = raytracer.renderFrame(g_Scene, halfWidth, halfHeight, g_AntiAliasing)
+	raytracer_image.savePNG(path + ".tmp", image)
+	os.replace(path + ".tmp", path)
+	return frame, time.perf_counter() - start, os.getpid()
+
+# 軌道の全フレームのうち、出力先にまだ画像がないフレームの (番号, ファイル名) のリスト
+def getPendingFrames(cameraPath, directory, pattern=FRAME_PATTERN):
+	frames = [(frame, os.path.join(directory, pattern.format(frame))) for frame in range(cameraPath.frames)]
+	return [(frame, path) for frame, path in frames if not os.path.exists(path)]
+
+# 連番画像を描画する。描画したフレーム数を返す
+def renderAnimation(name, cameraPath, directory, halfWidth, halfHeight, antiAliasing=None,
+		workers=None, pattern=FRAME_PATTERN, log=sys.stderr):
+	os.makedirs(directory, exist_ok=True)
+	pending = getPendingFrames(cameraPath, directory, pattern)
+	skipped = cameraPath.frames - len(pending)
+	if skipped:
+		print(f"{skipped} of {cameraPath.frames} frames already exist in {directory}", file=log)
+	if not pending:
+		return 0
+
+	jobs = []
+	for frame, path in pending:
+		eye, target = cameraPath.getCamera(frame)
+		jobs.append((frame, eye, target, halfWidth, halfHeight, path))
+
+	workers = min(workers or raytracer_parallel.g_Workers, len(jobs))
+	start = time.perf_counter()
+	with multiprocessing.Pool(workers, initializer=initWorker, initargs=(name, antiAliasing)) as pool:
+		for done, (frame, seconds, pid) in enumerate(pool.imap_unordered(renderAnimationFrame, jobs), 1):
+			print(f"[{done}/{len(jobs)}] frame {frame}: {seconds * 1000:.1f} ms (worker {pid})", file=log)
+	elapsed = time.perf_counter() - start
+	print(f"{len(jobs)} frames in {elapsed:.2f} s with {workers} workers ({len(jobs) / elapsed:.2f} frames/s)", file=log)
+	return len(jobs)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="render a camera path of a week7 / week8 scene as numbered PNG frames")
+	parser.add_argument("scene", help="script name or scene file (.json / .rtscene)")
+	parser.add_argument("output", help="output directory (existing frames are skipped)")
+	parser.add_argument("--path", help="camera path JSON file (orbit or keyframes); default is an orbit around the spheres")
+	parser.add_argument("--frames", type=int, default=36, help="frames of the default orbit")
+	parser.add_argument("--size", type=int, default=200, help="half width of the screen")
+	parser.add_argument("--workers", type=int, default=None, help="worker processes")
+	parser.add_argument("--aa", choices=["on", "off"], help="3x3 supersampling (default: the script's g_AntiAliasing)")
+	args = parser.parse_args(argv)
+
+	if args.path:
+		cameraPath = loadPath(args.path)
+	else:
+		cameraPath = getDefaultOrbit(raytracer_bench.loadCase(args.scene)[1], args.frames)
+	antiAliasing = None if args.aa is None else args.aa == "on"
+	renderAnimation(args.scene, cameraPath, args.output, args.size, args.size, antiAliasing, args.workers)
+
+# 使い方: python raytracer_animation.py week8_advanced1 orbit/ [--frames 36] [--size 200] [--workers 4]
+#         python raytracer_animation.py million.rtscene flythrough/ --path camera.json
+if __name__ == "__main__":
+	main(sys.argv[1:])
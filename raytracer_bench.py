@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+import raytracer
+import raytracer_bvh
+import raytracer_scene
+
+# week7 / week8 のレイトレーサーのベンチマーク (ウィンドウを開かずに実行する)
+# スクリプトごと・解像度ごと・1画素あたりのサンプル数ごとに描画時間、種類ごとのレイの処理速度、
+# ピークメモリを測り、コミットどうしで比べられるように JSON で書き出す
+
+SCRIPTS = ["week7_task", "week8_task1", "week8_task2", "week8_task3", "week8_task4",
+	"week8_advanced1", "week8_advanced2"]
+HALF_SIZES = [50, 100, 200]	# 画面の幅/2 (高さも同じ)
+SAMPLES = [1, 9]	# 1画素あたりのサンプル数 (9 は 3x3 スーパーサンプリング)
+SCENE_EXTENSIONS = (".json", ".rtscene")	# スクリプト名の代わりに渡せるシーンファイル (raytracer_scene)
+BVH_SPHERE_COUNT = 64	# シーンファイルの球がこれより多ければ BVH を作る
+
+# このプロセスのメモリ使用量の最大 (ピーク RSS) [KB]
+# ru_maxrss の単位は Linux では KB、macOS ではバイト
+def getPeakRss():
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak // 1024 if sys.platform == "darwin" else peak
+
+# 現在のコミットのハッシュ (git がなければ None)
+def getCommit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# 1つの条件で描画する。mode は "engine" (raytracer.py) か "reference" (getPixelColor)
+def render(tracer, scene, halfWidth, samples, mode):
+	if mode == "reference":
+		return raytracer.renderReference(tracer.getPixelColor, halfWidth, halfWidth, samples > 1)
+	return raytracer.renderFrame(scene, halfWidth, halfWidth, samples > 1)
+
+# スクリプトのシーン、またはシーンファイルを読み込む (シーンファイルなら tracer は None)
+def loadCase(name):
+	if name.endswith(SCENE_EXTENSIONS):
+		scene = raytracer_scene.loadScene(name)
+		if len(scene.radii) > BVH_SPHERE_COUNT:
+			scene.bvh = raytracer_bvh.BVH(scene.centers, scene.radii)
+		return None, scene
+	tracer = raytracer.loadTracer(name)
+	return tracer, tracer.getScene()
+
+# 1つの条件を測る。repeat 回のうち最も速い時間と、別の1回で測ったピークメモリを返す
+def runCase(name, halfWidth, samples, mode, repeat):
+	start = time.perf_counter()
+	tracer, scene = loadCase(name)
+	build_time = time.perf_counter() - start
+
+	render(tracer, scene, halfWidth, samples, mode)	# 影のマスクなどの準備を済ませておく
+	wall = float("inf")
+	for _ in range(repeat):
+		raytracer.resetRayCounts()
+		start = time.perf_counter()
+		render(tracer, scene, halfWidth, samples, mode)
+		wall = min(wall, time.perf_counter() - start)
+	counts = dict(raytracer.g_RayCounts)
+
+	tracemalloc.start()
+	render(tracer, scene, halfWidth, samples, mode)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	size = 2 * halfWidth + 1
+	result = {
+		"script": name,
+		"mode": mode,
+		"width": size,
+		"height": size,
+		"samples": samples,
+		"precision": str(scene.dtype),
+		"sceneBuildSeconds": build_time,
+		"wallSeconds": wall,
+		"peakBytes": peak,
+	}
+	if mode == "reference":
+		# getPixelColor の中のレイは数えられないので、一次レイの数だけ求める
+		counts = {"primary": size * size * samples, "shadow": None, "reflection": None}
+	for kind, count in counts.items():
+		result[kind + "Rays"] = count
+		result[kind + "RaysPerSecond"] = None if count is None else count / wall
+	return result
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="week7 / week8 ray tracer benchmark")
+	parser.add_argument("scripts", nargs="*", default=SCRIPTS, help="benchmarked scripts or scene files")
+	parser.add_argument("--sizes", type=int, nargs="+", default=HALF_SIZES, help="half widths of the screen")
+	parser.add_argument("--samples", type=int, nargs="+", default=SAMPLES, choices=[1, 9], help="samples per pixel")
+	parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (the fastest is reported)")
+	parser.add_argument("--reference", action="store_true", help="also time getPixelColor at the smallest size")
+	parser.add_argument("--output", default="-", help="JSON output file (- for stdout)")
+	args = parser.parse_args(argv)
+
+	runs = []
+	for name in args.scripts:
+		cases = [(size, samples, "engine") for size in args.sizes for samples in args.samples]
+		if args.reference and not name.endswith(SCENE_EXTENSIONS):
+			cases += [(min(args.sizes), samples, "reference") for samples in args.samples]
+		for size, samples, mode in cases:
+			run = runCase(name, size, samples, mode, args.repeat)
+			runs.append(run)
+			print(f"{name} {mode} {run['width']}x{run['height']} x{samples}: {run['wallSeconds'] * 1000:.1f} ms, "
+				f"{run['primaryRaysPerSecond'] / 1.0e6:.2f} Mrays/s primary, "
+				f"peak {run['peakBytes'] / 1.0e6:.1f} MB", file=sys.stderr)
+
+	report = {
+		"commit": getCommit(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"cpus": os.cpu_count(),
+		"maxRssKilobytes": getPeakRss(),
+		"runs": runs,
+	}
+	text = json.dumps(report, indent=2)
+	if args.output == "-":
+		print(text)
+	else:
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+
+# 使い方: python raytracer_bench.py [スクリプト名 / シーンファイル ...] [--sizes 50 100] [--samples 1 9] [--output bench.json]
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,235 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 球の集合に対する BVH (bounding volume hierarchy)
+# 重心の広がりが最も大きい軸で球を半分ずつ (中央値で) 分けていき、完全二分木を作る
+# ノード i の子は 2i+1, 2i+2 で、最後の段が葉になる
+# 探索はレイごとのスタックを配列で持ち、全てのレイを同時に1ノードずつ進める
+# 木の作り方と探索は図形によらないので、葉の交差判定 (intersectLeaf) を替えれば三角形にも使える (raytracer_mesh)
+
+g_LeafSize = 4	# 葉に入れる球の数
+g_ChunkSize = 1 << 16	# 一度に探索するレイの数 (スタック用のメモリを抑える)
+
+class BVH:
+	def __init__(self, centers, radii, leafSize=None):
+		start = time.perf_counter()
+		# float32 のシーンは float32 のまま扱う
+		dtype = np.float32 if np.asarray(centers).dtype == np.float32 else np.float64
+		self.centers = np.asarray(centers, dtype=dtype).reshape(-1, 3)
+		self.radii = np.asarray(radii, dtype=dtype)
+
+		# 球の境界箱 (数値誤差で交点を取りこぼさないよう少し広げる。float32 では誤差に合わせて広げる)
+		margin = 1.0e-7 * self.radii + 1.0e-9 * np.abs(self.centers).max(axis=1, initial=0.0)
+		margin *= np.sqrt(np.finfo(dtype).eps / np.finfo(np.float64).eps)
+		sphere_min = self.centers - (self.radii + margin)[:, np.newaxis]
+		sphere_max = self.centers + (self.radii + margin)[:, np.newaxis]
+		self.build(self.centers, sphere_min, sphere_max, leafSize)
+		self.buildTime = time.perf_counter() - start
+
+	# 重心 centroids と境界箱 (primMin, primMax) の配列から木を作る (球以外の図形でも使う)
+	def build(self, centroids, primMin, primMax, leafSize=None):
+		self.leafSize = leafSize or g_LeafSize
+
+		# 葉の数を 2 のべき乗にそろえ、余った場所は -1 (図形なし) で埋める
+		count = len(centroids)
+		self.primCount = count	# 図形の数
+		self.leafCount = 1
+		while self.leafCount * self.leafSize < count:
+			self.leafCount *= 2
+		self.depth = self.leafCount.bit_length() - 1	# 根から葉までの段数
+		self.firstLeaf = self.leafCount - 1	# 最初の葉のノード番号
+
+		order = np.full(self.leafCount * self.leafSize, -1, dtype=np.int64)
+		order[:count] = np.arange(count)
+		self.axis = np.zeros(self.firstLeaf, dtype=np.int64)	# 内部ノードで分割に使った軸
+
+		# 段ごとに、全てのノードの図形をまとめて中央値で二つに分ける
+		for level in range(self.depth):
+			segments = 1 << level
+			seg = order.reshape(segments, -1)
+			valid = seg >= 0
+			c = centroids[np.maximum(seg, 0)]
+			lo = np.where(valid[..., np.newaxis], c, np.inf).min(axis=1)
+			hi = np.where(valid[..., np.newaxis], c, -np.inf).max(axis=1)
+			axis = np.argmax(np.nan_to_num(hi - lo, nan=-1.0, neginf=-1.0), axis=1)
+
+			keys = np.take_along_axis(c, axis[:, np.newaxis, np.newaxis], axis=2)[..., 0]
+			keys[~valid] = np.inf	# 図形のない場所は右側に寄せる
+			half = seg.shape[1] // 2
+			part = np.argpartition(keys, half, axis=1)
+			order = np.take_along_axis(seg, part, axis=1).reshape(-1)
+			self.axis[segments - 1:2 * segments - 1] = axis
+
+		self.leafPrims = order.reshape(self.leafCount, self.leafSize)	# 葉ごとの図形の番号
+
+		# 葉の境界箱
+		valid = (self.leafPrims >= 0)[..., np.newaxis]
+		prims = np.maximum(self.leafPrims, 0)
+		nodes = 2 * self.leafCount - 1
+		self.nodeMin = np.empty((nodes, 3), dtype=primMin.dtype)
+		self.nodeMax = np.empty((nodes, 3), dtype=primMax.dtype)
+		self.nodeMin[self.firstLeaf:] = np.where(valid, primMin[prims], np.inf).min(axis=1)
+		self.nodeMax[self.firstLeaf:] = np.where(valid, primMax[prims], -np.inf).max(axis=1)
+
+		# 内部ノードの境界箱を下の段から順に求める
+		for level in range(self.depth - 1, -1, -1):
+			node = np.arange((1 << level) - 1, (1 << (level + 1)) - 1)
+			self.nodeMin[node] = np.minimum(self.nodeMin[2 * node + 1], self.nodeMin[2 * node + 2])
+			self.nodeMax[node] = np.maximum(self.nodeMax[2 * node + 1], self.nodeMax[2 * node + 2])
+
+	# 葉 leaves (レイ,) の図形とレイ p, v (レイ, 1, 3) の交点の t (レイ, 葉の大きさ)。交わらなければ inf
+	def intersectLeaf(self, leaves, p, v):
+		prims = self.leafPrims[leaves]
+		safe = np.maximum(prims, 0)
+		t = raytracer.intersectSphere(self.centers[safe], self.radii[safe], p, v)
+		return np.where((prims >= 0) & (t > 0.0), t, np.inf)
+
+	# 構築結果の統計 (空でないノード数、葉の数、深さ、構築時間)
+	def getReport(self):
+		return {
+			"spheres": len(self.radii),
+			"nodes": int(np.count_nonzero(np.all(self.nodeMin <= self.nodeMax, axis=1))),
+			"leaves": self.leafCount,
+			"depth": self.depth,
+			"buildMs": self.buildTime * 1000.0,
+		}
+
+	# 統計を1行の文字列にする
+	def getReportText(self):
+		r = self.getReport()
+		return (f"BVH: {r['spheres']} spheres, {r['nodes']} nodes, {r['leaves']} leaves, "
+			f"depth {r['depth']}, build {r['buildMs']:.1f} ms")
+
+	# 最も近い球との交点を求める (raytracer.intersectSpheres と同じ結果)
+	# tests (レイと同じ形の配列) を渡すと、レイごとの球との交差判定の回数を足す
+	def intersect(self, p, v, tests=None):
+		shape = np.shape(v)[:-1]
+		p, v = [a.reshape(-1, 3) for a in np.broadcast_arrays(p, v)]
+		min_t = np.full(len(v), np.inf, dtype=v.dtype)
+		index = np.full(len(v), -1, dtype=np.int64)
+		flat_tests = None if tests is None else tests.reshape(-1)
+		for s in range(0, len(v), g_ChunkSize):
+			self.traverse(p[s:s + g_ChunkSize], v[s:s + g_ChunkSize],
+				min_t[s:s + g_ChunkSize], index[s:s + g_ChunkSize], None,
+				None if tests is None else flat_tests[s:s + g_ChunkSize])
+		return min_t.reshape(shape), index.reshape(shape)
+
+	# どれかの球に遮られるかを求める (raytracer.isOccluded と同じ結果)
+	# maxT を渡すと、t がそれより手前の交点だけを遮るものとみなす (点光源までの距離など)
+	def occluded(self, p, v, tests=None, maxT=None):
+		shape = np.shape(v)[:-1]
+		p, v = [a.reshape(-1, 3) for a in np.broadcast_arrays(p, v)]
+		result = np.zeros(len(v), dtype=bool)
+		flat_tests = None if tests is None else tests.reshape(-1)
+		limit = None if maxT is None else np.broadcast_to(maxT, shape).reshape(-1)
+		for s in range(0, len(v), g_ChunkSize):
+			self.traverse(p[s:s + g_ChunkSize], v[s:s + g_ChunkSize],
+				None if limit is None else limit[s:s + g_ChunkSize], None, result[s:s + g_ChunkSize],
+				None if tests is None else flat_tests[s:s + g_ChunkSize])
+		return result.reshape(shape)
+
+	# レイの配列を木に沿って手前のノードから順にたどる
+	# occluded が None なら最も近い交点 (min_t, index) を更新し、そうでなければ遮られたかだけを求める
+	# 遮られたかを求めるときの min_t は交点を探す t の上限 (None なら上限なし)
+	def traverse(self, p, v, min_t, index, occluded, tests=None):
+		if len(v) == 0 or self.primCount == 0:
+			return
+		with np.errstate(divide="ignore"):
+			inv = 1.0 / v
+
+		stack = np.zeros((len(v), self.depth + 2), dtype=np.int64)	# 根 (0) から始める
+		sp = np.ones(len(v), dtype=np.int64)
+		rays = np.arange(len(v))
+
+		while len(rays) > 0:
+			sp[rays] -= 1
+			node = stack[rays, sp[rays]]
+
+			# レイと境界箱の交差判定 (スラブ法)。0 * inf の nan は fmin/fmax で無視する
+			with np.errstate(invalid="ignore"):
+				t0 = (self.nodeMin[node] - p[rays]) * inv[rays]
+				t1 = (self.nodeMax[node] - p[rays]) * inv[rays]
+			tnear = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+			tfar = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+			hit = tfar >= np.maximum(tnear, 0.0)
+			hit &= self.nodeMin[node, 0] <= self.nodeMax[node, 0]	# 図形のないノード (箱が inf, -inf) はスラブ法では当たってしまうので除く
+			if min_t is not None:
+				hit &= tnear <= min_t[rays]	# すでに見つけた交点 (または上限) より奥の箱は調べない
+
+			is_leaf = node >= self.firstLeaf
+
+			# 葉: 中の球と交差判定する
+			leaf = hit & is_leaf
+			if np.any(leaf):
+				r = rays[leaf]
+				leaves = node[leaf] - self.firstLeaf
+				prims = self.leafPrims[leaves]
+				t = self.intersectLeaf(leaves, p[r][:, np.newaxis, :], v[r][:, np.newaxis, :])
+				if tests is not None:
+					tests[r] += np.count_nonzero(prims >= 0, axis=1)
+
+				if occluded is None:
+					# 同じ t なら番号の小さい図形を選ぶ (線形探索と同じ結果になるように)
+					leaf_t = t.min(axis=1)
+					leaf_index = np.where(t == leaf_t[:, np.newaxis], prims, np.iinfo(np.int64).max).min(axis=1)
+					better = (leaf_t < min_t[r]) | ((leaf_t == min_t[r]) & (leaf_index < index[r]) & np.isfinite(leaf_t))
+					min_t[r[better]] = leaf_t[better]
+					index[r[better]] = leaf_index[better]
+				else:
+					limit = np.inf if min_t is None else min_t[r][:, np.newaxis]
+					blocked = r[(t < limit).any(axis=1)]
+					occluded[blocked] = True
+					sp[blocked] = 0	# 遮られたレイはそれ以上調べない
+
+			# 内部ノード: 遠い子、近い子の順に積む (近い子を先に調べる)
+			inner = hit & ~is_leaf
+			if np.any(inner):
+				r = rays[inner]
+				n = node[inner]
+				positive = v[r, self.axis[n]] >= 0.0
+				near = np.where(positive, 2 * n + 1, 2 * n + 2)
+				far = np.where(positive, 2 * n + 2, 2 * n + 1)
+				stack[r, sp[r]] = far
+				stack[r, sp[r] + 1] = near
+				sp[r] += 2
+
+			rays = rays[sp[rays] > 0]
+
+# 床の上に球をランダムに並べたシーンを作る (BVH の性能確認用)
+def makeRandomScene(count, seed=0, **kwargs):
+	rng = np.random.default_rng(seed)
+	radius = 60.0 * (100.0 / max(count, 1)) ** (1.0 / 3.0)	# 球が増えても全体の体積をそろえる
+	centers = np.column_stack([
+		rng.uniform(-1200.0, 1200.0, count),
+		rng.uniform(-150.0 + radius, 600.0, count),
+		rng.uniform(-3000.0, -1300.0, count),
+	])
+	radii = radius * rng.uniform(0.5, 1.0, count)
+	colors = rng.uniform(0.2, 1.0, (count, 3))
+	return raytracer.makeScene(centers, radii, colors, **kwargs)
+
+# 使い方: python raytracer_bvh.py [球の数 ... ]
+# BVH の構築統計と、線形探索との速度・結果の比較を表示する
+if __name__ == "__main__":
+	counts = [int(a) for a in sys.argv[1:]] or [100, 10000, 100000, 1000000]
+	halfWidth = 100
+	for count in counts:
+		scene = makeRandomScene(count, boardY=-150, checkerSize=100,
+			floorColors=((1.0, 1.0, 0.7), (0.6, 0.6, 0.6)), shadow=True)
+		scene.bvh = BVH(scene.centers, scene.radii)
+		print(scene.bvh.getReportText())
+
+		start = time.perf_counter()
+		image = raytracer.renderFrame(scene, halfWidth, halfWidth)
+		print(f"  BVH render {image.shape[1]}x{image.shape[0]}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+		# 線形探索は遅いので小さい画面で比較する
+		if count <= 10000:
+			bvh_image = raytracer.renderFrame(scene, 30, 30)
+			scene.bvh = None
+			start = time.perf_counter()
+			linear_image = raytracer.renderFrame(scene, 30, 30)
+			print(f"  linear render 61x61: {(time.perf_counter() - start) * 1000:.1f} ms, "
+				f"identical: {np.array_equal(bvh_image, linear_image)}")
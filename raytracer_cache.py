@@ -0,0 +1,83 @@
+import os
+import hashlib
+import collections
+import numpy as np
+
+# 描画結果のキャッシュ
+# シーンの内容・解像度・アンチエイリアシングの有無から作ったキーで画像を覚えておき、
+# 同じ条件ならレイトレーシングをせずに前の画像を使う
+
+g_MemoryFrames = 8	# メモリ上に覚えておく画像の数
+g_CacheDir = os.environ.get("RAYTRACER_CACHE_DIR")	# 画像を保存するディレクトリ (None ならメモリ上のみ)
+g_IgnoredFields = {"bvh", "packets", "stats"}	# キーに含めない Scene の属性 (結果に影響しない高速化用のデータ)
+
+# シーンと描画条件から画像のキー (SHA-256 の16進文字列) を作る
+def getSceneKey(scene, halfWidth, halfHeight, antiAliasing=False, mode="engine"):
+	h = hashlib.sha256()
+	h.update(f"{halfWidth},{halfHeight},{bool(antiAliasing)},{mode}".encode())
+	for name, value in sorted(vars(scene).items()):
+		if name in g_IgnoredFields:
+			continue
+		h.update(name.encode())
+		if isinstance(value, np.ndarray):
+			h.update(f"{value.dtype}{value.shape}".encode())
+			h.update(np.ascontiguousarray(value).tobytes())
+		else:
+			h.update(repr(value).encode())
+	return h.hexdigest()
+
+class FrameCache:
+	def __init__(self, capacity=None, directory=None):
+		self.capacity = capacity or g_MemoryFrames
+		self.directory = directory	# None ならディスクには保存しない
+		self.frames = collections.OrderedDict()	# キー -> 画像 (古い順)
+		self.hits = 0
+		self.misses = 0
+
+	# ディスク上のファイル名
+	def getPath(self, key):
+		return os.path.join(self.directory, key + ".npy")
+
+	# キーに対応する画像を返す。なければ None
+	def get(self, key):
+		image = self.frames.get(key)
+		if image is None and self.directory is not None and os.path.exists(self.getPath(key)):
+			image = np.load(self.getPath(key))
+			self.remember(key, image)
+
+		if image is None:
+			self.misses += 1
+			return None
+		self.frames.move_to_end(key)
+		self.hits += 1
+		return image
+
+	# 画像を覚える (ディスクが有効ならファイルにも保存する)
+	def put(self, key, image):
+		image = np.array(image)	# 呼び出し側の配列が書き換わっても影響しないようにコピーする
+		self.remember(key, image)
+		if self.directory is not None:
+			os.makedirs(self.directory, exist_ok=True)
+			temp = self.getPath(key) + ".tmp.npy"
+			np.save(temp, image)
+			os.replace(temp, self.getPath(key))	# 途中で終了しても壊れたファイルが残らないようにする
+
+	# メモリ上に覚え、多すぎれば古いものから捨てる
+	def remember(self, key, image):
+		self.frames[key] = image
+		self.frames.move_to_end(key)
+		while len(self.frames) > self.capacity:
+			self.frames.popitem(last=False)
+
+g_FrameCache = FrameCache(directory=g_CacheDir)
+
+# 同じシーン・同じ条件で描画済みの画像を返す。なければ None
+# レイの統計をとっているとき (Scene.stats) は数えるために描画し直すので None を返す
+def getFrame(scene, halfWidth, halfHeight, antiAliasing=False, mode="engine"):
+	if getattr(scene, "stats", None) is not None:
+		return None
+	return g_FrameCache.get(getSceneKey(scene, halfWidth, halfHeight, antiAliasing, mode))
+
+# 描画した画像を覚える
+def putFrame(scene, halfWidth, halfHeight, image, antiAliasing=False, mode="engine"):
+	g_FrameCache.put(getSceneKey(scene, halfWidth, halfHeight, antiAliasing, mode), image)
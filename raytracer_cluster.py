@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import time
+import socket
+import ipaddress
+import argparse
+import threading
+import subprocess
+import collections
+from multiprocessing.connection import Listener, Client, AuthenticationError
+import numpy as np
+import raytracer
+import raytracer_bench
+import raytracer_cache
+import raytracer_image
+import raytracer_parallel
+import raytracer_service
+
+# 複数のマシンでのタイル分割の描画 (高解像度の静止画用)
+# コーディネーターが画面をタイルに分けて TCP でワーカーに配り、終わったタイルを出力先のディレクトリの
+# 画像ファイル (memmap) と台帳 (ledger) に書き込む。コーディネーターが落ちても、同じディレクトリで
+# 起動し直せば台帳にあるタイルは飛ばして続きから描画する
+# 接続が切れたワーカーのタイルは待ち行列に戻し、なかなか終わらないタイル (遅いワーカーや応答のないマシン) は
+# 手の空いたワーカーにも同じタイルを渡して、先に返ってきた結果を使う
+#
+# 通信は multiprocessing.connection の認証 (HMAC) 付きの接続で、JSON のメッセージと画素のバイト列だけを送る (pickle は使わない)
+# 最初に描画の条件 (スクリプト名かシーンファイル名) を送り、ワーカーは自分でシーンを作ってシーンのキーが同じか確かめる
+# (全てのマシンに同じリポジトリとシーンファイルを置く)。その後はタイルごとに
+#   ワーカー → {"type": "ready"} か {"type": "result", "tile", "seconds"} とタイルの色のバイト列
+#   コーディネーター → {"type": "tile", "tile", "rows", "cols"} か {"type": "wait", "seconds"} か {"type": "done"}
+# をやりとりする。認証の鍵は環境変数 RAYTRACER_CLUSTER_KEY で全てのマシンに同じものを設定する
+# 鍵を設定しないとき (既定の鍵) は、コーディネーターはループバックのアドレスでしか受け付けない
+#
+# 出力先のディレクトリ
+#   job.json    描画の条件 (起動し直したときに同じ条件か確かめる)
+#   image.npy   画像 (H, W, 3)。タイルが終わるたびにその行だけを書き込む
+#   ledger.txt  終わったタイルの番号を1行ずつ追記する (タイルをディスクに書き出してから追記する)
+#   image.png   全てのタイルが終わったときの画像
+
+g_Host = "127.0.0.1"	# コーディネーターが受け付けるアドレス (他のマシンから使うときは "0.0.0.0")
+g_Port = 8766
+DEFAULT_KEY = b"raytracer"	# RAYTRACER_CLUSTER_KEY がないときの鍵 (このマシンの中だけで使う)
+g_AuthKey = os.environ.get("RAYTRACER_CLUSTER_KEY", "").encode() or DEFAULT_KEY	# 認証の鍵
+g_MaxMessage = 1 << 16	# JSON のメッセージの長さの上限 [バイト]
+g_Sync = getattr(os, "fdatasync", os.fsync)	# ファイルの内容をディスクに書き出す (macOS には fdatasync がない)
+g_TileSize = 64	# タイルの一辺の画素数
+g_MinTimeout = 2.0	# タイルを別のワーカーにも渡すまでの最短の時間 [秒]
+g_SlowFactor = 4.0	# 終わったタイルの描画時間の中央値の何倍かかったら遅いとみなすか
+g_WaitSeconds = 0.2	# 渡すタイルがないときにワーカーを待たせる時間 [秒]
+g_RetrySeconds = 30.0	# ワーカーがコーディネーターにつながるまで試し続ける時間 [秒]
+g_DrainSeconds = 5.0	# 全てのタイルが終わったあと、描画中のワーカーに done を伝えるために待つ時間の上限 [秒]
+
+JOB_FILE = "job.json"
+IMAGE_FILE = "image.npy"
+LEDGER_FILE = "ledger.txt"
+PNG_FILE = "image.png"
+
+# 終わったタイルの台帳と、描画中の画像 (ディスク上の memmap)
+class TileLedger:
+	def __init__(self, directory, job, shape, dtype):
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+		job_path = os.path.join(directory, JOB_FILE)
+		image_path = os.path.join(directory, IMAGE_FILE)
+		ledger_path = os.path.join(directory, LEDGER_FILE)
+		job = json.loads(json.dumps(job))	# 読み込んだ job.json と比べられるように JSON の値にそろえる
+
+		if os.path.exists(job_path):
+			with open(job_path) as f:
+				saved = json.load(f)
+			if saved != job:
+				raise ValueError(f"{directory} holds a different job ({saved}); use another directory")
+			self.done = self.read(ledger_path)
+		else:
+			image = np.lib.format.open_memmap(image_path, mode="w+", dtype=dtype, shape=shape)	# ヘッダーを書いて大きさを確保する
+			del image
+			if os.path.exists(ledger_path):
+				os.remove(ledger_path)
+			with open(job_path + ".tmp", "w") as f:
+				json.dump(job, f)
+			os.replace(job_path + ".tmp", job_path)	# job.json があれば画像ファイルもできている
+			self.done = set()
+		self.resumed = len(self.done)	# 起動したときに台帳にあったタイルの数
+		self.imagePath = image_path
+		self.offset = self.readHeader(image_path, shape, dtype)	# 画素の配列のファイル内の位置
+		self.shape = shape
+		self.dtype = np.dtype(dtype)
+		self.imageFile = os.open(image_path, os.O_RDWR)
+		self.file = open(ledger_path, "a")
+
+	# .npy のヘッダーを読み、形と型を確かめて配列の位置を返す
+	def readHeader(self, path, shape, dtype):
+		with open(path, "rb") as f:
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				header = np.lib.format.read_array_header_1_0(f)
+			else:
+				header = np.lib.format.read_array_header_2_0(f)
+			if header[0] != tuple(shape) or header[2] != np.dtype(dtype):
+				raise ValueError(f"{path}: expected {shape} {np.dtype(dtype)}, found {header[0]} {header[2]}")
+			return f.tell()
+
+	# 台帳を読む。書きかけの最後の行 (改行で終わらない行) は捨てて、ファイルからも切り詰める
+	def read(self, path):
+		if not os.path.exists(path):
+			return set()
+		with open(path, "rb+") as f:
+			data = f.read()
+			end = data.rfind(b"\n") + 1
+			if end < len(data):
+				f.truncate(end)
+		return {int(line) for line in data[:end].split()}
+
+	# タイルの色を画像ファイルの該当する行に書き込み、ディスクに書き出してから台帳に記録する
+	# 書き出すのはこのタイルの分だけなので、1タイルの時間は画像の大きさによらない
+	def record(self, tile, rows, cols, colors):
+		colors = np.ascontiguousarray(colors, dtype=self.dtype)
+		rowBytes = self.shape[1] * 3 * self.dtype.itemsize
+		start = self.offset + cols[0] * 3 * self.dtype.itemsize
+		for k, row in enumerate(range(rows[0], rows[1])):
+			os.pwrite(self.imageFile, colors[k].tobytes(), start + row * rowBytes)
+		g_Sync(self.imageFile)
+		self.file.write(f"{tile}\n")
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.done.add(tile)
+
+	# 画像 (読み取り専用の memmap)
+	def getImage(self):
+		return np.load(self.imagePath, mmap_mode="r")
+
+	def close(self):
+		self.file.close()
+		os.close(self.imageFile)
+
+# JSON のメッセージを送る
+def sendMessage(connection, **message):
+	connection.send_bytes(json.dumps(message).encode("utf-8"))
+
+# JSON のメッセージを受け取る (長すぎるメッセージは OSError)
+def receiveMessage(connection):
+	return json.loads(connection.recv_bytes(g_MaxMessage))
+
+# host がループバックのアドレス (このマシンの中だけ) か
+def isLoopback(host):
+	try:
+		return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+	except (OSError, ValueError):
+		return False
+
+# タイルを配り、結果を台帳に記録するコーディネーター
+class Coordinator:
+	def __init__(self, name, directory, halfWidth, halfHeight, antiAliasing=None, tileSize=None, log=sys.stderr):
+		tracer, self.scene = raytracer_bench.loadCase(name)
+		if antiAliasing is None:
+			antiAliasing = bool(getattr(tracer, "g_AntiAliasing", False))
+		self.halfWidth = halfWidth
+		self.halfHeight = halfHeight
+		self.antiAliasing = antiAliasing
+		self.tileSize = tileSize or g_TileSize
+		self.log = log
+
+		shape = (2 * halfHeight + 1, 2 * halfWidth + 1, 3)
+		self.tiles = raytracer_parallel.getTiles(shape[1], shape[0], self.tileSize)
+		self.job = {"scene": name, "halfWidth": halfWidth, "halfHeight": halfHeight, "antiAliasing": antiAliasing,
+			"tileSize": self.tileSize, "sceneKey": raytracer_cache.getSceneKey(self.scene, halfWidth, halfHeight, antiAliasing)}
+		self.ledger = TileLedger(directory, self.job, shape, self.scene.dtype)
+
+		self.lock = threading.Lock()	# 以下の状態と台帳を守る
+		self.pending = collections.deque(i for i in range(len(self.tiles)) if i not in self.ledger.done)	# まだ配っていないタイル
+		self.assigned = {}	# 描画中のタイル -> {ワーカー名: 渡した時刻}
+		self.tileTimes = []	# 終わったタイルの描画時間 [秒]
+		self.workerTiles = collections.Counter()	# ワーカー名 -> 結果を使ったタイルの数
+		self.requeued = 0	# 接続が切れたワーカーから待ち行列に戻したタイルの数
+		self.reassigned = 0	# 遅いワーカーのタイルを別のワーカーにも渡した回数
+		self.duplicates = 0	# 先に別のワーカーが終えていたので捨てた結果の数
+		self.connections = 0	# つながっているワーカーの数
+		self.finished = threading.Event()
+		if not self.pending:
+			self.finished.set()
+
+	# タイルを別のワーカーにも渡すまでの時間 [秒]
+	def getTimeout(self):
+		if not self.tileTimes:
+			return g_MinTimeout
+		return max(g_MinTimeout, g_SlowFactor * float(np.median(self.tileTimes)))
+
+	# ワーカー worker に渡すタイルの番号 (なければ None)
+	# 待ち行列が空なら、他のワーカーが長く抱えているタイルを渡す
+	def nextTile(self, worker):
+		with self.lock:
+			now = time.perf_counter()
+			if self.pending:
+				tile = self.pending.popleft()
+			else:
+				timeout = self.getTimeout()
+				late = [(min(owners.values()), tile) for tile, owners in self.assigned.items()
+					if worker not in owners and now - max(owners.values()) > timeout]
+				if not late:
+					return None
+				tile = min(late)[1]
+				self.reassigned += 1
+				print(f"Coordinator: tile {tile} is late, also giving it to {worker}", file=self.log)
+			self.assigned.setdefault(tile, {})[worker] = now
+			return tile
+
+	# タイルの結果を記録する。先に別のワーカーが終えていれば捨てる
+	def complete(self, worker, tile, colors, seconds):
+		with self.lock:
+			self.assigned.pop(tile, None)
+			if tile in self.ledger.done:
+				self.duplicates += 1
+				return
+			rows, cols = self.tiles[tile]
+			self.ledger.record(tile, rows, cols, colors)
+			self.tileTimes.append(seconds)
+			self.workerTiles[worker] += 1
+			if len(self.ledger.done) == len(self.tiles):
+				self.finished.set()
+
+	# 接続が切れたワーカーが抱えていたタイルを待ち行列の先頭に戻す
+	def release(self, worker):
+		with self.lock:
+			for tile, owners in list(self.assigned.items()):
+				owners.pop(worker, None)
+				if not owners:
+					del self.assigned[tile]
+					self.pending.appendleft(tile)
+					self.requeued += 1
+
+	# 1つのワーカーとの通信 (接続ごとのスレッドで実行される)
+	def handle(self, connection):
+		worker = None
+		with self.lock:
+			self.connections += 1
+		try:
+			hello = receiveMessage(connection)
+			worker = f"{hello['host']}:{hello['pid']}"	# ホスト名:pid
+			print(f"Coordinator: worker {worker} connected", file=self.log)
+			sendMessage(connection, type="job", precision=str(self.scene.dtype), **self.job)
+			while True:
+				message = receiveMessage(connection)
+				if message["type"] == "error":
+					print(f"Coordinator: worker {worker} gave up: {message['message']}", file=self.log)
+					break
+				if message["type"] == "result":
+					tile = int(message["tile"])
+					if not 0 <= tile < len(self.tiles):
+						raise ValueError(f"no tile {tile}")
+					rows, cols = self.tiles[tile]
+					shape = (rows[1] - rows[0], cols[1] - cols[0], 3)
+					data = connection.recv_bytes(int(np.prod(shape)) * self.scene.dtype.itemsize)
+					colors = np.frombuffer(data, dtype=self.scene.dtype).reshape(shape)
+					self.complete(worker, tile, colors, float(message["seconds"]))
+				tile = self.nextTile(worker)
+				if tile is not None:
+					rows, cols = self.tiles[tile]
+					sendMessage(connection, type="tile", tile=tile, rows=rows, cols=cols)
+				elif self.finished.is_set():
+					sendMessage(connection, type="done")
+					break
+				else:
+					sendMessage(connection, type="wait", seconds=g_WaitSeconds)
+		except (EOFError, OSError):
+			if worker is not None and not self.finished.is_set():
+				print(f"Coordinator: lost worker {worker}", file=self.log)
+		except (ValueError, KeyError, TypeError) as e:
+			print(f"Coordinator: dropped worker {worker} after a bad message ({type(e).__name__}: {e})", file=self.log)
+		finally:
+			if worker is not None:
+				self.release(worker)
+			connection.close()
+			with self.lock:
+				self.connections -= 1
+
+	# 接続を受け付ける (別スレッドで実行される)
+	def accept(self, listener):
+		while not self.finished.is_set():
+			try:
+				connection = listener.accept()
+			except AuthenticationError:
+				print("Coordinator: rejected a connection with a wrong key", file=self.log)
+				continue
+			except OSError:
+				return	# listener が閉じられた
+			threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+	# 全てのタイルが終わるまでワーカーにタイルを配り、画像を PNG に保存して返す
+	def run(self, host=None, port=None):
+		start = time.perf_counter()
+		if self.ledger.resumed:
+			print(f"Coordinator: resuming, {self.ledger.resumed} of {len(self.tiles)} tiles in the ledger", file=self.log)
+		host = host or g_Host
+		if not self.finished.is_set():
+			if g_AuthKey == DEFAULT_KEY and not isLoopback(host):
+				raise ValueError(f"set RAYTRACER_CLUSTER_KEY on every machine before listening on {host}")
+			listener = Listener((host, g_Port if port is None else port), authkey=g_AuthKey)
+			print(f"Coordinator: {len(self.pending)} tiles on {listener.address}", file=self.log)
+			threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+			self.finished.wait()
+			# 待たせていたワーカーや、別のワーカーが先に終えたタイルを描画中のワーカーに done を伝える
+			deadline = time.perf_counter() + g_DrainSeconds
+			while self.connections > 0 and time.perf_counter() < deadline:
+				time.sleep(0.05)
+			listener.close()
+		self.elapsed = time.perf_counter() - start
+		self.ledger.close()
+		image = self.ledger.getImage()
+		raytracer_image.savePNG(os.path.join(self.ledger.directory, PNG_FILE), image)
+		return image
+
+	def getReportText(self):
+		workers = ", ".join(f"{worker} {count}" for worker, count in sorted(self.workerTiles.items()))
+		return (f"Coordinator: {len(self.tiles)} tiles ({self.ledger.resumed} from the ledger) in {self.elapsed:.2f} s, "
+			f"{self.requeued} requeued from lost workers, {self.reassigned} given to a second worker, "
+			f"{self.duplicates} duplicate results dropped\n  tiles per worker: {workers or 'none'}")
+
+# ワーカーの本体: コーディネーターにつなぎ、タイルを描画して返す。全てのタイルが終わったら戻る
+# コーディネーターとの接続が切れたら (起動し直すのを待って) つなぎ直す
+# delay: タイルごとに待つ時間 [秒] (遅いワーカーの代わり)、failAfter: このタイル数を描画したら異常終了する (落ちるワーカーの代わり)
+def runWorker(address, delay=0.0, failAfter=None, log=sys.stderr):
+	rendered = 0
+	deadline = time.perf_counter() + g_RetrySeconds
+	while True:
+		try:
+			connection = Client(address, authkey=g_AuthKey)
+		except (ConnectionRefusedError, ConnectionResetError, FileNotFoundError):
+			if time.perf_counter() > deadline:
+				print(f"Worker {os.getpid()}: no coordinator at {address}", file=log)
+				return rendered
+			time.sleep(0.5)
+			continue
+
+		try:
+			sendMessage(connection, type="hello", host=socket.gethostname(), pid=os.getpid())
+			job = receiveMessage(connection)
+			halfWidth, halfHeight, antiAliasing = job["halfWidth"], job["halfHeight"], job["antiAliasing"]
+			# シーンはスクリプトかシーンファイルから自分で作る (読み込めるのは week7 / week8 のスクリプトとシーンファイルだけ)
+			try:
+				scene = raytracer_service.loadRequestScene(job["scene"])
+				if scene.dtype != np.dtype(job["precision"]):
+					scene.setPrecision(job["precision"])
+				if raytracer_cache.getSceneKey(scene, halfWidth, halfHeight, antiAliasing) != job["sceneKey"]:
+					raise ValueError(f"{job['scene']} differs from the coordinator's scene (another checkout?)")
+			except ValueError as e:
+				print(f"Worker {os.getpid()}: {e}", file=log)
+				sendMessage(connection, type="error", message=str(e))
+				connection.close()
+				return rendered
+			sendMessage(connection, type="ready")
+			while True:
+				message = receiveMessage(connection)
+				if message["type"] == "done":
+					connection.close()
+					return rendered
+				if message["type"] == "wait":
+					time.sleep(message["seconds"])
+					sendMessage(connection, type="ready")
+					continue
+				if failAfter is not None and rendered >= failAfter:
+					os._exit(1)
+				start = time.perf_counter()
+				colors = raytracer.renderRegion(scene, halfWidth, halfHeight, antiAliasing, message["rows"], message["cols"])
+				time.sleep(delay)
+				sendMessage(connection, type="result", tile=message["tile"], seconds=time.perf_counter() - start)
+				connection.send_bytes(np.ascontiguousarray(colors, dtype=scene.dtype).tobytes())
+				rendered += 1
+		except (EOFError, OSError):
+			print(f"Worker {os.getpid()}: lost the coordinator, reconnecting", file=log)
+			connection.close()
+			deadline = time.perf_counter() + g_RetrySeconds
+
+# "host:port" を (host, port) にする
+def parseAddress(text):
+	host, _, port = text.rpartition(":")
+	return host or g_Host, int(port)
+
+# このスクリプトのワーカーを別のプロセスで起動する
+def startWorkerProcess(address, delay=0.0, failAfter=None):
+	command = [sys.executable, os.path.abspath(__file__), "worker", f"{address[0]}:{address[1]}", "--delay", str(delay)]
+	if failAfter is not None:
+		command += ["--fail-after", str(failAfter)]
+	return subprocess.Popen(command)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="render a week7 / week8 scene in tiles on workers over TCP")
+	commands = parser.add_subparsers(dest="command", required=True)
+	for command in ["coordinator", "local"]:
+		sub = commands.add_parser(command)
+		sub.add_argument("scene", help="script name or scene file (.json / .rtscene)")
+		sub.add_argument("output", help="output directory (an unfinished job in it is resumed)")
+		sub.add_argument("--size", type=int, default=1000, help="half width of the screen")
+		sub.add_argument("--height", type=int, default=None, help="half height of the screen (default: --size)")
+		sub.add_argument("--aa", choices=["on", "off"], help="3x3 supersampling (default: the script's g_AntiAliasing)")
+		sub.add_argument("--tile", type=int, default=g_TileSize, help="tile size in pixels")
+		sub.add_argument("--host", default=g_Host, help="address to listen on")
+		sub.add_argument("--port", type=int, default=g_Port)
+	local = commands.choices["local"]
+	local.add_argument("--workers", type=int, default=raytracer_parallel.g_Workers, help="worker processes on this machine")
+	local.add_argument("--slow", type=int, default=0, help="how many of the workers sleep --delay seconds per tile")
+	local.add_argument("--delay", type=float, default=3.0)
+	local.add_argument("--crash", type=int, default=0, help="how many of the workers exit after 2 tiles")
+	local.add_argument("--verify", action="store_true", help="compare with a single-process render")
+	worker = commands.add_parser("worker")
+	worker.add_argument("address", help="coordinator host:port")
+	worker.add_argument("--processes", type=int, default=1, help="worker processes to start on this machine")
+	worker.add_argument("--delay", type=float, default=0.0, help="seconds to sleep per tile (to test slow workers)")
+	worker.add_argument("--fail-after", type=int, default=None, help="exit after this many tiles (to test lost workers)")
+	args = parser.parse_args(argv)
+
+	if args.command == "worker":
+		address = parseAddress(args.address)
+		children = [startWorkerProcess(address, args.delay, args.fail_after) for _ in range(args.processes - 1)]
+		rendered = runWorker(address, args.delay, args.fail_after)
+		print(f"Worker {os.getpid()}: {rendered} tiles", file=sys.stderr)
+		for child in children:
+			child.wait()
+		return
+
+	if g_AuthKey == DEFAULT_KEY and not isLoopback(args.host):
+		# 既定の鍵は誰でも知っているので、他のマシンから接続できるアドレスでは使わない
+		parser.error(f"set RAYTRACER_CLUSTER_KEY on every machine before listening on {args.host}")
+	antiAliasing = None if args.aa is None else args.aa == "on"
+	halfHeight = args.height or args.size
+	coordinator = Coordinator(args.scene, args.output, args.size, halfHeight, antiAliasing, args.tile)
+	children = []
+	if args.command == "local":
+		address = (args.host, args.port)
+		for k in range(args.workers):
+			if k < args.crash:
+				children.append(startWorkerProcess(address, failAfter=2))
+			else:
+				children.append(startWorkerProcess(address, args.delay if k >= args.workers - args.slow else 0.0))
+	image = coordinator.run(args.host, args.port)
+	print(coordinator.getReportText(), file=sys.stderr)
+	for child in children:
+		try:
+			child.wait(timeout=1.0)
+		except subprocess.TimeoutExpired:
+			child.terminate()	# まだ描画中の遅いワーカー
+	print(f"saved {os.path.join(args.output, PNG_FILE)}", file=sys.stderr)
+
+	if args.command == "local" and args.verify:
+		reference = raytracer.renderFrame(coordinator.scene, args.size, halfHeight, coordinator.antiAliasing)
+		print(f"bit-identical to a single-process render: {np.array_equal(reference, image)}", file=sys.stderr)
+
+# 使い方:
+#   export RAYTRACER_CLUSTER_KEY=...                                                         全てのマシンで同じ鍵を設定する
+#   python raytracer_cluster.py coordinator week8_task4 still/ --size 2000 --host 0.0.0.0     タイルを配る
+#   python raytracer_cluster.py worker coordinator-host:8766 --processes 8                     各マシンで描画する
+#   python raytracer_cluster.py local week8_task4 still/ --workers 4 --slow 1 --crash 1 --verify
+#       このマシンのワーカープロセスだけで試す (遅いワーカー・落ちるワーカーを混ぜられる)
+# 途中で止めたコーディネーターは同じ出力先で起動し直すと台帳の続きから描画する
+if __name__ == "__main__":
+	main(sys.argv[1:])
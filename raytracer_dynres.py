@@ -0,0 +1,80 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 描画時間を目標のフレーム時間に保つための解像度の自動調整
+# 毎回の描画時間を測り、1画素あたりの時間から目標に収まる解像度の倍率 (scale) を求める
+# 縮小した解像度では画素を大きくして画面全体の範囲を描くので、表示するときは 1/scale 倍に拡大する
+
+class ResolutionScaler:
+	def __init__(self, targetTime=1.0 / 30.0, minScale=0.1, maxScale=1.0, smoothing=0.5, tolerance=0.05):
+		self.targetTime = targetTime	# 目標のフレーム時間 [秒]
+		self.minScale = minScale	# 解像度の倍率の下限
+		self.maxScale = maxScale	# 解像度の倍率の上限 (1.0 ならウィンドウと同じ解像度まで)
+		self.smoothing = smoothing	# 1画素あたりの時間の指数移動平均の重み (前の値の重み)
+		self.tolerance = tolerance	# 倍率をこの割合より小さくしか変えないときは変えない (解像度のちらつきを防ぐ)
+		self.scale = maxScale	# 次のフレームの解像度の倍率
+		self.pixelTime = None	# 1画素あたりの描画時間 [秒] の平均
+		self.lastTime = 0.0	# 直前のフレームの描画時間 [秒]
+		self.lastScale = maxScale	# 直前のフレームの実際の倍率
+		self.lastSize = (0, 0)	# 直前のフレームの画像の (幅, 高さ)
+		self.frames = 0
+
+	# 画面 (halfWidth, halfHeight) を今の倍率で描くときの (halfWidth, halfHeight, 画素の大きさ)
+	# 画素は正方形のまま、幅が整数の画素数になるように倍率を丸める
+	def getRenderSize(self, halfWidth, halfHeight):
+		width = max(1, int(round(halfWidth * self.scale)))
+		pixelSize = halfWidth / width if halfWidth > 0 else 1.0
+		height = max(1, int(round(halfHeight / pixelSize)))
+		return width, height, pixelSize
+
+	# 描画時間 seconds (描画した画素数 pixels) から次のフレームの倍率を決める
+	# fullPixels: 倍率 1.0 のときの画素数
+	def update(self, seconds, pixels, fullPixels):
+		self.lastTime = seconds
+		self.frames += 1
+		pixelTime = seconds / max(pixels, 1)
+		if self.pixelTime is None:
+			self.pixelTime = pixelTime
+		else:
+			self.pixelTime = self.smoothing * self.pixelTime + (1.0 - self.smoothing) * pixelTime
+
+		# 描画時間は画素数 (倍率の2乗) に比例するとみなす
+		scale = np.sqrt(self.targetTime / (self.pixelTime * max(fullPixels, 1)))
+		scale = float(np.clip(scale, self.minScale, self.maxScale))
+		if abs(scale / self.scale - 1.0) > self.tolerance or scale in (self.minScale, self.maxScale):
+			self.scale = scale
+		return self.scale
+
+	# 今の倍率で画面全体を描画し、(画像, 画素の大きさ) を返す。描画時間を測って倍率を更新する
+	def render(self, scene, halfWidth, halfHeight, antiAliasing=False):
+		width, height, pixelSize = self.getRenderSize(halfWidth, halfHeight)
+		start = time.perf_counter()
+		image = raytracer.renderFrame(scene, width, height, antiAliasing, pixelSize)
+		seconds = time.perf_counter() - start
+
+		self.lastScale = 1.0 / pixelSize
+		self.lastSize = (image.shape[1], image.shape[0])
+		self.update(seconds, image.shape[0] * image.shape[1], (2 * halfWidth + 1) * (2 * halfHeight + 1))
+		return image, pixelSize
+
+	# 直前のフレームの倍率と描画時間を1行の文字列にする
+	def getReportText(self):
+		return (f"DynamicResolution: {self.lastSize[0]}x{self.lastSize[1]} (scale {self.lastScale:.2f}), "
+			f"{self.lastTime * 1000:.1f} ms / target {self.targetTime * 1000:.1f} ms, next scale {self.scale:.2f}")
+
+# 使い方: python raytracer_dynres.py [スクリプト名 [目標のフレーム時間 ms [halfWidth]]]
+# 同じシーンを繰り返し描画し、倍率が目標のフレーム時間に収まるところへ落ち着く様子を表示する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_advanced1"
+	targetTime = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 1.0 / 30.0
+	halfWidth = int(sys.argv[3]) if len(sys.argv) > 3 else 400
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	antiAliasing = getattr(tracer, "g_AntiAliasing", False)
+
+	scaler = ResolutionScaler(targetTime)
+	for _ in range(10):
+		scaler.render(scene, halfWidth, halfWidth, antiAliasing)
+		print(scaler.getReportText())
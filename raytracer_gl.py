@@ -0,0 +1,146 @@
+import numpy as np
+from OpenGL.GLUT import *
+from OpenGL.GL import *
+import raytracer
+import raytracer_progressive
+import raytracer_cache
+import raytracer_dynres
+import raytracer_worker
+
+# レイトレーサーの計算結果を OpenGL のウィンドウに表示する処理
+
+g_PixelType = np.float32	# 転送するフレームバッファの型 (np.float32 または np.uint8)
+g_SliceBudget = 0.03	# 段階的描画で idle 1回あたりに使う計算時間 [秒]
+g_ProgressiveRender = None	# 計算中の段階的描画 (raytracer_progressive.ProgressiveRender)
+g_BackgroundWorker = True	# True: 段階的描画を別スレッド (raytracer_worker) で計算する, False: idle コールバックで少しずつ計算する
+g_PresentInterval = 16	# 別スレッドの描画の途中経過を確かめて表示し直す間隔 [ms]
+g_RenderWorker = None	# 別スレッドの描画 (最初に使うときに作る)
+g_PresentedVersion = -1	# 最後に表示した途中経過の画像の version
+g_TimerActive = False	# 途中経過を確かめるタイマーが動いているか
+g_ResolutionScaler = raytracer_dynres.ResolutionScaler()	# 解像度の自動調整 (倍率と描画時間は描画をまたいで持つ)
+
+# 画素の型と OpenGL の型の対応
+GL_PIXEL_TYPES = {
+	np.dtype(np.float32): GL_FLOAT,
+	np.dtype(np.uint8): GL_UNSIGNED_BYTE,
+}
+
+# 画像 (2*halfHeight+1, 2*halfWidth+1, 3) を glDrawPixels 一回でウィンドウに転送する
+# 画像の左下の画素がスクリーン座標 (-halfWidth, -halfHeight) に来るように置く
+# zoom: 画像を拡大して表示する倍率 (縮小した解像度で描いた画像をウィンドウの大きさに戻す)
+def presentFrame(image, halfWidth, halfHeight, pixelType=None, zoom=1.0):
+	framebuffer = raytracer.toFramebuffer(image, pixelType or g_PixelType)
+	height, width = framebuffer.shape[:2]
+
+	# スクリーン座標の原点はウィンドウの中央にある
+	# glWindowPos はウィンドウの外を指しても有効なので、小さいウィンドウでもはみ出した部分だけが切り取られる
+	viewport = glGetIntegerv(GL_VIEWPORT)
+	left = int(round(0.5 - (halfWidth + 0.5) * zoom))
+	bottom = int(round(0.5 - (halfHeight + 0.5) * zoom))
+	glWindowPos2i(int(viewport[2]) // 2 + left, int(viewport[3]) // 2 + bottom)
+
+	glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+	glPixelZoom(zoom, zoom)
+	glDrawPixels(width, height, GL_RGB, GL_PIXEL_TYPES[framebuffer.dtype], framebuffer)
+	glPixelZoom(1.0, 1.0)
+
+# 描画時間が targetTime に収まる解像度で画面全体を描画し、ウィンドウの大きさに拡大して表示する
+# 倍率は毎回の描画時間から決め直す (raytracer_gl.g_ResolutionScaler.scale で参照できる)
+def displayDynamic(scene, halfWidth, halfHeight, targetTime, antiAliasing=False):
+	g_ResolutionScaler.targetTime = targetTime
+	image, pixelSize = g_ResolutionScaler.render(scene, halfWidth, halfHeight, antiAliasing)
+	height, width = image.shape[:2]
+	presentFrame(image, (width - 1) // 2, (height - 1) // 2, zoom=pixelSize)
+	print(g_ResolutionScaler.getReportText())
+	if scene.stats is not None:
+		print(scene.stats.getReportText())
+
+# 別スレッドの描画を返す
+def getRenderWorker():
+	global g_RenderWorker
+
+	if g_RenderWorker is None:
+		g_RenderWorker = raytracer_worker.RenderWorker()
+	return g_RenderWorker
+
+# 段階的描画を始める。計算は別スレッドか idle コールバックで少しずつ進める
+# adaptive, tileRenderer: 最後のアンチエイリアシングの段階の計算方法 (raytracer_progressive.ProgressiveRender)
+def startProgressive(scene, halfWidth, halfHeight, antiAliasing=False, adaptive=None, tileRenderer=None):
+	global g_ProgressiveRender
+
+	if g_BackgroundWorker:
+		g_ProgressiveRender = getRenderWorker().submit(scene, halfWidth, halfHeight, antiAliasing, adaptive, tileRenderer)
+		startPresentTimer()
+		return
+	g_ProgressiveRender = raytracer_progressive.ProgressiveRender(scene, halfWidth, halfHeight, antiAliasing,
+		adaptive=adaptive, tileRenderer=tileRenderer)
+	glutIdleFunc(idleProgressive)
+
+# 計算中の段階的描画を取りやめる (キー入力でシーンが変わったときなど)
+# 別スレッドの計算は次のスライスの区切りで止まる。次の display() で最初からやり直す
+def cancelProgressive():
+	global g_ProgressiveRender
+
+	g_ProgressiveRender = None
+	glutIdleFunc(None)
+	if g_RenderWorker is not None:
+		g_RenderWorker.cancel()
+
+# 途中経過を確かめるタイマーを動かす (GLUT の関数はメインスレッドからしか呼べないので、別スレッドは version を増やすだけ)
+def startPresentTimer():
+	global g_TimerActive
+
+	if not g_TimerActive:
+		g_TimerActive = True
+		glutTimerFunc(g_PresentInterval, pollWorker, 0)
+
+# タイマー: 途中経過の画像が更新されていれば再描画する。計算が終わって表示し終えたら止める
+def pollWorker(value):
+	global g_TimerActive
+
+	worker = g_RenderWorker
+	changed = worker.version != g_PresentedVersion
+	if changed:
+		glutPostRedisplay()
+	if changed or worker.busy or worker.pending is not None:
+		glutTimerFunc(g_PresentInterval, pollWorker, 0)
+	else:
+		g_TimerActive = False
+
+# idle コールバック: 時間の予算の分だけ計算を進めて再描画する
+def idleProgressive():
+	render = g_ProgressiveRender
+	if render is None:
+		glutIdleFunc(None)
+		return
+
+	render.step(g_SliceBudget)
+	if render.done:
+		glutIdleFunc(None)	# 計算が終わったら idle を止める
+		print(f"Progressive: {render.width}x{render.height} done in {render.elapsed * 1000:.0f} ms")
+		if render.scene.stats is not None:
+			print(render.scene.stats.getReportText())
+		raytracer_cache.putFrame(render.scene, render.halfWidth, render.halfHeight, render.image, render.antiAliasing,
+			render.mode)
+	glutPostRedisplay()
+
+# 段階的描画の途中経過を表示する。まだ始まっていなければ getScene() のシーンで始める
+# 同じシーンを描画したことがあれば、計算せずに覚えておいた画像を表示する
+# 別スレッドで計算するときは、display() は最新の途中経過の画像を表示するだけで計算はしない
+def displayProgressive(getScene, halfWidth, halfHeight, antiAliasing=False, adaptive=None, tileRenderer=None):
+	global g_PresentedVersion
+
+	if g_ProgressiveRender is None:
+		scene = getScene()
+		startProgressive(scene, halfWidth, halfHeight, antiAliasing, adaptive, tileRenderer)
+		if not g_BackgroundWorker:
+			image = raytracer_cache.getFrame(scene, halfWidth, halfHeight, antiAliasing, g_ProgressiveRender.mode)
+			if image is not None:
+				g_ProgressiveRender.useImage(image)
+				glutIdleFunc(None)
+
+	if g_BackgroundWorker:
+		image, g_PresentedVersion = g_RenderWorker.getImage()
+		presentFrame(image, halfWidth, halfHeight)
+		return
+	presentFrame(g_ProgressiveRender.image, halfWidth, halfHeight)
@@ -0,0 +1,85 @@
+import zlib
+import struct
+import numpy as np
+
+# 描画結果の画像ファイルへの書き出し
+# 画像は raytracer の並び (行 0 が画面の下端, 値は 0.0 ～ 1.0 の RGB) で受け取る
+
+# 画像を 8bit の RGB に変換し、上の行から並べる (画像ファイルの向き)
+def toRGB8(image):
+	image = np.asarray(image)
+	if image.dtype != np.uint8:
+		image = (np.clip(image, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+	return np.ascontiguousarray(image[::-1])
+
+# PNG のチャンク (長さ, 種類, データ, CRC)
+def makeChunk(kind, data):
+	return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+# PNG のファイルの先頭 (シグネチャと IHDR チャンク)
+def makeHeader(width, height):
+	return b"\x89PNG\r\n\x1a\n" + makeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+# 8bit の RGB (H, W, 3) を PNG の行の並びにする (各行の先頭はフィルタの種類 0: なし)
+def getScanlines(rgb):
+	height = rgb.shape[0]
+	rows = np.empty((height, 1 + rgb.shape[1] * 3), dtype=np.uint8)
+	rows[:, 0] = 0
+	rows[:, 1:] = rgb.reshape(height, -1)
+	return rows.tobytes()
+
+# 画像 (H, W, 3) を PNG のバイト列にする (8bit RGB, フィルタなし)
+def encodePNG(image):
+	rgb = toRGB8(image)
+	height, width = rgb.shape[:2]
+	return (makeHeader(width, height)
+		+ makeChunk(b"IDAT", zlib.compress(getScanlines(rgb), 6))
+		+ makeChunk(b"IEND", b""))
+
+# 画像 (H, W, 3) を PNG ファイルに保存する
+def savePNG(path, image):
+	with open(path, "wb") as f:
+		f.write(encodePNG(image))
+
+# 画像を帯ごとに PNG ファイルに書き出す (画像全体をメモリに置かずに大きな画像を保存する)
+# 帯は raytracer の並び (行 0 が帯の下端) で、画像の上の帯から順に write() に渡す
+class PNGWriter:
+	def __init__(self, path, width, height):
+		self.path = path
+		self.width = width
+		self.height = height
+		self.rows = 0	# 書き込んだ行数
+		self.compressor = zlib.compressobj(6)
+		self.file = open(path, "wb")
+		self.file.write(makeHeader(width, height))
+
+	def write(self, band):
+		rgb = toRGB8(band)
+		if rgb.shape[1] != self.width or self.rows + rgb.shape[0] > self.height:
+			raise ValueError(f"band {rgb.shape} does not fit the {self.width}x{self.height} image")
+		data = self.compressor.compress(getScanlines(rgb))
+		if data:
+			self.file.write(makeChunk(b"IDAT", data))
+		self.rows += rgb.shape[0]
+
+	def close(self):
+		if self.rows != self.height:
+			raise ValueError(f"{self.path}: {self.rows} of {self.height} rows written")
+		self.file.write(makeChunk(b"IDAT", self.compressor.flush()))
+		self.file.write(makeChunk(b"IEND", b""))
+		self.file.close()
+
+# 0.0 ～ 1.0 の値の配列を疑似カラー (黒 → 青 → 赤 → 黄 → 白) の画像 (..., 3) にする
+HEATMAP_COLORS = np.array([
+	[0.0, 0.0, 0.0],
+	[0.1, 0.1, 0.8],
+	[0.9, 0.1, 0.1],
+	[1.0, 0.9, 0.1],
+	[1.0, 1.0, 1.0],
+])
+
+def getFalseColor(values):
+	x = np.clip(values, 0.0, 1.0) * (len(HEATMAP_COLORS) - 1)
+	i = np.minimum(np.floor(x).astype(np.int64), len(HEATMAP_COLORS) - 2)
+	f = (x - i)[..., np.newaxis]
+	return (1.0 - f) * HEATMAP_COLORS[i] + f * HEATMAP_COLORS[i + 1]
@@ -0,0 +1,121 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 複数の光源と物体ごとの材質 (必要なときだけ Scene.lights, Scene.materials に設定する)
+# 照明の計算は raytracer.shadePhong が光源ごとに行い、影のレイは全ての光源の分をまとめて1回で追跡する
+# どちらも None のときは各スクリプトと同じ平行光源1つ・共通の材質で計算する
+
+# 平行光源と点光源の一覧 (光源ごとの値を連続した配列で持つ)
+class LightList:
+	def __init__(self):
+		self.vectors = np.zeros((0, 3))	# 平行光源は光源方向 (単位ベクトル)、点光源は位置
+		self.isPoint = np.zeros(0, dtype=bool)	# 点光源か
+		self.intensities = np.zeros((0, 3))	# 光の強さ (RGB)
+		self.attenuation = np.zeros((0, 3))	# 点光源の減衰 1 / (定数 + 1次 * 距離 + 2次 * 距離^2) の係数
+
+	def __len__(self):
+		return len(self.isPoint)
+
+	# キャッシュのキー (raytracer_cache) に光源の内容を含める
+	def __repr__(self):
+		return (f"LightList({self.vectors.tolist()}, {self.isPoint.tolist()}, "
+			f"{self.intensities.tolist()}, {self.attenuation.tolist()})")
+
+	def add(self, vector, isPoint, intensity, attenuation):
+		self.vectors = np.vstack([self.vectors, np.asarray(vector, dtype=np.float64)])
+		self.isPoint = np.append(self.isPoint, isPoint)
+		self.intensities = np.vstack([self.intensities, np.broadcast_to(np.asarray(intensity, dtype=np.float64), 3)])
+		self.attenuation = np.vstack([self.attenuation, np.asarray(attenuation, dtype=np.float64)])
+		return len(self) - 1
+
+	# 平行光源を加える。direction は入射光の進行方向 (Scene の lightDirection と同じ向き)
+	def addDirectional(self, direction, intensity=1.0):
+		L = -np.asarray(direction, dtype=np.float64)
+		return self.add(L / np.sqrt(L.dot(L)), False, intensity, (1.0, 0.0, 0.0))
+
+	# 点光源を加える。attenuation は glLight の GL_*_ATTENUATION と同じ (定数, 1次, 2次) の係数
+	def addPoint(self, position, intensity=1.0, attenuation=(1.0, 0.0, 0.0)):
+		return self.add(position, True, intensity, attenuation)
+
+	# 交点 point (N, 3) から見た光源の一覧 (raytracer.getLights と同じ形)
+	def getLights(self, point):
+		lights = []
+		for vector, isPoint, intensity, (c, l, q) in zip(self.vectors, self.isPoint, self.intensities, self.attenuation):
+			vector = vector.astype(point.dtype)
+			intensity = intensity.astype(point.dtype)
+			if not isPoint:
+				lights.append((vector, intensity, None))
+				continue
+			offset = vector - point
+			distance = np.sqrt(raytracer.dot(offset, offset))
+			attenuation = 1.0 / (c + l * distance + q * distance * distance)
+			lights.append((offset / distance[..., np.newaxis], intensity * attenuation[..., np.newaxis], distance))
+		return lights
+
+# 材質の表 (材質の番号ごとの拡散・鏡面反射定数と鏡面反射の指数)
+# 球の材質は Scene.materialIds、床の材質は Scene.floorMaterial で番号を指定する
+class MaterialTable:
+	def __init__(self):
+		self.kd = np.zeros(0)	# 拡散反射定数
+		self.ks = np.zeros(0)	# 鏡面反射定数
+		self.shininess = np.zeros(0)	# 鏡面反射の指数
+
+	def __len__(self):
+		return len(self.kd)
+
+	def __repr__(self):
+		return f"MaterialTable({self.kd.tolist()}, {self.ks.tolist()}, {self.shininess.tolist()})"
+
+	# 材質を加えて番号を返す
+	def add(self, kd=0.8, ks=0.8, shininess=32):
+		self.kd = np.append(self.kd, kd)
+		self.ks = np.append(self.ks, ks)
+		self.shininess = np.append(self.shininess, shininess)
+		return len(self) - 1
+
+	# 材質の番号 (数か (N,) の配列) から raytracer.shadePhong に渡す (kd, ks, shininess) を返す
+	def lookup(self, ids):
+		if np.ndim(ids) == 0:
+			return self.kd[ids], self.ks[ids], self.shininess[ids]
+		return self.kd[ids][..., np.newaxis], self.ks[ids][..., np.newaxis], self.shininess[ids]
+
+# スクリプトのシーンと同じ照明 (lightDirection の平行光源1つ) の LightList と、
+# 球と床の材質 (床は鏡面反射なし) の MaterialTable を設定する
+def useLightList(scene):
+	scene.lights = LightList()
+	scene.lights.addDirectional(scene.lightDirection, scene.iin)
+	scene.materials = MaterialTable()
+	scene.materialIds = np.zeros(len(scene.radii), dtype=np.int64)
+	scene.materials.add(scene.kd, scene.ks, scene.shininess)
+	scene.floorMaterial = scene.materials.add(scene.kd, 0.0, scene.shininess)
+	return scene
+
+# 使い方: python raytracer_lights.py [スクリプト名 [halfWidth]]
+# 光源を 1, 2, 4, 8, 16 個に増やしながら描画し、描画時間と影のレイの数が光源の数に比例することを確かめる
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_advanced1"
+	halfWidth = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	scene.shadow = False	# 影のない1光源なら元のシーンと同じ結果になる
+	reference = raytracer.renderFrame(scene, halfWidth, halfWidth)
+	useLightList(scene)
+	print(f"{name}: single light without shadows identical: {np.array_equal(reference, raytracer.renderFrame(scene, halfWidth, halfWidth))}")
+
+	scene.shadow = True
+	rng = np.random.default_rng(0)
+	for count in [1, 2, 4, 8, 16]:
+		lights = LightList()
+		for i in range(count):
+			if i % 2 == 0:
+				lights.addDirectional(rng.uniform([-1.0, -1.0, -1.0], [1.0, -0.2, 1.0]), 1.0 / count)
+			else:
+				lights.addPoint(rng.uniform([-800.0, 200.0, -2500.0], [800.0, 800.0, -500.0]), 2.0 / count)
+		scene.lights = lights
+		raytracer.resetRayCounts()
+		start = time.perf_counter()
+		raytracer.renderFrame(scene, halfWidth, halfWidth)
+		seconds = time.perf_counter() - start
+		print(f"{count:2d} lights: {seconds * 1000:7.1f} ms, {raytracer.g_RayCounts['shadow']} shadow rays")
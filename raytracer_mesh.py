@@ -0,0 +1,195 @@
+import sys
+import time
+import hashlib
+import importlib
+import numpy as np
+import raytracer
+import raytracer_bvh
+import raytracer_image
+
+# 三角形メッシュ (week6 の課題が出力する OBJ ファイル) をレイトレーサーで描画する
+# 三角形は頂点 v0 と2辺 e1, e2 の配列で持ち、Möller–Trumbore 法でまとめて交差判定する
+# 三角形の BVH は raytracer_bvh.BVH と同じ木を使い、葉の交差判定だけを三角形用にする
+# シェーディングには頂点法線を重心座標で補間した法線を使う (Scene.mesh に設定する)
+
+g_LeafSize = 8	# 葉に入れる三角形の数 (三角形の交差判定は軽いので球より少し大きい葉にする)
+
+# OBJ ファイルを読み込み、(頂点 (V, 3), 面 (F, 3)) を返す
+# 面の頂点番号は 0 から始まるように直す。4頂点以上の面は扇形に三角形に分ける
+def loadOBJ(path):
+	vertices = []
+	faces = []
+	with open(path) as f:
+		for line in f:
+			parts = line.split()
+			if not parts:
+				continue
+			if parts[0] == "v":
+				vertices.append([float(a) for a in parts[1:4]])
+			elif parts[0] == "f":
+				# "f 1 2 3" と "f 1/1/1 2/2/2 3/3/3" の両方を読む (負の番号は後ろから数える)
+				index = [int(a.split("/")[0]) for a in parts[1:]]
+				index = [i - 1 if i > 0 else len(vertices) + i for i in index]
+				for k in range(1, len(index) - 1):
+					faces.append([index[0], index[k], index[k + 1]])
+	return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3)
+
+# week6 のスクリプトを実行して OBJ ファイルを作り、そのファイル名を返す
+def makeOBJ(name):
+	module = importlib.import_module(name)
+	module.setCoordinates()
+	module.exportOBJ()
+	return module.OUTPUT_FILENAME
+
+# 三角形 (v0, e1, e2) とレイ (p, v) の交点を Möller–Trumbore 法で求める
+# 引数はどれも (x, y, z) の成分ごとの配列の組で、配列は同じ形に放送できればよい
+# 戻り値は (t, u, w)。u, w は交点の重心座標 (交点 = v0 + u e1 + w e2)。交わらないレイは t = inf
+# 三角形の表裏は区別しない
+def intersectTriangles(v0, e1, e2, p, v):
+	# pvec = v x e2, tvec = p - v0, qvec = tvec x e1
+	px = v[1] * e2[2] - v[2] * e2[1]
+	py = v[2] * e2[0] - v[0] * e2[2]
+	pz = v[0] * e2[1] - v[1] * e2[0]
+	det = e1[0] * px + e1[1] * py + e1[2] * pz
+	tx, ty, tz = p[0] - v0[0], p[1] - v0[1], p[2] - v0[2]
+	qx = ty * e1[2] - tz * e1[1]
+	qy = tz * e1[0] - tx * e1[2]
+	qz = tx * e1[1] - ty * e1[0]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		inv = 1.0 / det
+		u = (tx * px + ty * py + tz * pz) * inv
+		w = (v[0] * qx + v[1] * qy + v[2] * qz) * inv
+		t = (e2[0] * qx + e2[1] * qy + e2[2] * qz) * inv
+	hit = (det != 0.0) & (u >= 0.0) & (w >= 0.0) & (u + w <= 1.0) & (t > 0.0)
+	return np.where(hit, t, np.inf), u, w
+
+# 三角形の BVH
+class TriangleBVH(raytracer_bvh.BVH):
+	def __init__(self, v0, e1, e2, leafSize=None):
+		start = time.perf_counter()
+		self.v0, self.e1, self.e2 = v0, e1, e2
+		corners = np.stack([v0, v0 + e1, v0 + e2], axis=1)
+		# 数値誤差で交点を取りこぼさないよう、境界箱をメッシュの大きさに対してわずかに広げる
+		margin = 1.0e-9 * max(float(np.abs(corners).max(initial=0.0)), 1.0)
+		self.build(corners.mean(axis=1), corners.min(axis=1) - margin, corners.max(axis=1) + margin, leafSize or g_LeafSize)
+		data = np.concatenate([v0, e1, e2], axis=1)[np.maximum(self.leafPrims, 0)]
+		self.leafData = np.where((self.leafPrims >= 0)[..., np.newaxis], data, 0.0).transpose(0, 2, 1).copy()
+		self.buildTime = time.perf_counter() - start
+
+	# 葉ごとの三角形の v0, e1, e2 の9成分は (葉, 9, 葉の大きさ) の連続した配列 leafData にまとめてある
+	# (三角形のない場所は det = 0 になり交わらない)
+	def intersectLeaf(self, leaves, p, v):
+		data = self.leafData[leaves]
+		p = p[:, 0, :, np.newaxis]
+		v = v[:, 0, :, np.newaxis]
+		v0, e1, e2 = data[:, 0:3].transpose(1, 0, 2), data[:, 3:6].transpose(1, 0, 2), data[:, 6:9].transpose(1, 0, 2)
+		return intersectTriangles(v0, e1, e2, p.transpose(1, 0, 2), v.transpose(1, 0, 2))[0]
+
+	def getReportText(self):
+		return (f"TriangleBVH: {self.primCount} triangles, {self.leafCount} leaves, "
+			f"depth {self.depth}, build {self.buildTime * 1000:.1f} ms")
+
+class Mesh:
+	def __init__(self, vertices, faces, color=(0.8, 0.8, 0.8), material=None, smooth=True, leafSize=None):
+		self.vertices = np.array(vertices, dtype=np.float64).reshape(-1, 3)	# 頂点の座標
+		self.faces = np.array(faces, dtype=np.int64).reshape(-1, 3)	# 面ごとの頂点番号
+		self.color = np.array(color, dtype=np.float64)	# メッシュの色
+		self.material = material	# 材質の番号 (Scene.materials の行)。None なら Scene の kd, ks, shininess
+		self.smooth = smooth	# True: 頂点法線を補間する, False: 面の法線を使う
+		self.leafSize = leafSize
+		self.update()
+
+	# キャッシュのキー (raytracer_cache) にメッシュの内容を含める
+	def __repr__(self):
+		return f"Mesh({len(self.vertices)}, {len(self.faces)}, {self.digest}, {self.color.tolist()}, {self.material}, {self.smooth})"
+
+	# 頂点を変えたあとに、三角形の辺・法線・BVH を作り直す
+	def update(self):
+		corners = self.vertices[self.faces]
+		self.v0 = corners[:, 0]
+		self.e1 = corners[:, 1] - self.v0
+		self.e2 = corners[:, 2] - self.v0
+		area_normals = np.cross(self.e1, self.e2)	# 長さが面積の2倍の面の法線
+		self.faceNormals = raytracer.normalize(area_normals)
+
+		# 同じ位置の頂点 (球の継ぎ目や極) をまとめ、面積で重み付けした面の法線の和を頂点法線にする
+		_, weld = np.unique(np.round(self.vertices, 9), axis=0, return_inverse=True)
+		weld = weld.reshape(-1)
+		sums = np.zeros((weld.max(initial=-1) + 1, 3))
+		for k in range(3):
+			np.add.at(sums, weld[self.faces[:, k]], area_normals)
+		self.vertexNormals = raytracer.normalize(sums[weld])
+
+		self.bvh = TriangleBVH(self.v0, self.e1, self.e2, self.leafSize)
+		self.digest = hashlib.sha1(self.vertices.tobytes() + self.faces.tobytes()).hexdigest()[:16]
+
+	# 頂点を (x, y, z) の順に軸を並べ替え・拡大・平行移動する
+	# up: 元のメッシュの上方向の軸 ("z" なら week6 の曲面 z = f(u, v) を y が上の向きに起こす)
+	# 境界箱の中心が center、最も長い辺が size になるように置く
+	def place(self, center, size, up="z"):
+		vertices = self.vertices
+		if up == "z":
+			vertices = np.column_stack([vertices[:, 0], vertices[:, 2], -vertices[:, 1]])
+		lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+		scale = size / max(float((hi - lo).max()), 1.0e-12)
+		self.vertices = (vertices - (lo + hi) / 2.0) * scale + np.asarray(center, dtype=np.float64)
+		self.update()
+		return self
+
+	# 最も近い三角形との交点 (t, 三角形の番号)。交わらないレイは t = inf, 番号 = -1
+	def intersect(self, p, v, tests=None):
+		return self.bvh.intersect(p, v, tests)
+
+	# レイがどれかの三角形に遮られるか
+	def occluded(self, p, v, tests=None, maxT=None):
+		return self.bvh.occluded(p, v, tests, maxT)
+
+	# 三角形 tri の上の点 point での法線 (頂点法線を重心座標で補間する)
+	def getNormals(self, tri, point):
+		if not self.smooth:
+			return self.faceNormals[tri]
+		e1, e2 = self.e1[tri], self.e2[tri]
+		d = point - self.v0[tri]
+		d00 = np.sum(e1 * e1, axis=-1)
+		d01 = np.sum(e1 * e2, axis=-1)
+		d11 = np.sum(e2 * e2, axis=-1)
+		d20 = np.sum(d * e1, axis=-1)
+		d21 = np.sum(d * e2, axis=-1)
+		denom = d00 * d11 - d01 * d01
+		u = ((d11 * d20 - d01 * d21) / denom)[..., np.newaxis]
+		w = ((d00 * d21 - d01 * d20) / denom)[..., np.newaxis]
+		n = self.vertexNormals[self.faces[tri]]
+		return raytracer.normalize((1.0 - u - w) * n[:, 0] + u * n[:, 1] + w * n[:, 2])
+
+# week6 の OBJ を床の上に置いたシーン
+def makeMeshScene(path, size=600.0, color=(0.3, 0.6, 0.9), **kwargs):
+	mesh = Mesh(*loadOBJ(path), color=color)
+	mesh.place((0.0, -150.0 + size / 4.0, -1500.0), size)
+	settings = dict(boardY=-150, floorColors=((1.0, 1.0, 0.7), (0.6, 0.6, 0.6)), checkerSize=100, shadow=True)
+	settings.update(kwargs)
+	scene = raytracer.makeScene(np.zeros((0, 3)), np.zeros(0), np.zeros((0, 3)), **settings)
+	scene.mesh = mesh
+	return scene
+
+# 使い方: python raytracer_mesh.py [OBJ ファイルか week6 のスクリプト名 [出力 PNG [halfWidth]]]
+# week6 のスクリプト名を渡すと OBJ を作ってから読み込む。床の上に置いて影付きで描画する
+if __name__ == "__main__":
+	source = sys.argv[1] if len(sys.argv) > 1 else "week6_task5_ripple"
+	output = sys.argv[2] if len(sys.argv) > 2 else "mesh.png"
+	halfWidth = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+	path = source if source.endswith(".obj") else makeOBJ(source)
+
+	start = time.perf_counter()
+	scene = makeMeshScene(path)
+	print(f"{path}: {len(scene.mesh.vertices)} vertices, {len(scene.mesh.faces)} triangles, "
+		f"loaded in {(time.perf_counter() - start) * 1000:.0f} ms")
+	print(scene.mesh.bvh.getReportText())
+
+	raytracer.resetRayCounts()
+	start = time.perf_counter()
+	image = raytracer.renderFrame(scene, halfWidth, halfWidth)
+	seconds = time.perf_counter() - start
+	print(f"{image.shape[1]}x{image.shape[0]} in {seconds:.2f} s "
+		f"({raytracer.g_RayCounts['primary']} primary, {raytracer.g_RayCounts['shadow']} shadow rays)")
+	raytracer_image.savePNG(output, image)
+	print(f"saved {output}")
@@ -0,0 +1,172 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 一次レイのパケット追跡
+# 画面を packetSize x packetSize のブロック (パケット) に分け、ブロックのレイ全体を包む視錐台 (4枚の平面) と
+# 各球との判定をブロックごとに1回だけ行う。視錐台と重なる球についてだけ、個々のレイの交差判定をする
+# 一次レイは視点から出る向きがそろっているので、球の少ない画面の大部分のブロックは判定なしで済む
+
+g_PacketSize = 8	# ブロックの一辺の画素数 (8 か 16)
+g_SphereChunk = 1024	# 一度に視錐台と判定する球の数 (ブロック x 球 の表の大きさを抑える)
+
+# 視錐台を作るとき、ブロックの範囲に加える余白 [画素] (数値誤差で境界の球を落とさないように)
+FRUSTUM_MARGIN = 0.25
+
+class PacketTracer:
+	def __init__(self, packetSize=None):
+		self.packetSize = packetSize or g_PacketSize
+		# 直前の呼び出しのパケットごとの統計
+		self.packetRays = np.zeros(0, dtype=np.int64)	# パケットのレイの数
+		self.packetCandidates = np.zeros(0, dtype=np.int64)	# 視錐台と重なった球の数
+		self.packetHits = np.zeros(0, dtype=np.int64)	# 球に当たったレイの数
+		self.resetStats()
+
+	# これまでの呼び出しの合計を 0 に戻す
+	def resetStats(self):
+		self.totals = {"calls": 0, "packets": 0, "rays": 0, "spheres": 0, "culled": 0,
+			"candidates": 0, "tests": 0, "bruteTests": 0, "hits": 0, "seconds": 0.0}
+
+	# キャッシュのキー (raytracer_cache) には結果に影響しないので含めない
+	def __repr__(self):
+		return f"PacketTracer({self.packetSize})"
+
+	# ブロックごとのスクリーン上の範囲 [x0, x1] x [y0, y1] を通るレイを包む4枚の平面 (ブロック, 4, 3)
+	# 平面は視点を通り、法線は内側を向く
+	def getFrustumPlanes(self, scene, x0, x1, y0, y1):
+		x0 = x0 - FRUSTUM_MARGIN
+		x1 = x1 + FRUSTUM_MARGIN
+		y0 = y0 - FRUSTUM_MARGIN
+		y1 = y1 + FRUSTUM_MARGIN
+		z = np.full_like(x0, -scene.distance)
+		corners = np.stack([
+			np.stack([x0, y0, z], axis=-1),
+			np.stack([x1, y0, z], axis=-1),
+			np.stack([x1, y1, z], axis=-1),
+			np.stack([x0, y1, z], axis=-1),
+		], axis=1)
+		corners = raytracer.getCameraRays(scene, corners)
+		planes = np.cross(corners, np.roll(corners, -1, axis=1))
+		planes /= np.linalg.norm(planes, axis=2, keepdims=True)
+
+		# ブロックの中心を通るレイが内側になる向きにそろえる
+		center = corners.mean(axis=1, keepdims=True)
+		planes *= np.where(np.sum(planes * center, axis=2, keepdims=True) < 0.0, -1.0, 1.0)
+		return planes
+
+	# スクリーン座標 xs, ys (rows, cols) を通る一次レイ rays (rows, cols, 3) と球との最も近い交点を求める
+	# 戻り値は raytracer.intersectSpheres と同じ (t, 球の番号)
+	def intersect(self, scene, xs, ys, rays):
+		start_time = time.perf_counter()
+		rows, cols = xs.shape
+		S = self.packetSize
+		pr = -(-rows // S)
+		pc = -(-cols // S)
+
+		# (pr*S, pc*S, ...) の配列を (ブロック, ブロック内のレイ, ...) に並べ替える
+		def split(a):
+			a = a.reshape((pr, S, pc, S) + a.shape[2:]).swapaxes(1, 2)
+			return a.reshape((pr * pc, S * S) + a.shape[4:])
+
+		# 端の画素を繰り返して大きさをそろえてから並べ替える
+		def toPackets(a):
+			return split(np.pad(a, [(0, pr * S - rows), (0, pc * S - cols)] + [(0, 0)] * (a.ndim - 2), mode="edge"))
+
+		# (ブロック, ブロック内のレイ) を元の (rows, cols) の並びに戻す
+		def fromPackets(a):
+			a = a.reshape(pr, pc, S, S).swapaxes(1, 2).reshape(pr * S, pc * S)
+			return a[:rows, :cols]
+
+		px = toPackets(xs)
+		py = toPackets(ys)
+		v = toPackets(rays)
+		p = scene.viewpoint
+		count = len(px)
+		planes = self.getFrustumPlanes(scene, px.min(axis=1), px.max(axis=1), py.min(axis=1), py.max(axis=1))
+
+		min_t = np.full(px.shape, np.inf, dtype=scene.dtype)
+		index = np.full(px.shape, -1, dtype=np.int64)
+		candidates = np.zeros(count, dtype=np.int64)
+
+		for start in range(0, len(scene.radii), g_SphereChunk):
+			centers = scene.centers[start:start + g_SphereChunk]
+			radii = scene.radii[start:start + g_SphereChunk]
+
+			# どれかの平面の外側に球全体があれば、そのブロックのレイはその球に当たらない
+			distance = np.einsum("bkj,nj->bnk", planes, centers - p)
+			overlap = np.all(distance >= -(radii * (1.0 + 1.0e-7))[np.newaxis, :, np.newaxis], axis=2)
+			candidates += overlap.sum(axis=1)
+
+			# 球の番号順に調べる (同じ t なら番号の小さい球になり、線形探索と同じ結果になる)
+			for j in range(len(radii)):
+				blocks = np.flatnonzero(overlap[:, j])
+				if len(blocks) == 0:
+					continue
+				t = raytracer.intersectSphere(centers[j], radii[j], p, v[blocks])
+				closer = (t > 0.0) & (t < min_t[blocks])
+				min_t[blocks] = np.where(closer, t, min_t[blocks])
+				index[blocks] = np.where(closer, start + j, index[blocks])
+
+		# 画素ごとの統計には、パケットの候補の球の数をそのパケットのレイの交差判定の回数として数える
+		if scene.stats is not None:
+			raytracer.countStats(scene, tests=fromPackets(np.repeat(candidates[:, np.newaxis], S * S, axis=1)))
+
+		# パケットごとの統計 (大きさをそろえるために増やしたレイは数えない)
+		valid = np.zeros((pr * S, pc * S), dtype=bool)
+		valid[:rows, :cols] = True
+		valid = split(valid)
+		self.packetRays = valid.sum(axis=1)
+		self.packetCandidates = candidates
+		self.packetHits = ((index >= 0) & valid).sum(axis=1)
+
+		totals = self.totals
+		totals["calls"] += 1
+		totals["packets"] += count
+		totals["rays"] += rows * cols
+		totals["spheres"] = len(scene.radii)
+		totals["culled"] += int(np.count_nonzero(candidates == 0))
+		totals["candidates"] += int(candidates.sum())
+		totals["tests"] += int((candidates * self.packetRays).sum())
+		totals["bruteTests"] += rows * cols * len(scene.radii)
+		totals["hits"] += int(self.packetHits.sum())
+		totals["seconds"] += time.perf_counter() - start_time
+		return fromPackets(min_t), fromPackets(index)
+
+	# 直前の呼び出しのパケットを、全て当たった / 一部当たった / 全く当たらなかった に分けて数える
+	def getPacketHitCounts(self):
+		full = int(np.count_nonzero(self.packetHits == self.packetRays))
+		empty = int(np.count_nonzero(self.packetHits == 0))
+		return {"full": full, "partial": len(self.packetHits) - full - empty, "empty": empty}
+
+	# 統計を1行の文字列にする
+	def getReportText(self):
+		t = self.totals
+		packets = max(t["packets"], 1)
+		h = self.getPacketHitCounts()
+		return (f"Packets {self.packetSize}x{self.packetSize}: {t['packets']} packets, {t['spheres']} spheres, "
+			f"{t['candidates'] / packets:.2f} candidates/packet, {t['culled']} culled, "
+			f"{t['tests']} of {t['bruteTests']} ray-sphere tests, "
+			f"last frame hit full/partial/none {h['full']}/{h['partial']}/{h['empty']}, "
+			f"{t['seconds'] * 1000:.1f} ms")
+
+# 使い方: python raytracer_packet.py [スクリプト名 [パケットの大きさ ...]]
+# パケット追跡の統計と、使わない場合との速度・結果の比較を表示する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_advanced1"
+	sizes = [int(a) for a in sys.argv[2:]] or [8, 16]
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	scene.packets = None
+	halfWidth, halfHeight = int(tracer.g_HalfWidth), int(tracer.g_HalfHeight)
+
+	start = time.perf_counter()
+	plain = raytracer.renderFrame(scene, halfWidth, halfHeight)
+	print(f"{name}: without packets {(time.perf_counter() - start) * 1000:.1f} ms")
+	for size in sizes:
+		scene.packets = PacketTracer(size)
+		start = time.perf_counter()
+		image = raytracer.renderFrame(scene, halfWidth, halfHeight)
+		elapsed = time.perf_counter() - start
+		print(f"  {size}x{size}: {elapsed * 1000:.1f} ms, identical: {np.array_equal(image, plain)}")
+		print("  " + scene.packets.getReportText())
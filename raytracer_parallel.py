@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import atexit
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import raytracer
+
+# 画面をタイルに分け、複数のプロセスで並列にレイトレーシングする
+# 各プロセスは共有メモリ上のフレームバッファに直接書き込むので、結果を集めるときにコピーは発生しない
+
+g_Workers = os.cpu_count() or 1	# ワーカープロセス数
+g_TileSize = 32	# タイルの一辺の画素数
+
+# 画面 (height 行, width 列) をタイルに分割する
+# 各タイルは ((開始行, 終了行), (開始列, 終了列)) で表す
+def getTiles(width, height, tileSize):
+	tiles = []
+	for row in range(0, height, tileSize):
+		for col in range(0, width, tileSize):
+			tiles.append(((row, min(row + tileSize, height)), (col, min(col + tileSize, width))))
+	return tiles
+
+# ワーカープロセス側で開いている共有メモリ (名前 -> SharedMemory)
+g_AttachedMemory = {}
+
+# 共有メモリ上のフレームバッファを配列として開く
+def attachFramebuffer(name, shape, dtype):
+	if name not in g_AttachedMemory:
+		g_AttachedMemory[name] = shared_memory.SharedMemory(name=name)
+	return np.ndarray(shape, dtype=dtype, buffer=g_AttachedMemory[name].buf)
+
+# 1つのタイルを描画して共有メモリに書き込む (ワーカープロセスで実行される)
+# scene が None のときは getPixelColor を1画素ずつ呼ぶ
+def renderTile(job):
+	name, shape, dtype, scene, getPixelColor, halfWidth, halfHeight, antiAliasing, (rows, cols) = job
+	if scene is not None:
+		colors = raytracer.renderRegion(scene, halfWidth, halfHeight, antiAliasing, rows, cols)
+	else:
+		colors = raytracer.renderReference(getPixelColor, halfWidth, halfHeight, antiAliasing, rows, cols)
+
+	framebuffer = attachFramebuffer(name, shape, dtype)
+	framebuffer[rows[0]:rows[1], cols[0]:cols[1]] = colors
+	return rows, cols
+
+# プロセスプールと共有メモリのフレームバッファを持ち、フレームをタイル単位で並列に描画する
+class TileRenderer:
+	def __init__(self, workers=None, tileSize=None):
+		self.workers = workers or g_Workers
+		self.tileSize = tileSize or g_TileSize
+		# ワーカーが共有メモリを勝手に後始末しないよう、リソーストラッカーをプールより先に起動して共有させる
+		resource_tracker.ensure_running()
+		self.pool = multiprocessing.Pool(self.workers)
+		self.memory = None	# フレームバッファの共有メモリ
+		self.shape = None	# フレームバッファの形 (H, W, 3)
+		self.dtype = None	# フレームバッファの型 (シーンの計算精度に合わせる)
+		self.lastTime = 0.0	# 直前のフレームの描画時間 [秒]
+		self.lock = threading.Lock()	# 描画中は持つ (段階的描画の別スレッドと共有メモリを取り合わないように)
+		atexit.register(self.close)
+
+	# 画像の大きさと型に合わせて共有メモリを確保し直す
+	def allocate(self, shape, dtype=np.float64):
+		dtype = np.dtype(dtype)
+		if self.shape == shape and self.dtype == dtype:
+			return
+		self.release()
+		size = int(np.prod(shape)) * dtype.itemsize
+		self.memory = shared_memory.SharedMemory(create=True, size=size)
+		self.shape = shape
+		self.dtype = dtype
+
+	# 画面全体を描画し、共有メモリ上の画像 (2*halfHeight+1, 2*halfWidth+1, 3) を返す
+	# 返す配列は次の render() の呼び出しまで有効
+	# rows: (開始行, 終了行) を渡すとその行だけを描画し、その行の画像の写しを返す
+	def render(self, scene, halfWidth, halfHeight, antiAliasing=False, getPixelColor=None, rows=None):
+		with self.lock:
+			return self.renderTiles(scene, halfWidth, halfHeight, antiAliasing, getPixelColor, rows)
+
+	def renderTiles(self, scene, halfWidth, halfHeight, antiAliasing, getPixelColor, rows):
+		start = time.perf_counter()
+		shape = (2 * halfHeight + 1, 2 * halfWidth + 1, 3)
+		self.allocate(shape, np.float64 if scene is None else scene.dtype)
+
+		band = rows or (0, shape[0])
+		tiles = [((r0 + band[0], r1 + band[0]), cols) for (r0, r1), cols in getTiles(shape[1], band[1] - band[0], self.tileSize)]
+		jobs = [(self.memory.name, shape, self.dtype, scene, getPixelColor, halfWidth, halfHeight, antiAliasing, tile)
+			for tile in tiles]
+		for _ in self.pool.imap_unordered(renderTile, jobs):
+			pass
+
+		self.lastTime = time.perf_counter() - start
+		image = np.ndarray(shape, dtype=self.dtype, buffer=self.memory.buf)
+		return image if rows is None else image[band[0]:band[1]].copy()
+
+	# 共有メモリを解放する
+	def release(self):
+		if self.memory is not None:
+			self.memory.close()
+			self.memory.unlink()
+			self.memory = None
+			self.shape = None
+			self.dtype = None
+
+	# プロセスプールを終了し、共有メモリを解放する
+	def close(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+		self.release()
+
+# 使い方: python raytracer_parallel.py [スクリプト名 halfWidth ワーカー数 タイルサイズ]
+# 逐次計算とタイル並列計算の結果がビット単位で一致するかを確かめる
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_task4"
+	halfWidth = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	workers = int(sys.argv[3]) if len(sys.argv) > 3 else g_Workers
+	tileSize = int(sys.argv[4]) if len(sys.argv) > 4 else g_TileSize
+	module = raytracer.loadTracer(name)
+	scene = module.getScene()
+	antiAliasing = getattr(module, "g_AntiAliasing", False)
+
+	start = time.perf_counter()
+	serial = raytracer.renderFrame(scene, halfWidth, halfWidth, antiAliasing)
+	serial_time = time.perf_counter() - start
+
+	renderer = TileRenderer(workers, tileSize)
+	image = renderer.render(scene, halfWidth, halfWidth, antiAliasing)
+	print(f"{name}: {image.shape[1]}x{image.shape[0]} AA={'ON' if antiAliasing else 'OFF'}")
+	print(f"  serial {serial_time * 1000:.1f} ms, {workers} workers x {tileSize}px tiles {renderer.lastTime * 1000:.1f} ms")
+	print(f"  bit-identical: {np.array_equal(serial, image)}")
+	renderer.close()
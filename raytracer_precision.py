@@ -0,0 +1,61 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# float64 と float32 の計算精度の比較
+# 同じシーンを両方の精度で描画し、描画時間と画素ごとの色の誤差 (float64 の結果との差) を表示する
+
+SCRIPTS = ["week7_task", "week8_task1", "week8_task2", "week8_task3", "week8_task4",
+	"week8_advanced1", "week8_advanced2"]
+
+# 8bit に丸めたとき色が変わる誤差の大きさ
+VISIBLE_ERROR = 0.5 / 255.0
+
+# scene を dtype の精度にして描画し、(画像, repeat 回のうち最も速い時間) を返す
+def renderWithPrecision(scene, dtype, halfWidth, halfHeight, antiAliasing, repeat):
+	scene.setPrecision(dtype)
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		image = raytracer.renderFrame(scene, halfWidth, halfHeight, antiAliasing)
+		best = min(best, time.perf_counter() - start)
+	return image, best
+
+# 1つのスクリプトについて両方の精度を比べた結果の辞書を返す
+def compare(name, halfWidth, halfHeight, antiAliasing=False, repeat=3):
+	tracer = raytracer.loadTracer(name)
+	reference, time64 = renderWithPrecision(tracer.getScene(), np.float64, halfWidth, halfHeight, antiAliasing, repeat)
+	scene = tracer.getScene()
+	image, time32 = renderWithPrecision(scene, np.float32, halfWidth, halfHeight, antiAliasing, repeat)
+
+	error = np.abs(image.astype(np.float64) - reference).max(axis=2)
+	return {
+		"script": name,
+		"float64Seconds": time64,
+		"float32Seconds": time32,
+		"speedup": time64 / time32,
+		"maxError": float(error.max()),
+		"meanError": float(error.mean()),
+		"visiblePixels": int(np.count_nonzero(error > VISIBLE_ERROR)),
+		"pixels": error.size,
+		"epsilon": scene.epsilon,
+	}
+
+# 使い方: python raytracer_precision.py [スクリプト名 ...] [-s halfWidth] [-a]
+# -a でアンチエイリアシングあり
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	halfWidth = 200
+	antiAliasing = "-a" in args
+	if "-s" in args:
+		halfWidth = int(args[args.index("-s") + 1])
+		del args[args.index("-s"):args.index("-s") + 2]
+	names = [a for a in args if a != "-a"] or SCRIPTS
+
+	print(f"{'script':<16} {'float64':>9} {'float32':>9} {'speedup':>7} {'max err':>9} {'mean err':>9} {'visible':>9}")
+	for name in names:
+		r = compare(name, halfWidth, halfWidth, antiAliasing)
+		print(f"{name:<16} {r['float64Seconds'] * 1000:7.1f}ms {r['float32Seconds'] * 1000:7.1f}ms "
+			f"{r['speedup']:6.2f}x {r['maxError']:9.2e} {r['meanError']:9.2e} "
+			f"{r['visiblePixels']:>4}/{r['pixels']} (epsilon {r['epsilon']:.3g})")
@@ -0,0 +1,138 @@
+import time
+import threading
+import numpy as np
+import raytracer
+
+# 段階的 (プログレッシブ) 描画
+# 最初は 8 画素おきに追跡して大きなブロックで塗り、4, 2, 1 画素おきと細かくしていく
+# 処理は小さな区切り (スライス) に分かれていて、時間の予算ごとに少しずつ進められる
+
+g_Steps = (8, 4, 2, 1)	# 各段階のサンプル間隔 [画素]
+g_RaysPerSlice = 4096	# 1スライスで追跡するレイの数の目安
+
+# 描画した画像を覚えるときの描画方法 (raytracer_cache の mode)。適応的アンチエイリアシングは結果が違うので分ける
+def getCacheMode(antiAliasing=False, adaptive=None):
+	if antiAliasing and adaptive is not None:
+		return f"adaptive:{adaptive[0]}:{adaptive[1]}"
+	return "engine"
+
+class ProgressiveRender:
+	# adaptive: 最後の段階を適応的アンチエイリアシング (raytracer.renderAdaptive) にするときの (contrast, gridSize)
+	# tileRenderer: 最後の段階をタイル並列で計算するときのプロセスプール (raytracer_parallel.TileRenderer)
+	def __init__(self, scene, halfWidth, halfHeight, antiAliasing=False, steps=None, adaptive=None, tileRenderer=None):
+		self.scene = scene
+		self.halfWidth = halfWidth
+		self.halfHeight = halfHeight
+		self.antiAliasing = antiAliasing
+		self.steps = steps or g_Steps
+		self.adaptive = adaptive
+		self.tileRenderer = tileRenderer
+		self.mode = getCacheMode(antiAliasing, adaptive)
+		self.height = 2 * halfHeight + 1
+		self.width = 2 * halfWidth + 1
+		self.image = np.zeros((self.height, self.width, 3), dtype=scene.dtype)	# 途中経過の画像
+		self.passIndex = 0	# 現在の段階
+		self.done = False	# 全ての段階が終わったか
+		self.elapsed = 0.0	# これまでの計算時間 [秒]
+		self.slices = self.getSlices()
+		self.lock = threading.Lock()	# 途中経過の画像を書き換える間は持つ (別のスレッドで表示するとき用)
+		if scene.stats is not None:
+			scene.stats.beginFrame(self.height, self.width)
+
+	# 段階の数 (アンチエイリアシングありなら最後にアンチエイリアシングの段階が加わる)
+	def getPassCount(self):
+		return len(self.steps) + (1 if self.antiAliasing else 0)
+
+	# 全ての段階のスライスを順に返す
+	def getSlices(self):
+		for index, step in enumerate(self.steps):
+			self.passIndex = index
+			cols = np.arange(0, self.width, step)
+			rows_per_slice = max(1, g_RaysPerSlice // len(cols))
+			sample_rows = np.arange(0, self.height, step)
+			for i in range(0, len(sample_rows), rows_per_slice):
+				yield self.makeSampleSlice(sample_rows[i:i + rows_per_slice], cols, step, index == 0)
+
+		if self.antiAliasing:
+			# 最後にアンチエイリアシングで行ごとに計算し直す
+			# 適応的なら1画素1本と境界の画素の分、タイル並列ならタイル1段ずつをまとめてプロセスプールに渡す
+			self.passIndex = len(self.steps)
+			if self.adaptive is not None:
+				rows_per_slice = max(1, g_RaysPerSlice // self.width)
+			elif self.tileRenderer is not None:
+				rows_per_slice = self.tileRenderer.tileSize
+			else:
+				rows_per_slice = max(1, g_RaysPerSlice // (9 * self.width))
+			for r in range(0, self.height, rows_per_slice):
+				rows = (r, min(r + rows_per_slice, self.height))
+				yield lambda rows=rows: self.renderRows(rows)
+
+	# step 画素おきのサンプルを追跡して step x step のブロックを塗るスライスを作る
+	# 前の段階 (2*step おき) ですでに追跡した画素は計算し直さない
+	def makeSampleSlice(self, rows, cols, step, first):
+		def run():
+			xs, ys = np.meshgrid(cols.astype(np.float64) - self.halfWidth, rows.astype(np.float64) - self.halfHeight)
+			todo = np.ones(xs.shape, dtype=bool)
+			if not first:
+				todo = ~(((rows % (2 * step)) == 0)[:, np.newaxis] & ((cols % (2 * step)) == 0)[np.newaxis, :])
+
+			if first:
+				# 最初の段階は格子全体を追跡するので、パケット追跡が使える
+				colors = raytracer.tracePrimaryRays(self.scene, xs, ys)[0]
+			else:
+				colors = np.empty(xs.shape + (3,), dtype=self.image.dtype)
+				colors[~todo] = self.image[rows][:, cols][~todo]
+				colors[todo] = raytracer.tracePrimaryRays(self.scene, xs[todo], ys[todo])[0]
+
+			# サンプルの色で step x step のブロックを塗る
+			block = np.repeat(np.repeat(colors, step, axis=0), step, axis=1)
+			r0 = rows[0]
+			r1 = min(rows[-1] + step, self.height)
+			with self.lock:
+				self.image[r0:r1] = block[:r1 - r0, :self.width]
+		return run
+
+	# rows の範囲の行をアンチエイリアシングで計算する (適応的か、3x3 スーパーサンプリングを1プロセスかタイル並列で)
+	def renderRows(self, rows):
+		if self.adaptive is not None:
+			contrast, gridSize = self.adaptive
+			colors = raytracer.renderAdaptive(self.scene, self.halfWidth, self.halfHeight, contrast, gridSize, rows)[0]
+		elif self.tileRenderer is not None:
+			colors = self.tileRenderer.render(self.scene, self.halfWidth, self.halfHeight, True, rows=rows)
+		else:
+			colors = raytracer.renderRegion(self.scene, self.halfWidth, self.halfHeight, True, rows=rows)
+		with self.lock:
+			self.image[rows[0]:rows[1]] = colors
+
+	# budget 秒を使い切るまでスライスを処理する。画像が更新されたら True を返す
+	def step(self, budget):
+		if self.done:
+			return False
+		start = time.perf_counter()
+		while time.perf_counter() - start < budget:
+			task = next(self.slices, None)
+			if task is None:
+				self.done = True
+				if self.scene.stats is not None:
+					self.scene.stats.endFrame()
+				break
+			task()
+		self.elapsed += time.perf_counter() - start
+		return True
+
+	# 計算済みの画像 (キャッシュなど) をそのまま最終結果にする
+	def useImage(self, image):
+		with self.lock:
+			self.image = np.array(image, dtype=self.image.dtype)
+		self.done = True
+
+	# 途中経過の画像の写し (別のスレッドが書き換えている途中の行は含まない)
+	def getImage(self):
+		with self.lock:
+			return self.image.copy()
+
+	# 最後まで計算した画像を返す (renderFrame か、adaptive なら renderAdaptive と同じ結果になる)
+	def finish(self):
+		while not self.done:
+			self.step(float("inf"))
+		return self.image
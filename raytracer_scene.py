@@ -0,0 +1,132 @@
+import sys
+import json
+import time
+import numpy as np
+import raytracer
+
+# シーンファイルの読み書き
+# JSON 形式 (.json): 人が読み書きできる形。球は {"center", "radius", "color"} のリスト
+# バイナリ形式 (.rtscene): 球の中心・半径・色をそれぞれ連続した float64 の配列として並べた形
+#   np.memmap で開くので、100万個の球でも読み込み時に解析やコピーをしない
+#
+# バイナリ形式の並び (リトルエンディアン)
+#   "RTSCENE\0" (8バイト), 版 (uint32), 設定の JSON の長さ (uint32), 球の数 (uint64)
+#   設定の JSON (UTF-8)
+#   中心 (球の数 x 3), 半径 (球の数), 色 (球の数 x 3)   それぞれ ALIGNMENT バイト境界から始まる
+
+MAGIC = b"RTSCENE\0"
+VERSION = 1
+ALIGNMENT = 64
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("settingsLength", "<u4"), ("count", "<u8")])
+
+# ファイルに保存する Scene の設定 (球以外の属性)
+SETTINGS = ["boardY", "lightDirection", "viewpoint", "distance", "shininess", "kd", "ks", "iin", "ia",
+	"floorColors", "checkerSize", "shadow", "reflectionWeight", "background", "floorFilter"]
+
+# Scene の設定を JSON に書ける値の辞書にする
+def getSettings(scene):
+	settings = {}
+	for name in SETTINGS:
+		value = getattr(scene, name)
+		settings[name] = value.tolist() if isinstance(value, np.ndarray) else value
+	return settings
+
+# 設定の辞書と球の配列から Scene を作る
+def makeSceneFromSettings(settings, centers, radii, colors):
+	settings = dict(settings)
+	boardY = settings.pop("boardY", None)
+	unknown = set(settings) - set(SETTINGS)
+	if unknown:
+		raise ValueError(f"unknown scene settings: {sorted(unknown)}")
+	return raytracer.makeScene(centers, radii, colors, boardY, **settings)
+
+# offset を ALIGNMENT の倍数に切り上げる
+def align(offset):
+	return -(-offset // ALIGNMENT) * ALIGNMENT
+
+# バイナリ形式の各配列のファイル内の位置 (中心, 半径, 色)
+def getArrayOffsets(settingsLength, count):
+	centers = align(HEADER_DTYPE.itemsize + settingsLength)
+	radii = align(centers + count * 3 * 8)
+	colors = align(radii + count * 8)
+	return centers, radii, colors, colors + count * 3 * 8
+
+# シーンをファイルに保存する。拡張子が .json なら JSON 形式、それ以外はバイナリ形式
+def saveScene(scene, path):
+	if path.endswith(".json"):
+		# 設定は1行、球は1個ずつ1行に書く
+		spheres = [json.dumps({"center": c, "radius": r, "color": k}) for c, r, k in
+			zip(scene.centers.tolist(), scene.radii.tolist(), scene.colors.tolist())]
+		with open(path, "w") as f:
+			f.write(f'{{"format": "rtscene", "version": {VERSION},\n"settings": {json.dumps(getSettings(scene))},\n')
+			f.write('"spheres": [\n' + ",\n".join(spheres) + "\n]}\n")
+		return
+
+	settings = json.dumps(getSettings(scene)).encode("utf-8")
+	count = len(scene.radii)
+	header = np.array([(MAGIC, VERSION, len(settings), count)], dtype=HEADER_DTYPE)
+	offsets = getArrayOffsets(len(settings), count)
+	with open(path, "wb") as f:
+		f.write(header.tobytes())
+		f.write(settings)
+		for offset, array in zip(offsets, [scene.centers, scene.radii, scene.colors]):
+			f.write(b"\0" * (offset - f.tell()))
+			f.write(np.ascontiguousarray(array, dtype="<f8").tobytes())
+
+# シーンファイルを読み込む。バイナリ形式の球の配列はファイルを memmap したもの (読み取り専用)
+def loadScene(path):
+	with open(path, "rb") as f:
+		head = f.read(HEADER_DTYPE.itemsize)
+		if head[:len(MAGIC)] != MAGIC:
+			f.seek(0)
+			return loadJsonScene(json.load(f), path)
+		header = np.frombuffer(head, dtype=HEADER_DTYPE)[0]
+		if header["version"] != VERSION:
+			raise ValueError(f"{path}: unsupported scene version {header['version']}")
+		settings = json.loads(f.read(int(header["settingsLength"])).decode("utf-8"))
+
+	count = int(header["count"])
+	offsets = getArrayOffsets(int(header["settingsLength"]), count)
+	if count == 0:
+		centers, radii, colors = np.zeros((0, 3)), np.zeros(0), np.zeros((0, 3))
+	else:
+		centers = np.memmap(path, dtype="<f8", mode="r", offset=offsets[0], shape=(count, 3))
+		radii = np.memmap(path, dtype="<f8", mode="r", offset=offsets[1], shape=(count,))
+		colors = np.memmap(path, dtype="<f8", mode="r", offset=offsets[2], shape=(count, 3))
+	return makeSceneFromSettings(settings, centers, radii, colors)
+
+# JSON 形式のデータからシーンを作る
+def loadJsonScene(data, path=""):
+	if data.get("format") != "rtscene" or data.get("version") != VERSION:
+		raise ValueError(f"{path}: not a version {VERSION} rtscene file")
+	spheres = data.get("spheres", [])
+	centers = np.array([s["center"] for s in spheres], dtype=np.float64).reshape(-1, 3)
+	radii = np.array([s["radius"] for s in spheres], dtype=np.float64)
+	colors = np.array([s["color"] for s in spheres], dtype=np.float64).reshape(-1, 3)
+	return makeSceneFromSettings(data.get("settings", {}), centers, radii, colors)
+
+# 使い方:
+#   python raytracer_scene.py export week8_advanced1 advanced1.json   スクリプトのシーンを書き出す (結果が同じか確認する)
+#   python raytracer_scene.py random 1000000 million.rtscene          ランダムな球のシーンを作る
+#   python raytracer_scene.py info million.rtscene                     シーンの読み込み時間と内容を表示する
+if __name__ == "__main__":
+	command = sys.argv[1] if len(sys.argv) > 1 else "info"
+	if command == "export":
+		tracer = raytracer.loadTracer(sys.argv[2])
+		scene = tracer.getScene()
+		saveScene(scene, sys.argv[3])
+		loaded = loadScene(sys.argv[3])
+		identical = np.array_equal(raytracer.renderFrame(scene, 50, 50), raytracer.renderFrame(loaded, 50, 50))
+		print(f"{sys.argv[2]} -> {sys.argv[3]}: {len(scene.radii)} spheres, identical render: {identical}")
+	elif command == "random":
+		import raytracer_bvh
+		scene = raytracer_bvh.makeRandomScene(int(sys.argv[2]), boardY=-150, checkerSize=100,
+			floorColors=((1.0, 1.0, 0.7), (0.6, 0.6, 0.6)), shadow=True)
+		start = time.perf_counter()
+		saveScene(scene, sys.argv[3])
+		print(f"{sys.argv[3]}: {len(scene.radii)} spheres, saved in {(time.perf_counter() - start) * 1000:.1f} ms")
+	elif command == "info":
+		start = time.perf_counter()
+		scene = loadScene(sys.argv[2])
+		print(f"{sys.argv[2]}: {len(scene.radii)} spheres, loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+		print(json.dumps(getSettings(scene)))
@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import raytracer
+import raytracer_bench
+import raytracer_cache
+import raytracer_image
+import raytracer_scene
+import raytracer_animation
+import raytracer_shadowmask
+import raytracer_parallel
+
+# ローカルの描画サービス (GLUT を読み込まずに、他のツールから HTTP で week7 / week8 のレイトレーサーに描画を頼む)
+# 頼まれた描画はジョブの待ち行列に入れ、ワーカープロセスのプールで1つずつ描画する
+# 描画した画像はシーンの内容と描画条件のハッシュ (raytracer_cache.getSceneKey) をキーに覚えておき、
+# 同じ内容の依頼には描画せずに返す。同じ内容のジョブが待ち行列にあれば、そのジョブの結果を待つ
+#
+# POST /render  本体は JSON の依頼。結果は PNG (image/png) か、画素の float の配列 (application/octet-stream)
+#   {"scene": スクリプト名・シーンファイル (.json / .rtscene)・rtscene 形式の JSON のどれか,
+#    "settings": {Scene の設定の上書き (raytracer_scene.SETTINGS)}, "camera": {"eye": [x, y, z], "target": [x, y, z]},
+#    "halfWidth": 200, "halfHeight": 200, "antiAliasing": false, "precision": "float64", "format": "png" か "raw"}
+#   raw の画素は raytracer の並び (行 0 が画面の下端) で、形と型はヘッダー X-Image-Shape, X-Image-Dtype に入る
+#   ジョブの時間 [ms] はヘッダー X-Job-Timings (JSON) に入る
+# GET /status   待ち行列の長さ・描画中のジョブ数・キャッシュの当たり外れ・最近のジョブの時間 (JSON)
+
+g_Host = "127.0.0.1"	# 受け付けるアドレス (ローカルからの依頼だけ)
+g_Port = 8765
+g_Workers = raytracer_parallel.g_Workers	# ワーカープロセス数
+g_CacheFrames = 64	# メモリ上に覚えておく画像の数
+g_RecentJobs = 32	# /status に表示する最近のジョブの数
+g_MaxHalfSize = 2000	# 受け付ける halfWidth, halfHeight の上限
+FORMATS = {"png": "image/png", "raw": "application/octet-stream"}
+PRECISIONS = ["float64", "float32"]
+
+# 1つの描画のジョブ
+class RenderJob:
+	def __init__(self, number, key, scene, halfWidth, halfHeight, antiAliasing):
+		self.number = number	# 受け付けた順の番号
+		self.key = key	# 結果のキャッシュのキー
+		self.scene = scene
+		self.halfWidth = halfWidth
+		self.halfHeight = halfHeight
+		self.antiAliasing = antiAliasing
+		self.image = None	# 描画した画像 (終わるまで None)
+		self.error = None	# 描画に失敗したときのメッセージ
+		self.worker = None	# 描画したワーカープロセスの pid
+		self.done = threading.Event()
+		self.queued = time.perf_counter()	# 待ち行列に入れた時刻
+		self.started = None	# 描画を始めた時刻
+		self.finished = None	# 描画が終わった時刻
+
+	# 待ち時間と描画時間 [ms]
+	def getTimings(self):
+		timings = {}
+		if self.started is not None:
+			timings["queueMs"] = (self.started - self.queued) * 1000.0
+		if self.finished is not None:
+			timings["renderMs"] = (self.finished - self.started) * 1000.0
+		return timings
+
+# 1つのジョブを描画する (ワーカープロセスで実行される)
+def renderJob(args):
+	scene, halfWidth, halfHeight, antiAliasing = args
+	return raytracer.renderFrame(scene, halfWidth, halfHeight, antiAliasing), os.getpid()
+
+# 依頼の "scene" からシーンを作る
+def loadRequestScene(description):
+	if isinstance(description, dict):
+		return raytracer_scene.loadJsonScene(description, "request")
+	if not isinstance(description, str):
+		raise ValueError("scene must be a script name, a scene file or an rtscene object")
+	if description.endswith(raytracer_bench.SCENE_EXTENSIONS):
+		if not os.path.exists(description):
+			raise ValueError(f"scene file not found: {description}")
+	elif not (description.startswith(("week7_", "week8_")) and description.isidentifier()):
+		# スクリプトは week7 / week8 のレイトレーサーだけを読み込む
+		raise ValueError(f"unknown scene script: {description}")
+	return raytracer_bench.loadCase(description)[1]
+
+# Scene の設定を上書きする (raytracer_scene.SETTINGS の名前だけ)
+def applySettings(scene, settings):
+	unknown = set(settings) - set(raytracer_scene.SETTINGS)
+	if unknown:
+		raise ValueError(f"unknown scene settings: {sorted(unknown)}")
+	for name, value in settings.items():
+		if name == "boardY":
+			value = None if value is None else float(value)
+		elif name in ["lightDirection", "viewpoint", "background"]:
+			value = np.array(value, dtype=np.float64).reshape(3)
+		elif name == "floorColors":
+			value = np.array(value, dtype=np.float64).reshape(-1, 3)
+		elif name == "distance":
+			value = float(value)
+		setattr(scene, name, value)
+
+# 依頼の JSON から (シーン, halfWidth, halfHeight, antiAliasing, 出力形式) を作る
+def parseRequest(request):
+	if not isinstance(request, dict) or "scene" not in request:
+		raise ValueError("request must be a JSON object with a scene")
+	halfWidth = int(request.get("halfWidth", 200))
+	halfHeight = int(request.get("halfHeight", halfWidth))
+	if not (0 < halfWidth <= g_MaxHalfSize and 0 < halfHeight <= g_MaxHalfSize):
+		raise ValueError(f"halfWidth and halfHeight must be in 1..{g_MaxHalfSize}")
+	output = request.get("format", "png")
+	if output not in FORMATS:
+		raise ValueError(f"format must be one of {sorted(FORMATS)}")
+	precision = request.get("precision", "float64")
+	if precision not in PRECISIONS:
+		raise ValueError(f"precision must be one of {PRECISIONS}")
+
+	scene = loadRequestScene(request["scene"])
+	applySettings(scene, request.get("settings", {}))
+	camera = request.get("camera")
+	if camera is not None:
+		raytracer_animation.setCamera(scene, camera["eye"], camera["target"])
+	scene.setPrecision(precision)
+	# 床の影のマスクはスクリプトが元の光の向き・床で作ったものなので、上書きしたシーンに合わせる (同じなら作り直さない)
+	if scene.shadowMask is not None:
+		scene.shadowMask = raytracer_shadowmask.getShadowMask(scene, scene.shadowMask.cellSize, scene.shadowMask.exact)
+	return scene, halfWidth, halfHeight, bool(request.get("antiAliasing", False)), output
+
+# 待ち行列・ワーカープロセスのプール・結果のキャッシュを持ち、描画の依頼を処理する
+class RenderService:
+	def __init__(self, workers=None, cacheDir=None, log=sys.stderr):
+		self.workers = workers or g_Workers
+		self.cache = raytracer_cache.FrameCache(g_CacheFrames, cacheDir)
+		self.lock = threading.Lock()	# cache, inflight, 統計を守る
+		self.queue = queue.Queue()
+		self.inflight = {}	# キー -> 待ち行列にあるか描画中のジョブ
+		self.recent = collections.deque(maxlen=g_RecentJobs)	# 最近のジョブの記録
+		self.jobCount = 0
+		self.running = 0	# 描画中のジョブ数
+		self.completed = 0
+		self.failed = 0
+		self.shared = 0	# 待ち行列にある同じ内容のジョブの結果を使った依頼の数
+		self.log = log
+		self.pool = multiprocessing.Pool(self.workers)
+		# ワーカープロセスと同じ数のスレッドが待ち行列からジョブを取り出し、プールで描画する
+		self.dispatchers = [threading.Thread(target=self.dispatch, daemon=True) for _ in range(self.workers)]
+		for thread in self.dispatchers:
+			thread.start()
+
+	# 描画を頼み、(画像, ジョブの記録) を返す。同じ内容の画像があれば描画しない
+	def render(self, scene, halfWidth, halfHeight, antiAliasing=False):
+		start = time.perf_counter()
+		# raytracer_cache と同じキーなので、RAYTRACER_CACHE_DIR を共有すればウィンドウで描画した画像も使える
+		key = raytracer_cache.getSceneKey(scene, halfWidth, halfHeight, antiAliasing)
+		with self.lock:
+			self.jobCount += 1
+			number = self.jobCount
+			image = self.cache.get(key)
+			job = None
+			if image is None:
+				job = self.inflight.get(key)
+				source = "shared" if job is not None else "render"
+				if job is None:
+					job = RenderJob(number, key, scene, halfWidth, halfHeight, antiAliasing)
+					self.inflight[key] = job
+					self.queue.put(job)
+				else:
+					self.shared += 1
+			else:
+				source = "cache"
+
+		record = {"job": number, "key": key[:16], "width": 2 * halfWidth + 1, "height": 2 * halfHeight + 1,
+			"antiAliasing": antiAliasing, "source": source}
+		if job is not None:
+			job.done.wait()
+			if job.error is not None:
+				raise RuntimeError(job.error)
+			image = job.image
+			record.update(job.getTimings())
+			record["worker"] = job.worker
+		record["totalMs"] = (time.perf_counter() - start) * 1000.0
+		with self.lock:
+			self.recent.append(record)
+		return image, record
+
+	# ディスパッチャのスレッドの本体: 待ち行列からジョブを取り出して描画する
+	def dispatch(self):
+		while True:
+			job = self.queue.get()
+			job.started = time.perf_counter()
+			with self.lock:
+				self.running += 1
+			try:
+				job.image, job.worker = self.pool.apply(renderJob, [(job.scene, job.halfWidth, job.halfHeight, job.antiAliasing)])
+			except Exception as e:
+				job.error = f"{type(e).__name__}: {e}"
+			job.finished = time.perf_counter()
+			job.scene = None	# 終わったジョブのシーンは持ち続けない
+
+			with self.lock:
+				self.running -= 1
+				if job.error is None:
+					self.cache.put(job.key, job.image)
+					self.completed += 1
+				else:
+					self.failed += 1
+				del self.inflight[job.key]
+			job.done.set()
+			timings = job.getTimings()
+			print(f"RenderService: job {job.number} {2 * job.halfWidth + 1}x{2 * job.halfHeight + 1} "
+				f"{'failed' if job.error else 'done'}, queued {timings['queueMs']:.1f} ms, "
+				f"render {timings['renderMs']:.1f} ms (worker {job.worker})", file=self.log)
+
+	# 待ち行列の長さ・描画中のジョブ数・キャッシュの統計・最近のジョブの記録
+	def getStatus(self):
+		with self.lock:
+			return {
+				"workers": self.workers,
+				"queueDepth": self.queue.qsize(),
+				"running": self.running,
+				"jobs": self.jobCount,
+				"completed": self.completed,
+				"failed": self.failed,
+				"shared": self.shared,
+				"cache": {"hits": self.cache.hits, "misses": self.cache.misses, "frames": len(self.cache.frames)},
+				"recent": list(self.recent),
+			}
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+# HTTP の依頼を RenderService に渡す
+class RenderRequestHandler(BaseHTTPRequestHandler):
+	service = None	# makeServer で設定する
+
+	def do_GET(self):
+		if self.path == "/status":
+			self.sendJSON(200, self.service.getStatus())
+		else:
+			self.sendJSON(404, {"error": f"not found: {self.path}"})
+
+	def do_POST(self):
+		if self.path != "/render":
+			self.sendJSON(404, {"error": f"not found: {self.path}"})
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+			scene, halfWidth, halfHeight, antiAliasing, output = parseRequest(request)
+		except (ValueError, KeyError, TypeError) as e:
+			self.sendJSON(400, {"error": f"{type(e).__name__}: {e}"})
+			return
+		try:
+			image, record = self.service.render(scene, halfWidth, halfHeight, antiAliasing)
+		except RuntimeError as e:
+			self.sendJSON(500, {"error": str(e)})
+			return
+
+		start = time.perf_counter()
+		if output == "png":
+			body = raytracer_image.encodePNG(image)
+		else:
+			image = np.ascontiguousarray(image, dtype=image.dtype.newbyteorder("<"))
+			body = image.tobytes()
+		record["encodeMs"] = (time.perf_counter() - start) * 1000.0
+
+		self.send_response(200)
+		self.send_header("Content-Type", FORMATS[output])
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("X-Job-Timings", json.dumps(record))
+		self.send_header("X-Queue-Depth", str(self.service.queue.qsize()))
+		if output == "raw":
+			self.send_header("X-Image-Shape", ",".join(str(n) for n in image.shape))
+			self.send_header("X-Image-Dtype", image.dtype.str)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendJSON(self, status, data):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# アクセスログはジョブのログと重なるので出さない
+	def log_message(self, format, *args):
+		pass
+
+# サービスを受け付ける HTTP サーバーを作る (serve_forever() で開始する)
+def makeServer(service, host=None, port=None):
+	handler = type("Handler", (RenderRequestHandler,), {"service": service})
+	server = ThreadingHTTPServer((host or g_Host, g_Port if port is None else port), handler)
+	server.daemon_threads = True
+	return server
+
+# 描画を頼む (クライアント側)。(PNG のバイト列か画像の配列, ジョブの記録) を返す
+def requestRender(request, url=None):
+	url = url or f"http://{g_Host}:{g_Port}"
+	data = json.dumps(request).encode("utf-8")
+	http_request = urllib.request.Request(url + "/render", data, {"Content-Type": "application/json"})
+	try:
+		with urllib.request.urlopen(http_request) as response:
+			body = response.read()
+			record = json.loads(response.headers["X-Job-Timings"])
+			if response.headers["Content-Type"] == FORMATS["raw"]:
+				shape = tuple(int(n) for n in response.headers["X-Image-Shape"].split(","))
+				return np.frombuffer(body, dtype=response.headers["X-Image-Dtype"]).reshape(shape), record
+			return body, record
+	except urllib.error.HTTPError as e:
+		raise ValueError(json.loads(e.read()).get("error", str(e))) from None
+
+# サービスの状態を取得する (クライアント側)
+def requestStatus(url=None):
+	url = url or f"http://{g_Host}:{g_Port}"
+	with urllib.request.urlopen(url + "/status") as response:
+		return json.loads(response.read())
+
+# 使い方:
+#   python raytracer_service.py serve [port [ワーカー数]]                  サービスを開始する
+#   python raytracer_service.py request week8_task4 out.png [halfWidth]    描画を頼んで PNG に保存する
+#   python raytracer_service.py status                                      待ち行列とジョブの時間を表示する
+#   python raytracer_service.py check                                       設定の上書きの結果を確かめる (サーバーは使わない)
+# ディスクにも結果を覚えておくには RAYTRACER_CACHE_DIR を設定する
+if __name__ == "__main__":
+	command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+	if command == "serve":
+		port = int(sys.argv[2]) if len(sys.argv) > 2 else g_Port
+		workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+		service = RenderService(workers, raytracer_cache.g_CacheDir)
+		server = makeServer(service, port=port)
+		print(f"RenderService: http://{g_Host}:{port} with {service.workers} workers", file=sys.stderr)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		server.server_close()
+		service.close()
+	elif command == "request":
+		halfWidth = int(sys.argv[4]) if len(sys.argv) > 4 else 200
+		body, record = requestRender({"scene": sys.argv[2], "halfWidth": halfWidth})
+		with open(sys.argv[3], "wb") as f:
+			f.write(body)
+		print(json.dumps(record))
+	elif command == "status":
+		print(json.dumps(requestStatus(), indent=1))
+	elif command == "check":
+		# 光の向きと床の高さを上書きした依頼の画像が、スクリプトの変数を変えて作り直したシーンの画像と一致するか
+		# (week8_task3 / week8_advanced1 は床の影のマスクを使う)
+		halfWidth = 150	# 床の影が画面に入る大きさ
+		overrides = [("lightDirection", "g_LightDirection", [1.0, -4.0, -3.0]), ("boardY", None, -120.0)]
+		for name in ["week8_task3", "week8_advanced1", "week8_task4"]:
+			for setting, variable, value in overrides:
+				scene = parseRequest({"scene": name, "halfWidth": halfWidth, "settings": {setting: value}})[0]
+				image = renderJob((scene, halfWidth, halfWidth, False))[0]
+				tracer = raytracer.loadTracer(name)
+				if variable is not None:
+					saved = getattr(tracer, variable)
+					setattr(tracer, variable, np.array(value))
+					fresh = tracer.getScene()
+					setattr(tracer, variable, saved)
+				else:
+					saved = tracer.g_Board.y
+					tracer.g_Board.y = value
+					fresh = tracer.getScene()
+					tracer.g_Board.y = saved
+				max_error, mismatches = raytracer.compareFrames(image, raytracer.renderFrame(fresh, halfWidth, halfWidth))
+				print(f"{name} {setting}={value}: max error {max_error:.3g}, mismatched pixels {mismatches}")
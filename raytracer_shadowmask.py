@@ -0,0 +1,140 @@
+import time
+import numpy as np
+import raytracer
+
+# 床の影のマスク
+# 光源は平行光で球は動かないので、床の上の影の形はシーンと光の向きだけで決まる
+# 球を光の向きに沿って床へ投影した範囲を (x, z) の格子に塗っておき、床の影の判定は表を引くだけにする
+
+g_CellSize = 2.0	# 格子の1マスの大きさ (床の座標の単位)
+g_Exact = True	# True: 影の境界付近のマスだけは影のレイを実際に飛ばして判定する
+
+# 格子を作るとき、境界箱に加える余白のマス数
+MARGIN_CELLS = 2
+
+# これより球が多く BVH があるときは、球ごとに塗らずに格子全体を BVH で判定する
+BVH_SPHERE_COUNT = 64
+
+class ShadowMask:
+	def __init__(self, scene, cellSize=None, exact=None):
+		start = time.perf_counter()
+		self.cellSize = cellSize or g_CellSize
+		self.exact = g_Exact if exact is None else exact
+		self.lightDir = scene.getLightDir()
+		self.boardY = scene.boardY	# 作ったときの床の y 座標
+
+		L = self.lightDir
+		self.valid = scene.boardY is not None and L[1] > 1.0e-6 and len(scene.radii) > 0
+		self.x0 = self.z0 = 0.0
+		self.mask = np.zeros((0, 0), dtype=bool)	# [z のマス, x のマス] が影なら True
+		self.uncertain = np.zeros((0, 0), dtype=bool)	# 影の境界に接するマス
+		if self.valid:
+			self.build(scene)
+		self.buildTime = time.perf_counter() - start
+
+	# 球ごとに床へ投影した楕円の境界箱の中のマスを調べて塗る
+	def build(self, scene):
+		L = self.lightDir
+		y0 = scene.boardY
+		cell = self.cellSize
+
+		# 球の中心を光の向きに沿って床へ投影した点と、投影した楕円の x, z 方向の半径
+		s = (scene.centers[:, 1] - y0) / L[1]
+		px = scene.centers[:, 0] - s * L[0]
+		pz = scene.centers[:, 2] - s * L[2]
+		hx = scene.radii * np.sqrt(1.0 + (L[0] / L[1]) ** 2)
+		hz = scene.radii * np.sqrt(1.0 + (L[2] / L[1]) ** 2)
+
+		margin = MARGIN_CELLS * cell
+		self.x0 = float((px - hx).min() - margin)
+		self.z0 = float((pz - hz).min() - margin)
+		nx = int(np.ceil(((px + hx).max() + margin - self.x0) / cell))
+		nz = int(np.ceil(((pz + hz).max() + margin - self.z0) / cell))
+		self.mask = np.zeros((nz, nx), dtype=bool)
+
+		if scene.bvh is not None and len(scene.radii) > BVH_SPHERE_COUNT:
+			# 球が多いときは格子全体を BVH でまとめて判定する
+			self.mask[:, :] = self.isOccludedAt(scene, np.arange(nx), np.arange(nz), None)
+		else:
+			for i in range(len(scene.radii)):
+				ix = np.arange(max(0, int((px[i] - hx[i] - self.x0) / cell) - 1), min(nx, int((px[i] + hx[i] - self.x0) / cell) + 2))
+				iz = np.arange(max(0, int((pz[i] - hz[i] - self.z0) / cell) - 1), min(nz, int((pz[i] + hz[i] - self.z0) / cell) + 2))
+				if len(ix) == 0 or len(iz) == 0:
+					continue
+				self.mask[iz[0]:iz[-1] + 1, ix[0]:ix[-1] + 1] |= self.isOccludedAt(scene, ix, iz, i)
+
+		# 周囲8マスのどれかと値が違うマスを境界とする
+		padded = np.pad(self.mask, 1, mode="edge")
+		self.uncertain = np.zeros_like(self.mask)
+		for dz in (-1, 0, 1):
+			for dx in (-1, 0, 1):
+				self.uncertain |= padded[1 + dz:1 + dz + nz, 1 + dx:1 + dx + nx] != self.mask
+
+	# マスの中心から光源方向へ影のレイを飛ばして判定する (sphere が None なら全ての球)
+	def isOccludedAt(self, scene, ix, iz, sphere):
+		x = self.x0 + (ix + 0.5) * self.cellSize
+		z = self.z0 + (iz + 0.5) * self.cellSize
+		points = np.empty((len(iz), len(ix), 3), dtype=scene.dtype)
+		points[..., 0] = x[np.newaxis, :]
+		points[..., 1] = scene.boardY
+		points[..., 2] = z[:, np.newaxis]
+		origin = points + scene.epsilon * self.lightDir
+		if sphere is None:
+			return raytracer.isOccluded(scene, origin, np.broadcast_to(self.lightDir, origin.shape))
+		return raytracer.intersectSphere(scene.centers[sphere], scene.radii[sphere], origin, self.lightDir) > 0.0
+
+	# マスの統計を1行の文字列にする
+	def getReportText(self):
+		nz, nx = self.mask.shape
+		return (f"ShadowMask: {nx}x{nz} cells of {self.cellSize}, {int(self.mask.sum())} shadowed, "
+			f"{int(self.uncertain.sum())} on boundary, build {self.buildTime * 1000:.1f} ms")
+
+	# キャッシュのキー (raytracer_cache) に使う表現。マスの中身は球・床・光の向きと設定から決まるので、
+	# 作ったときの光の向きと床も含める (あとでシーンの光や床だけを変えると別のキーになる)
+	def __repr__(self):
+		return (f"ShadowMask(cellSize={self.cellSize}, exact={self.exact}, "
+			f"lightDir={self.lightDir.tolist()}, boardY={self.boardY})")
+
+	# 床の交点の配列 (..., 3) が影になるかを表から求める
+	# exact のときは境界付近の点だけ影のレイを実際に飛ばす
+	def isShadowed(self, scene, intersection):
+		shape = intersection.shape[:-1]
+		if not self.valid:
+			if scene.boardY is None or len(scene.radii) == 0:
+				return np.zeros(shape, dtype=bool)
+			# 光が下から来るなど表が作れない場合は普通に影のレイを飛ばす
+			origin = intersection + scene.epsilon * self.lightDir
+			return raytracer.isOccluded(scene, origin, np.broadcast_to(self.lightDir, intersection.shape))
+
+		nz, nx = self.mask.shape
+		ix = np.floor((intersection[..., 0] - self.x0) / self.cellSize).astype(np.int64)
+		iz = np.floor((intersection[..., 2] - self.z0) / self.cellSize).astype(np.int64)
+		inside = (ix >= 0) & (ix < nx) & (iz >= 0) & (iz < nz)
+		ix = np.where(inside, ix, 0)
+		iz = np.where(inside, iz, 0)
+		in_shadow = inside & self.mask[iz, ix]
+
+		if self.exact:
+			near = inside & self.uncertain[iz, ix]
+			if np.any(near):
+				origin = intersection[near] + scene.epsilon * self.lightDir
+				with raytracer.statsScope(scene, near):
+					in_shadow[near] = raytracer.isOccluded(scene, origin, np.broadcast_to(self.lightDir, origin.shape))
+		return in_shadow
+
+# 直前に作ったマスク (シーンと光の向きが変わらなければ作り直さない)
+g_LastKey = None
+g_LastMask = None
+
+# シーンの影のマスクを返す。球・床・光の向き・設定が前回と同じなら前回のマスクを使う
+def getShadowMask(scene, cellSize=None, exact=None):
+	global g_LastKey, g_LastMask
+
+	cellSize = cellSize or g_CellSize
+	exact = g_Exact if exact is None else exact
+	key = (scene.centers.tobytes(), scene.radii.tobytes(), scene.boardY,
+		scene.getLightDir().tobytes(), cellSize, exact)
+	if key != g_LastKey:
+		g_LastMask = ShadowMask(scene, cellSize, exact)
+		g_LastKey = key
+	return g_LastMask
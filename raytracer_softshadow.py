@@ -0,0 +1,169 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 大きさのある光源 (円盤) による柔らかい影 (必要なときだけ Scene.softShadow に設定する)
+# 平行光源は見かけの半径 angle の円盤 (太陽)、点光源は光源の方を向いた半径 radius の円盤とみなす
+# 交点ごとに円盤を n x n に分けた層から1点ずつ選んで影のレイを飛ばし、遮られなかった割合を光の届く量にする
+# 全ての光源・交点・サンプルの影のレイはまとめて1回の raytracer.isOccluded で追跡する
+# adaptive のときは最初に n x n の層のうち少ない層 (2x2 の区画から1つずつ) にレイを飛ばし、
+# 結果が分かれた交点 (半影) にだけ残りの層のレイを飛ばす (合わせて n x n 本)
+
+# サンプルの位置を交点ごとにずらす擬似乱数 (交点の座標から決めるので、画面の分け方によらず同じ画像になる)
+NOISE_VECTORS = np.array([[12.9898, 78.233, 37.719], [39.3468, 11.135, 83.155]])
+NOISE_SCALE = 43758.5453
+R2_STEPS = (0.7548776662466927, 0.5698402909980532)	# 2次元の低食い違い列 (R2 列) の1歩
+
+class SoftShadow:
+	def __init__(self, angle=2.0, radius=50.0, samples=16, adaptive=True, testSamples=4):
+		self.angle = float(angle)	# 平行光源の見かけの半径 [度]
+		self.radius = float(radius)	# 点光源の円盤の半径
+		self.samples = int(samples)	# 1つの光源あたりの影のレイの数 (n x n に切り上げる)
+		self.adaptive = adaptive	# True: 最初のレイの結果が分かれた交点にだけ残りのレイを飛ばす
+		self.testSamples = int(testSamples)	# adaptive のとき最初に飛ばすレイの数 (m x m に切り上げる。m < n のときだけ適応的にする)
+		self.resetCounts()
+
+	# キャッシュのキー (raytracer_cache) に影の設定を含める (統計は含めない)
+	def __repr__(self):
+		return f"SoftShadow({self.angle}, {self.radius}, {self.samples}, {self.adaptive}, {self.testSamples})"
+
+	def resetCounts(self):
+		self.points = 0	# 影を求めた (交点, 光源) の組の数
+		self.penumbra = 0	# そのうち残りのレイを飛ばした組の数
+		self.rays = 0	# 飛ばした影のレイの数
+
+	# 交点 point (N, 3) から光源 lights (raytracer.getLights の一覧) への光の届く割合 (光源の数, N)
+	# 光源が裏側にある交点は 0 (raytracer.getLightVisibility と同じ)
+	def getVisibility(self, scene, point, normal, lights):
+		visible = np.zeros((len(lights), len(point)), dtype=point.dtype)
+		keys, owners, offsets, sizes, isPoint = [], [], [], [], []
+		for k, (light_dir, _, distance) in enumerate(lights):
+			light_dir = np.broadcast_to(light_dir, point.shape)
+			facing = np.flatnonzero(raytracer.dot(normal, light_dir) > 0.0)
+			keys.append(np.full(len(facing), k))
+			owners.append(facing)
+			if distance is None:
+				offsets.append(light_dir[facing])
+				sizes.append(np.full(len(facing), np.tan(np.radians(self.angle))))
+			else:
+				offsets.append(light_dir[facing] * distance[facing][..., np.newaxis])
+				sizes.append(np.full(len(facing), self.radius))
+			isPoint.append(np.full(len(facing), distance is not None))
+
+		owner = np.concatenate(owners)
+		if len(owner) == 0:
+			return visible
+		offset = np.concatenate(offsets).astype(point.dtype)
+		size = np.concatenate(sizes).astype(point.dtype)
+		isPoint = np.concatenate(isPoint)
+		origin = point[owner] + scene.epsilon * raytracer.normalize(offset)	# 微小量だけずらす
+
+		n = getGridSize(self.samples)
+		m = getGridSize(self.testSamples)
+		if self.adaptive and m < n:
+			order = getSampleOrder(n, m)
+			blocked = self.traceSamples(scene, owner, origin, offset, size, isPoint, order[:m * m], n)
+			count = blocked.sum(axis=1)
+			penumbra = np.flatnonzero((count > 0) & (count < blocked.shape[1]))
+			# 半影の交点には、最初のレイで使わなかった残りの層にだけレイを飛ばす
+			more = self.traceSamples(scene, owner[penumbra], origin[penumbra], offset[penumbra],
+				size[penumbra], isPoint[penumbra], order[m * m:], n)
+			shadowed = count / blocked.shape[1]
+			shadowed[penumbra] = (count[penumbra] + more.sum(axis=1)) / (n * n)
+			self.penumbra += len(penumbra)
+		else:
+			shadowed = self.traceSamples(scene, owner, origin, offset, size, isPoint, np.arange(n * n), n).mean(axis=1)
+			self.penumbra += len(owner)
+		self.points += len(owner)
+		visible[np.concatenate(keys), owner] = 1.0 - shadowed
+		return visible
+
+	# 円盤を n x n に分けた層のうち cells の層の点へ向かう影のレイをまとめて追跡し、遮られたか (交点の数, 層の数) を返す
+	# offset: 交点から円盤の中心へのベクトル (平行光源は光源方向)、size: 円盤の半径 (平行光源は tan(angle))
+	def traceSamples(self, scene, owner, origin, offset, size, isPoint, cells, n):
+		disc = getDiscSamples(origin, cells, n)	# (交点, 層, 2)
+		axis_u, axis_v = getBasis(raytracer.normalize(offset))
+		target = offset[:, np.newaxis, :] + size[:, np.newaxis, np.newaxis] * (
+			disc[..., 0:1] * axis_u[:, np.newaxis, :] + disc[..., 1:2] * axis_v[:, np.newaxis, :])
+		length = np.sqrt(raytracer.dot(target, target))
+		direction = target / length[..., np.newaxis]
+		limit = np.where(isPoint[:, np.newaxis], length - scene.epsilon, np.inf)
+
+		samples = direction.shape[1]
+		self.rays += direction.shape[0] * samples
+		with raytracer.statsScope(scene, np.repeat(owner, samples), "shadow"):
+			blocked = raytracer.isOccluded(scene, np.repeat(origin, samples, axis=0),
+				direction.reshape(-1, 3), limit.reshape(-1))
+		return blocked.reshape(-1, samples)
+
+	# 直前の resetCounts からの統計を1行の文字列にする
+	def getReportText(self):
+		share = self.penumbra / self.points if self.points else 0.0
+		per_point = self.rays / self.points if self.points else 0.0
+		return (f"SoftShadow: {self.points} shaded points, {self.penumbra} sampled fully ({share:.1%}), "
+			f"{self.rays} shadow rays ({per_point:.2f} per point)")
+
+# count 本のサンプルを並べる正方形の格子の一辺 (count 以上の平方数に切り上げる)
+def getGridSize(count):
+	return max(1, int(np.ceil(np.sqrt(count))))
+
+# n x n のマスの順番: 最初の m x m 個は格子を m x m の区画に分けた各区画の中央のマス、残りはそれ以外のマスを番号順に並べる
+# 最初のレイと残りのレイが同じ層を二重に使わず、合わせるとちょうど n x n の層別サンプルになる
+def getSampleOrder(n, m):
+	centers = [((2 * i + 1) * n // (2 * m)) * n + (2 * j + 1) * n // (2 * m) for i in range(m) for j in range(m)]
+	rest = np.setdiff1d(np.arange(n * n), centers)
+	return np.concatenate([np.array(centers, dtype=rest.dtype), rest])
+
+# 単位円盤の上の層別サンプル (交点の数, マスの数, 2)
+# 正方形を n x n のマスに分けて cells のマスから1点ずつ選び、面積を保つ写像 (Shirley-Chiu) で円盤に移す
+def getDiscSamples(origin, cells, n):
+	cells = np.asarray(cells)
+	# マスの中の位置: 交点ごとの乱数から始めてマスの番号だけ R2 列の1歩ずつずらす (マスごとに違う位置になる)
+	jitter = []
+	for a in range(2):
+		start = np.sin(origin.astype(np.float64) @ NOISE_VECTORS[a]) * NOISE_SCALE
+		jitter.append(np.mod(start[:, np.newaxis] + cells * R2_STEPS[a], 1.0))
+	u = 2.0 * (cells % n + jitter[0]) / n - 1.0
+	v = 2.0 * (cells // n + jitter[1]) / n - 1.0
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		wide = np.abs(u) > np.abs(v)
+		r = np.where(wide, u, v)
+		phi = np.where(wide, (np.pi / 4.0) * (v / u), (np.pi / 2.0) - (np.pi / 4.0) * (u / v))
+	phi = np.where(r == 0.0, 0.0, phi)
+	return np.stack([r * np.cos(phi), r * np.sin(phi)], axis=-1).astype(origin.dtype)
+
+# 単位ベクトル w (N, 3) に垂直な2本の単位ベクトル
+def getBasis(w):
+	helper = np.where((np.abs(w[:, 0]) < 0.9)[:, np.newaxis], np.eye(3, dtype=w.dtype)[0], np.eye(3, dtype=w.dtype)[1])
+	u = raytracer.normalize(np.cross(helper, w))
+	return u, np.cross(w, u)
+
+# 使い方: python raytracer_softshadow.py [スクリプト名 [halfWidth [サンプル数]]]
+# 固い影・全ての交点に同じ数のレイ・適応的なレイの数の3通りで描画し、時間と影のレイの数、
+# 多くのサンプルで描いた画像との差を表示する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_advanced1"
+	halfWidth = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	samples = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	scene.shadowMask = None
+
+	scene.softShadow = SoftShadow(samples=256, adaptive=False)
+	reference = raytracer.renderFrame(scene, halfWidth, halfWidth)
+
+	cases = [("hard", None), (f"{samples} samples", SoftShadow(samples=samples, adaptive=False)),
+		(f"adaptive {samples}", SoftShadow(samples=samples, adaptive=True))]
+	for label, softShadow in cases:
+		scene.softShadow = softShadow
+		raytracer.resetRayCounts()
+		start = time.perf_counter()
+		image = raytracer.renderFrame(scene, halfWidth, halfWidth)
+		seconds = time.perf_counter() - start
+		error = np.abs(image - reference).mean()
+		print(f"{label:>12}: {seconds * 1000:7.1f} ms, {raytracer.g_RayCounts['shadow']:7d} shadow rays, "
+			f"mean error {error:.4f}")
+		if softShadow is not None:
+			print("              " + softShadow.getReportText())
@@ -0,0 +1,138 @@
+import sys
+import time
+import contextlib
+import numpy as np
+import raytracer
+import raytracer_image
+
+# 画素ごとのレイの統計 (必要なときだけ Scene.stats に設定する)
+# 画素ごと・種類ごと (一次レイ・影のレイ・反射レイ) に、追跡したレイの数と物体との交差判定の回数を数える
+# エンジンはレイの配列を部分集合に分けながら処理するので、いま処理しているレイがどの画素のものか
+# (owner) を scope() で絞り込みながら数える。Scene.stats が None のときエンジンは何もしない
+
+KINDS = ("primary", "shadow", "reflection")
+
+class RayStats:
+	def __init__(self):
+		self.shape = (0, 0)	# 画面の大きさ (H, W)
+		self.pixelSize = 1.0	# 1画素の大きさ (スクリーン座標の単位)
+		self.rays = {}	# 種類 -> 画素ごとのレイの数 (H*W,)
+		self.tests = {}	# 種類 -> 画素ごとの交差判定の回数 (H*W,)
+		self.owner = None	# いま処理しているレイの画素の番号 (None なら数えない)
+		self.kind = None	# いま処理しているレイの種類
+		self.frames = 0	# 数え終わったフレームの数
+		self.lastTotals = None	# 直前のフレームの合計
+		self.startTime = 0.0
+		self.beginFrame(0, 0)
+
+	# キャッシュのキー (raytracer_cache) には結果に影響しないので含めない
+	def __repr__(self):
+		return "RayStats()"
+
+	# 新しいフレームを数え始める
+	def beginFrame(self, height, width, pixelSize=1.0):
+		self.shape = (height, width)
+		self.pixelSize = pixelSize
+		for kind in KINDS:
+			self.rays[kind] = np.zeros(height * width, dtype=np.int64)
+			self.tests[kind] = np.zeros(height * width, dtype=np.int64)
+		self.startTime = time.perf_counter()
+
+	# フレームを数え終える。合計を lastTotals に残す
+	def endFrame(self):
+		self.frames += 1
+		self.lastTotals = self.getTotals()
+		self.lastTotals["seconds"] = time.perf_counter() - self.startTime
+		return self.lastTotals
+
+	# スクリーン座標 xs, ys のサンプルが含まれる画素の番号 (フレームを数え始めていなければ None)
+	def getPixels(self, xs, ys):
+		height, width = self.shape
+		if height * width == 0:
+			return None
+		cols = np.rint(np.divide(xs, self.pixelSize)).astype(np.int64) + (width - 1) // 2
+		rows = np.rint(np.divide(ys, self.pixelSize)).astype(np.int64) + (height - 1) // 2
+		return (rows * width + cols).reshape(-1)
+
+	# 処理するレイを絞り込む
+	# pixels: 画素の番号の配列 (画面全体での番号)。subset: いまのレイのうちの一部 (番号か bool の配列)
+	@contextlib.contextmanager
+	def scope(self, subset=None, kind=None, pixels=None):
+		saved = (self.owner, self.kind)
+		if pixels is not None:
+			self.owner = np.asarray(pixels).reshape(-1)
+		elif subset is not None and self.owner is not None:
+			self.owner = self.owner[np.asarray(subset).reshape(-1)]
+		self.kind = kind or self.kind
+		try:
+			yield
+		finally:
+			self.owner, self.kind = saved
+
+	# いまのレイについて、レイの数と交差判定の回数を足す (値はレイごとの配列か全てのレイに共通の数)
+	def count(self, rays=0, tests=0):
+		if self.owner is None or len(self.owner) == 0:
+			return
+		size = len(self.rays[self.kind])
+		for target, value in [(self.rays, rays), (self.tests, tests)]:
+			if np.ndim(value) == 0:
+				if value:
+					target[self.kind] += np.bincount(self.owner, minlength=size) * int(value)
+			else:
+				target[self.kind] += np.bincount(self.owner, weights=np.reshape(value, -1), minlength=size).astype(np.int64)
+
+	# 種類ごとのレイの数と交差判定の回数の合計
+	def getTotals(self):
+		totals = {}
+		for kind in KINDS:
+			totals[kind + "Rays"] = int(self.rays[kind].sum())
+			totals[kind + "Tests"] = int(self.tests[kind].sum())
+		totals["pixels"] = self.shape[0] * self.shape[1]
+		return totals
+
+	# 画素ごとの値 (H, W)。what は "rays" か "tests"、kind が None なら全ての種類の合計
+	def getImage(self, what="tests", kind=None):
+		source = self.rays if what == "rays" else self.tests
+		kinds = KINDS if kind is None else [kind]
+		return sum(source[k] for k in kinds).reshape(self.shape)
+
+	# 統計を1行の文字列にする
+	def getReportText(self):
+		t = self.lastTotals or self.getTotals()
+		pixels = max(t["pixels"], 1)
+		text = ", ".join(f"{kind} {t[kind + 'Rays']} rays / {t[kind + 'Tests']} tests" for kind in KINDS)
+		cost = self.getImage()
+		peak = int(cost.max()) if cost.size else 0
+		return f"RayStats: {text}, {sum(t[k + 'Tests'] for k in KINDS) / pixels:.1f} tests/pixel (max {peak})"
+
+	# 画素ごとの交差判定の回数を疑似カラーの画像にする (最大の画素を 1.0 とする)
+	def getHeatmap(self, what="tests", kind=None):
+		cost = self.getImage(what, kind).astype(np.float64)
+		peak = cost.max() if cost.size else 0.0
+		return raytracer_image.getFalseColor(cost / peak if peak > 0.0 else cost)
+
+	# ヒートマップを PNG ファイルに保存する
+	def saveHeatmap(self, path, what="tests", kind=None):
+		raytracer_image.savePNG(path, self.getHeatmap(what, kind))
+
+# 使い方: python raytracer_stats.py [スクリプト名 [heatmap.png]]
+# スクリプトのシーンを統計ありで描画して合計を表示し、交差判定の回数のヒートマップを保存する
+# 統計なしの描画時間と比べて、数えない場合に遅くならないことも確認する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_task3"
+	path = sys.argv[2] if len(sys.argv) > 2 else f"heatmap_{name}.png"
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	halfWidth, halfHeight = int(tracer.g_HalfWidth), int(tracer.g_HalfHeight)
+
+	times = []
+	for stats in [None, RayStats()]:
+		scene.stats = stats
+		raytracer.renderFrame(scene, halfWidth, halfHeight)
+		start = time.perf_counter()
+		raytracer.renderFrame(scene, halfWidth, halfHeight)
+		times.append(time.perf_counter() - start)
+	print(f"{name}: without stats {times[0] * 1000:.1f} ms, with stats {times[1] * 1000:.1f} ms")
+	print(scene.stats.getReportText())
+	scene.stats.saveHeatmap(path)
+	print(f"heatmap: {path}")
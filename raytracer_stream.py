@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import raytracer
+import raytracer_bench
+import raytracer_image
+
+# メモリに載らない大きさの画像 (16k x 16k のポスターなど) の描画
+# 画面を横長の帯 (数行ずつ) に分けて上から順に描画し、描き終わった帯をすぐに出力先に書き出す
+# 出力は PNG (raytracer_image.PNGWriter で圧縮しながら書く) か、.npy のシーンの精度の配列 (帯ごとに memmap で書く)
+# 手元に置くのは1つの帯とその計算の作業用の配列だけなので、メモリの使用量は画像の大きさではなく帯の大きさで決まる
+
+g_BandPixels = 1 << 16	# 1つの帯の画素数の目安 (帯の行数 = これ / 画面の幅)。作業用のメモリはこれに比例する
+RAW_EXTENSION = ".npy"
+
+# 画像を帯ごとに .npy ファイルに書き出す (np.load(path, mmap_mode="r") で読める)
+# 帯ごとにその範囲だけを memmap して書き込み、閉じてから次の帯に進むので、書き込んだページはメモリに残らない
+# dtype はシーンの精度 (scene.dtype) にすると renderFrame と同じ値になる
+class RawWriter:
+	def __init__(self, path, width, height, dtype):
+		self.path = path
+		self.width = width
+		self.height = height
+		self.dtype = np.dtype(dtype)
+		self.top = height	# まだ書いていない行の上端 (上の帯から順に書く)
+		image = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(height, width, 3))
+		self.offset = image.offset	# ヘッダーの後の配列の位置
+		del image
+
+	def write(self, band):
+		rows = (self.top - len(band), self.top)
+		if band.shape[1:] != (self.width, 3) or rows[0] < 0:
+			raise ValueError(f"band {band.shape} does not fit the {self.width}x{self.height} image")
+		rowBytes = self.width * 3 * self.dtype.itemsize
+		target = np.memmap(self.path, dtype=self.dtype, mode="r+", offset=self.offset + rows[0] * rowBytes, shape=band.shape)
+		target[:] = band
+		target.flush()
+		del target
+		self.top = rows[0]
+
+	def close(self):
+		if self.top != 0:
+			raise ValueError(f"{self.path}: {self.height - self.top} of {self.height} rows written")
+
+# 出力先の拡張子に合わせた書き出し (.npy なら RawWriter、それ以外は PNG)
+def openWriter(path, width, height, dtype):
+	if path.endswith(RAW_EXTENSION):
+		return RawWriter(path, width, height, dtype)
+	return raytracer_image.PNGWriter(path, width, height)
+
+# 画面の上の帯から順に、帯の行の範囲 (開始, 終了) を返す (行 0 が画面の下端)
+def getBands(height, bandRows):
+	return [(max(0, top - bandRows), top) for top in range(height, 0, -bandRows)]
+
+# 画面を帯ごとに描画して writer に書き出し、描画の統計を返す
+def renderStream(scene, halfWidth, halfHeight, writer, antiAliasing=False, bandPixels=None, log=None):
+	width, height = 2 * halfWidth + 1, 2 * halfHeight + 1
+	bandRows = max(1, (bandPixels or g_BandPixels) // width)
+	bands = getBands(height, bandRows)
+	start = time.perf_counter()
+	for k, rows in enumerate(bands):
+		writer.write(raytracer.renderRegion(scene, halfWidth, halfHeight, antiAliasing, rows))
+		if log is not None and (k + 1) % max(1, len(bands) // 10) == 0:
+			print(f"  {rows[0] * 100 // height:3d}% left, {time.perf_counter() - start:.1f} s, "
+				f"peak RSS {raytracer_bench.getPeakRss() / 1024:.0f} MB", file=log)
+	writer.close()
+	return {"width": width, "height": height, "bands": len(bands), "bandRows": bandRows,
+		"seconds": time.perf_counter() - start, "maxRssKilobytes": raytracer_bench.getPeakRss()}
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="render a week7 / week8 scene in bands streamed to a PNG or .npy file")
+	parser.add_argument("scene", help="script name or scene file (.json / .rtscene)")
+	parser.add_argument("output", help="output file (.png, or .npy for pixels in the scene's precision)")
+	parser.add_argument("--size", type=int, default=2000, help="half width of the screen")
+	parser.add_argument("--height", type=int, default=None, help="half height of the screen (default: --size)")
+	parser.add_argument("--aa", choices=["on", "off"], help="3x3 supersampling (default: the script's g_AntiAliasing)")
+	parser.add_argument("--band", type=int, default=g_BandPixels, help="pixels per band")
+	parser.add_argument("--scaling", help="comma separated half widths: render each in a fresh process and compare peak RSS")
+	parser.add_argument("--json", action="store_true", help="print the statistics as JSON")
+	args = parser.parse_args(argv)
+
+	if args.scaling:
+		# サイズごとに別のプロセスで描画し、ピーク RSS が画像の大きさで増えないことを確かめる
+		print(f"{'size':>13} {'pixels':>12} {'bands':>6} {'seconds':>8} {'peak RSS':>10}")
+		for size in [int(a) for a in args.scaling.split(",")]:
+			command = [sys.executable, os.path.abspath(__file__), args.scene, args.output, "--size", str(size),
+				"--band", str(args.band), "--json"] + ([] if args.aa is None else ["--aa", args.aa])
+			stats = json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+			print(f"{stats['width']:>6}x{stats['height']:<6} {stats['width'] * stats['height']:>12} {stats['bands']:>6} "
+				f"{stats['seconds']:>8.2f} {stats['maxRssKilobytes'] / 1024:>7.0f} MB")
+		return
+
+	tracer, scene = raytracer_bench.loadCase(args.scene)
+	antiAliasing = bool(getattr(tracer, "g_AntiAliasing", False)) if args.aa is None else args.aa == "on"
+	halfHeight = args.height or args.size
+	writer = openWriter(args.output, 2 * args.size + 1, 2 * halfHeight + 1, scene.dtype)
+	stats = renderStream(scene, args.size, halfHeight, writer, antiAliasing, args.band, None if args.json else sys.stderr)
+	if args.json:
+		print(json.dumps(stats))
+		return
+	print(f"{args.output}: {stats['width']}x{stats['height']} AA={'ON' if antiAliasing else 'OFF'} in {stats['seconds']:.1f} s, "
+		f"{stats['bands']} bands of {stats['bandRows']} rows, peak RSS {stats['maxRssKilobytes'] / 1024:.0f} MB")
+
+# 使い方: python raytracer_stream.py week8_task4 poster.png --size 8000 --aa on
+#         python raytracer_stream.py week8_task4 poster.npy --size 8000          シーンの精度の画素を .npy に書き出す
+#         python raytracer_stream.py week8_task4 /tmp/out.png --scaling 250,500,1000,2000   サイズごとのピーク RSS を比べる
+if __name__ == "__main__":
+	main(sys.argv[1:])
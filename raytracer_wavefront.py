@@ -0,0 +1,132 @@
+import sys
+import time
+import numpy as np
+import raytracer
+
+# 反射の多重反射をウェーブフロント方式で計算する
+# 反射の段 (バウンス) ごとに、まだ生きているレイを配列にまとめて球と床に対して一度に追跡する
+# 何にも当たらないレイ・床に当たったレイ・重みが小さくなったレイは次の段の配列から取り除く
+# 色は最後の段から順に、week8_advanced2 と同じ式 (1-w)I + w(I+C)/2 で手前の交点へ混ぜていく
+
+g_Depth = 4	# 反射を追う最大の段数
+g_MinWeight = 0.01	# 反射レイの重み (画素の色への寄与) がこれより小さくなったら追跡をやめる
+
+class Wavefront:
+	def __init__(self, depth=None, minWeight=None):
+		self.depth = depth or g_Depth
+		self.minWeight = g_MinWeight if minWeight is None else minWeight
+		self.resetStats()
+
+	# これまでの統計を 0 に戻す
+	def resetStats(self):
+		self.bounceRays = np.zeros(self.depth, dtype=np.int64)	# 段ごとに追跡したレイの数
+		self.bounceSeconds = np.zeros(self.depth)	# 段ごとの追跡時間 [秒]
+		self.terminated = 0	# 重みが小さくて打ち切ったレイの数
+
+	# キャッシュのキー (raytracer_cache) に使う表現。結果は段数と打ち切りの重みで決まる
+	def __repr__(self):
+		return f"Wavefront(depth={self.depth}, minWeight={self.minWeight})"
+
+	# 球の交点の色 I (打ち切り前) に反射の映り込みを加える (raytracer.addFloorReflection の代わり)
+	def shade(self, scene, I, intersection, ray, normal):
+		w = scene.reflectionWeight
+		levels = []	# 段ごとの (親の番号, 当たった物体の色 (打ち切り前), 球に当たったか)
+		weight = np.ones(len(I))
+		live = np.arange(len(I))	# 反射レイを出す交点 (前の段の配列の番号)
+		root = np.arange(len(I))	# 反射レイを出す交点の、最初の交点 I での番号 (画素ごとの統計用)
+		point, direction, n = intersection, ray, normal
+
+		for bounce in range(self.depth):
+			# 寄与が小さいレイは追跡しない
+			weight = weight * (0.5 * w)
+			keep = weight >= self.minWeight
+			self.terminated += int(np.count_nonzero(~keep))
+			live, weight, root = live[keep], weight[keep], root[keep]
+			if len(live) == 0:
+				break
+
+			start = time.perf_counter()
+			d, n = direction[keep], n[keep]
+			v = raytracer.normalize(d - 2.0 * raytracer.dot(d, n)[..., np.newaxis] * n)
+			p = point[keep] + scene.epsilon * v
+
+			# 球と床のうち近い方に当たる
+			with raytracer.statsScope(scene, root):
+				raytracer.countStats(scene, rays=1)
+				t_sphere, index = raytracer.intersectSpheres(scene, p, v)
+				t_floor = raytracer.intersectBoard(scene, p, v)
+			on_floor = (t_floor > 0.0) & ((index < 0) | (t_floor < t_sphere))
+			on_sphere = (index >= 0) & ~on_floor
+			hit = on_sphere | on_floor
+
+			color = np.zeros((len(v), 3), dtype=scene.dtype)
+			if np.any(on_floor):
+				with raytracer.statsScope(scene, root[on_floor]):
+					color[on_floor] = raytracer.shadeFloor(scene, p[on_floor] + t_floor[on_floor][..., np.newaxis] * v[on_floor],
+						ray=v[on_floor])
+			if np.any(on_sphere):
+				x = p[on_sphere] + t_sphere[on_sphere][..., np.newaxis] * v[on_sphere]
+				with raytracer.statsScope(scene, root[on_sphere]):
+					color[on_sphere] = raytracer.shadeSpheres(scene, index[on_sphere], x, v[on_sphere])
+			levels.append((live[hit], color[hit], on_sphere[hit]))
+
+			self.bounceRays[bounce] += len(v)
+			raytracer.g_RayCounts["reflection"] += len(v)
+			self.bounceSeconds[bounce] += time.perf_counter() - start
+
+			# 球に当たったレイだけが次の段の反射レイを出す (床は反射しない)
+			point = p[on_sphere] + t_sphere[on_sphere][..., np.newaxis] * v[on_sphere]
+			direction = v[on_sphere]
+			n = raytracer.normalize(point - scene.centers[index[on_sphere]])
+			live = np.flatnonzero(on_sphere[hit])
+			weight = weight[on_sphere]
+			root = root[on_sphere]
+
+		# 最後の段から順に、当たった物体の色を親の交点の色へ混ぜる (球の色はそこで 1.0 で打ち切る)
+		result = None
+		for depth in range(len(levels) - 1, -1, -1):
+			parent, color, on_sphere = levels[depth]
+			if result is not None:
+				child = levels[depth + 1][0]
+				color[child] = self.mix(w, color[child], result)
+			result = np.where(on_sphere[..., np.newaxis], np.minimum(color, 1.0), color)
+		if result is None:
+			return I
+
+		I = I.copy()
+		I[levels[0][0]] = self.mix(w, I[levels[0][0]], result)
+		return I
+
+	# 交点の色 I に反射先の色 C を混ぜる (week8_advanced2 と同じ計算の順序)
+	@staticmethod
+	def mix(w, I, C):
+		return (1.0 - w) * I + w * ((I + C) / 2.0)
+
+	# 段ごとの統計を文字列の行のリストにする
+	def getReportLines(self):
+		lines = [f"Wavefront: depth {self.depth}, min weight {self.minWeight}, {self.terminated} rays terminated by weight"]
+		for bounce in range(self.depth):
+			rays = int(self.bounceRays[bounce])
+			seconds = self.bounceSeconds[bounce]
+			rate = rays / seconds if seconds > 0.0 else 0.0
+			lines.append(f"  bounce {bounce + 1}: {rays} rays, {seconds * 1000:.1f} ms, {rate / 1.0e6:.2f} Mrays/s")
+		return lines
+
+# 使い方: python raytracer_wavefront.py [スクリプト名 [反射の重み [段数 ...]]]
+# スクリプトのシーンに反射を付けて、段数ごとの描画時間と段ごとのレイの処理速度を表示する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_advanced1"
+	weight = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+	depths = [int(a) for a in sys.argv[3:]] or [1, 2, 4, 8]
+	tracer = raytracer.loadTracer(name)
+	scene = tracer.getScene()
+	scene.reflectionWeight = weight
+	halfWidth, halfHeight = int(tracer.g_HalfWidth), int(tracer.g_HalfHeight)
+
+	for depth in depths:
+		scene.reflections = Wavefront(depth)
+		start = time.perf_counter()
+		raytracer.renderFrame(scene, halfWidth, halfHeight)
+		print(f"{name} depth {depth}: {(time.perf_counter() - start) * 1000:.1f} ms")
+		for line in scene.reflections.getReportLines():
+			print("  " + line)
@@ -0,0 +1,130 @@
+import sys
+import time
+import threading
+import raytracer
+import raytracer_cache
+import raytracer_progressive
+
+# 別スレッドでの描画 (GLUT のメインループは表示とキー入力だけを行い、描画中もウィンドウが固まらない)
+# 描画は raytracer_progressive.ProgressiveRender のスライス (数千本のレイの帯) に分けて進め、
+# スライスが終わるたびに共有の途中経過の画像に書き込み、version を1つ増やして知らせる
+# 新しい描画を頼む・取りやめると世代 (generation) が変わり、計算中の描画は次のスライスの区切りで止まる
+
+g_SliceBudget = 0.01	# 取りやめを確かめる間隔の目安 [秒] (この時間ごとにスライスの区切りで世代を確かめる)
+
+class RenderWorker:
+	def __init__(self, log=sys.stdout):
+		self.condition = threading.Condition()
+		self.generation = 0	# 描画を頼む・取りやめるたびに増える
+		self.pending = None	# まだ始めていない描画 (ProgressiveRender)
+		self.render = None	# 表示する描画 (計算中か最後に終わったもの)
+		self.version = 0	# 途中経過の画像が更新されるたびに増える
+		self.busy = False	# 計算中か
+		self.log = log
+		self.thread = threading.Thread(target=self.run, daemon=True)	# メインスレッドが終わると一緒に終わる
+		self.thread.start()
+
+	# 描画を頼む (計算中の描画は取りやめる)。同じシーンを描画したことがあれば覚えておいた画像を使う
+	# adaptive, tileRenderer: 最後のアンチエイリアシングの段階の計算方法 (raytracer_progressive.ProgressiveRender)
+	def submit(self, scene, halfWidth, halfHeight, antiAliasing=False, adaptive=None, tileRenderer=None):
+		render = raytracer_progressive.ProgressiveRender(scene, halfWidth, halfHeight, antiAliasing,
+			adaptive=adaptive, tileRenderer=tileRenderer)
+		image = raytracer_cache.getFrame(scene, halfWidth, halfHeight, antiAliasing, render.mode)
+		with self.condition:
+			self.generation += 1
+			self.render = render
+			self.version += 1
+			if image is not None:
+				render.useImage(image)
+				self.pending = None
+			else:
+				self.pending = render
+				self.condition.notify()
+		return render
+
+	# 計算中の描画を取りやめる (表示中の画像はそのまま残す)
+	def cancel(self):
+		with self.condition:
+			self.generation += 1
+			self.pending = None
+
+	# 表示する途中経過の画像と version (描画がなければ (None, version))
+	def getImage(self):
+		with self.condition:
+			render, version = self.render, self.version
+		return (None if render is None else render.getImage()), version
+
+	def isCurrent(self, generation):
+		return generation == self.generation
+
+	# スレッドの本体: 頼まれた描画をスライスごとに進め、世代が変わったら止める
+	def run(self):
+		while True:
+			with self.condition:
+				while self.pending is None:
+					self.condition.wait()
+				render, generation = self.pending, self.generation
+				self.pending = None
+				self.busy = True
+
+			while not render.done and self.isCurrent(generation):
+				render.step(g_SliceBudget)
+				with self.condition:
+					self.version += 1
+
+			with self.condition:
+				self.busy = self.pending is not None
+			if not render.done:
+				print(f"RenderWorker: cancelled after {render.elapsed * 1000:.0f} ms", file=self.log)
+				continue
+			print(f"RenderWorker: {render.width}x{render.height} done in {render.elapsed * 1000:.0f} ms", file=self.log)
+			if render.scene.stats is not None:
+				print(render.scene.stats.getReportText(), file=self.log)
+			raytracer_cache.putFrame(render.scene, render.halfWidth, render.halfHeight, render.image, render.antiAliasing,
+				render.mode)
+
+	# 計算中の描画が終わるか取りやめられるまで待つ (timeout 秒で諦めたら False)
+	def wait(self, timeout=None):
+		deadline = None if timeout is None else time.perf_counter() + timeout
+		while True:
+			with self.condition:
+				if not self.busy and self.pending is None:
+					return True
+			if deadline is not None and time.perf_counter() > deadline:
+				return False
+			time.sleep(0.001)
+
+# 使い方: python raytracer_worker.py [スクリプト名 [halfWidth]]
+# 別スレッドで描画しながらメインスレッドが応答し続けること (メインスレッドの1回の待ち時間の最大) と、
+# 描画を取りやめてから計算が止まるまでの時間を表示する
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "week8_task4"
+	halfWidth = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	tracer = raytracer.loadTracer(name)
+	worker = RenderWorker()
+
+	# メインスレッドは 16 ms ごとに画像を取り出す (GLUT の表示の代わり)。1回の間隔の最大を測る
+	render = worker.submit(tracer.getScene(), halfWidth, halfWidth, antiAliasing=True)
+	start = time.perf_counter()
+	last = start
+	longest = 0.0
+	frames = 0
+	while not render.done:
+		time.sleep(0.016)
+		image, version = worker.getImage()
+		now = time.perf_counter()
+		longest = max(longest, now - last)
+		last = now
+		frames += 1
+	worker.wait()
+	print(f"main thread: {frames} frames presented while rendering, longest gap {longest * 1000:.1f} ms")
+
+	# 描画を始めてすぐ取りやめ、計算が止まるまでの時間を測る
+	scene = tracer.getScene()
+	scene.shininess += 1	# キャッシュに当たらないようにシーンを変える
+	worker.submit(scene, halfWidth, halfWidth, antiAliasing=True)
+	time.sleep(0.2)
+	start = time.perf_counter()
+	worker.cancel()
+	worker.wait()
+	print(f"cancel: worker stopped {(time.perf_counter() - start) * 1000:.1f} ms after the request")
@@ -3,6 +3,10 @@ import numpy as np
 from OpenGL.GLUT import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
+import raytracer
+import raytracer_gl
+import raytracer_cache
+import raytracer_packet
 
 # 3次元ベクトルを作る
 def vec3(x, y, z):
@@ -48,6 +52,15 @@ g_Ks = 0.8  # 鏡面反射定数
 g_Iin = 1.0 # 入射光の強さ 
 g_Ia  = 0.2 # 環境光
 
+# 描画方法の設定
+g_UseEngine = True  # True: ベクトル化エンジンで画面全体を計算, False: getPixelColor で1画素ずつ計算
+g_Progressive = True  # True: 粗い画像から段階的に描画する (ベクトル化エンジンのみ)
+g_DynamicResolution = False  # True: 描画時間が g_TargetFrameTime に収まるように解像度を自動で下げる (ベクトル化エンジンのみ)
+g_TargetFrameTime = 1.0 / 30.0  # 目標のフレーム時間 [秒]
+g_UsePackets = True  # True: 一次レイを画面のブロックごとにまとめて視錐台で球を絞り込む (ベクトル化エンジンのみ)
+g_PacketSize = 8  # パケットの一辺の画素数 (8 か 16)
+g_PacketTracer = raytracer_packet.PacketTracer(g_PacketSize)	# パケットごとの統計を描画をまたいで持つ
+
 g_Viewpoint = vec3(0., 0., 0.)	# 視点位置
 g_LightDirection = vec3(-2., -4., -2.)	# 入射光の進行方向
 
@@ -92,25 +105,55 @@ def getPixelColor(x, y):
 	return vec3(0.0, 0.0, 0.0)	# 背景色
 
 
+# ベクトル化エンジン (raytracer.py) 用にこのシーンを記述する
+def getScene():
+	scene = raytracer.Scene([g_Sphere], None, g_LightDirection,
+		viewpoint=g_Viewpoint, distance=g_Distance, shininess=g_Shininess,
+		kd=g_Kd, ks=g_Ks, iin=g_Iin, ia=g_Ia)
+
+	# 一次レイのパケット追跡
+	if g_UsePackets:
+		scene.packets = g_PacketTracer
+	return scene
+
 def display():
 	glClear(GL_COLOR_BUFFER_BIT)
 
-	glBegin(GL_POINTS)
-	for y in range(-g_HalfHeight, g_HalfHeight+1):
-		for x in range(-g_HalfWidth, g_HalfWidth+1):
-			colorVec = getPixelColor(x, y)	# 座標 (x, y) の色を取得する
-			glColor3dv(colorVec)	# (x, y) の画素を描画
-			glVertex2i(x, y)
-	glEnd()
+	if g_DynamicResolution and g_UseEngine:
+		# 解像度の自動調整: 縮小した解像度で描画し、ウィンドウの大きさに拡大して表示する
+		raytracer_gl.displayDynamic(getScene(), g_HalfWidth, g_HalfHeight, g_TargetFrameTime)
+		glFlush()
+		return
+
+	if g_Progressive and g_UseEngine:
+		# 段階的描画: 途中経過の画像を表示し、計算は idle コールバックで進める
+		raytracer_gl.displayProgressive(getScene, g_HalfWidth, g_HalfHeight)
+		glFlush()
+		return
+
+	# 画面全体の色をまとめて計算する (シーンが前と同じなら覚えておいた画像を使う)
+	scene = getScene()
+	mode = "engine" if g_UseEngine else "reference"
+	image = raytracer_cache.getFrame(scene, g_HalfWidth, g_HalfHeight, mode=mode)
+	if image is None:
+		if g_UseEngine:
+			image = raytracer.renderFrame(scene, g_HalfWidth, g_HalfHeight)
+		else:
+			image = raytracer.renderReference(getPixelColor, g_HalfWidth, g_HalfHeight)
+		raytracer_cache.putFrame(scene, g_HalfWidth, g_HalfHeight, image, mode=mode)
+
+	# 計算した画像をまとめてウィンドウに転送する
+	raytracer_gl.presentFrame(image, g_HalfWidth, g_HalfHeight)
 	glFlush()
 
 
 # ウィンドウのサイズが変更されたときの処理
 def resize(w, h):
+    global g_HalfWidth, g_HalfHeight
     if h > 0:
         glViewport(0, 0, w, h)
-        g_HalfWidth = w / 2
-        g_HalfHeight = h / 2
+        g_HalfWidth = w // 2
+        g_HalfHeight = h // 2
         glViewport(0, 0, w, h)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -119,12 +162,35 @@ def resize(w, h):
         glOrtho(-g_HalfWidth, g_HalfWidth, -g_HalfHeight, g_HalfHeight, -10, 10)
         glMatrixMode(GL_MODELVIEW)
 
+        # 描画する画素数がウィンドウに合わせて変わるので、計算中の描画は最初からやり直す
+        raytracer_gl.cancelProgressive()
+
 # キーが押されたときのイベント処理
 def keyboard(key, x, y): 
+	global g_UseEngine, g_Progressive, g_UsePackets, g_DynamicResolution
+
 	if key in [b'q', b'Q', b'\x1b']: #b'\x1b'は ESC の ASCII コード
 		glutDestroyWindow(g_WindowID)
 		return
-
+	elif key in [b'v', b'V']:
+		# ベクトル化エンジンと getPixelColor の切り替え
+		g_UseEngine = not g_UseEngine
+		print(f"UseEngine: {'ON' if g_UseEngine else 'OFF'}")
+	elif key in [b'p', b'P']:
+		# 段階的描画の切り替え
+		g_Progressive = not g_Progressive
+		print(f"Progressive: {'ON' if g_Progressive else 'OFF'}")
+	elif key in [b'r', b'R']:
+		# 解像度の自動調整の切り替え
+		g_DynamicResolution = not g_DynamicResolution
+		print(f"DynamicResolution: {'ON' if g_DynamicResolution else 'OFF'}")
+	elif key in [b'k', b'K']:
+		# パケット追跡の切り替え (これまでの統計を表示する)
+		g_UsePackets = not g_UsePackets
+		print(f"UsePackets: {'ON' if g_UsePackets else 'OFF'}")
+		print(g_PacketTracer.getReportText())
+
+	raytracer_gl.cancelProgressive()	# 計算中の描画を取りやめて最初からやり直す
 	glutPostRedisplay()
 
 if __name__ == "__main__":
@@ -3,6 +3,10 @@ import numpy as np
 from OpenGL.GLUT import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
+import raytracer
+import raytracer_gl
+import raytracer_cache
+import raytracer_parallel
 
 # 3次元ベクトルを作る
 def vec3(x, y, z):
@@ -86,6 +90,19 @@ g_Ia  = 0.2 # 環境光
 
 # アンチエイリアシングの設定
 g_AntiAliasing = True  # True: アンチエイリアシング有効, False: 無効
+g_AdaptiveAA = True  # True: 周囲と差のある画素だけをサンプリングし直す, False: 全画素を3x3でサンプリング
+g_AAContrast = 0.05  # 適応的アンチエイリアシングで計算し直す色の差のしきい値
+g_AAGridSize = 3  # 計算し直す画素のサンプル数 (g_AAGridSize x g_AAGridSize)
+g_FloorFilter = False  # True: 床の格子模様を画素の範囲で平均した色にする (1画素1サンプルでも床がちらつかない。ベクトル化エンジンのみ)
+
+# 描画方法の設定
+g_UseEngine = True  # True: ベクトル化エンジンで画面全体を計算, False: getPixelColor で1画素ずつ計算
+g_Progressive = True  # True: 粗い画像から段階的に描画する (ベクトル化エンジンのみ)
+g_DynamicResolution = False  # True: 描画時間が g_TargetFrameTime に収まるように解像度を自動で下げる (ベクトル化エンジンのみ)
+g_TargetFrameTime = 1.0 / 30.0  # 目標のフレーム時間 [秒]
+g_ParallelWorkers = raytracer_parallel.g_Workers  # タイル並列計算のプロセス数 (1 以下なら並列化しない)
+g_TileSize = 32  # タイル並列計算のタイルの一辺の画素数
+g_TileRenderer = None  # タイル並列計算用のプロセスプール (最初の描画時に作る)
 
 g_Viewpoint = vec3(0., 0., 0.)	# 視点位置
 g_LightDirection = vec3(-2., -4., -2.)	# 入射光の進行方向
@@ -170,35 +187,75 @@ def getPixelColor(x, y):
 	# 何とも交差しない
 	return vec3(0.0, 0.0, 0.0)	# 背景色
 
+# ベクトル化エンジン (raytracer.py) 用にこのシーンを記述する
+def getScene():
+	return raytracer.Scene([g_Sphere], g_Board, g_LightDirection,
+		viewpoint=g_Viewpoint, distance=g_Distance, shininess=g_Shininess,
+		kd=g_Kd, ks=g_Ks, iin=g_Iin, ia=g_Ia,
+		floorColors=((1.0, 1.0, 0.7), (0.6, 0.6, 0.6)), checkerSize=100, shadow=True,
+		floorFilter=g_FloorFilter)
+
+# タイル並列計算用のプロセスプールを返す
+def getTileRenderer():
+	global g_TileRenderer
+
+	if g_TileRenderer is None:
+		g_TileRenderer = raytracer_parallel.TileRenderer(g_ParallelWorkers, g_TileSize)
+	return g_TileRenderer
+
 def display():
 	glClear(GL_COLOR_BUFFER_BIT)
 
-	glBegin(GL_POINTS)
-	for y in range(-g_HalfHeight, g_HalfHeight+1):
-		for x in range(-g_HalfWidth, g_HalfWidth+1):
-			if g_AntiAliasing:
-				# 3x3スーパーサンプリング
-				# 各ピクセルを9分割してサンプリング
-				color_sum = vec3(0., 0., 0.)
-				for dy in [-1./3., 0., 1./3.]:
-					for dx in [-1./3., 0., 1./3.]:
-						color_sum += getPixelColor(x + dx, y + dy)
-				colorVec = color_sum / 9.0  # 9つの平均値
-			else:
-				# アンチエイリアシングなし
-				colorVec = getPixelColor(x, y)
-
-			glColor3dv(colorVec)	# (x, y) の画素を描画
-			glVertex2i(x, y)
-	glEnd()
+	if g_DynamicResolution and g_UseEngine:
+		# 解像度の自動調整: 縮小した解像度で描画し、ウィンドウの大きさに拡大して表示する
+		raytracer_gl.displayDynamic(getScene(), g_HalfWidth, g_HalfHeight, g_TargetFrameTime, g_AntiAliasing)
+		glFlush()
+		return
+
+	if g_Progressive and g_UseEngine:
+		# 段階的描画: 途中経過の画像を表示し、計算は idle コールバックで進める
+		# 最後のアンチエイリアシングの段階は、適応的アンチエイリアシングかタイル並列計算で行う
+		adaptive = (g_AAContrast, g_AAGridSize) if g_AdaptiveAA else None
+		tileRenderer = getTileRenderer() if g_AntiAliasing and g_ParallelWorkers > 1 else None
+		raytracer_gl.displayProgressive(getScene, g_HalfWidth, g_HalfHeight, g_AntiAliasing, adaptive, tileRenderer)
+		glFlush()
+		return
+
+	# 画面全体の色をまとめて計算する (シーンが前と同じなら覚えておいた画像を使う)
+	scene = getScene()
+	adaptive = g_AntiAliasing and g_AdaptiveAA and g_UseEngine
+	if adaptive:
+		mode = f"adaptive:{g_AAContrast}:{g_AAGridSize}"
+	else:
+		mode = "engine" if g_UseEngine else "reference"
+	image = raytracer_cache.getFrame(scene, g_HalfWidth, g_HalfHeight, g_AntiAliasing, mode)
+
+	if image is None:
+		if adaptive:
+			# 適応的アンチエイリアシング
+			image, stats = raytracer.renderAdaptive(scene, g_HalfWidth, g_HalfHeight, g_AAContrast, g_AAGridSize)
+			print(raytracer.getAdaptiveReportText(stats))
+		elif g_ParallelWorkers > 1:
+			# タイルに分けて複数のプロセスで計算する (結果は逐次計算とビット単位で一致する)
+			image = getTileRenderer().render(scene if g_UseEngine else None, g_HalfWidth, g_HalfHeight,
+				g_AntiAliasing, getPixelColor)
+		elif g_UseEngine:
+			image = raytracer.renderFrame(scene, g_HalfWidth, g_HalfHeight, g_AntiAliasing)
+		else:
+			image = raytracer.renderReference(getPixelColor, g_HalfWidth, g_HalfHeight, g_AntiAliasing)
+		raytracer_cache.putFrame(scene, g_HalfWidth, g_HalfHeight, image, g_AntiAliasing, mode)
+
+	# 計算した画像をまとめてウィンドウに転送する
+	raytracer_gl.presentFrame(image, g_HalfWidth, g_HalfHeight)
 	glFlush()
 
 # ウィンドウのサイズが変更されたときの処理
 def resize(w, h):
+    global g_HalfWidth, g_HalfHeight
     if h > 0:
         glViewport(0, 0, w, h)
-        g_HalfWidth = w / 2
-        g_HalfHeight = h / 2
+        g_HalfWidth = w // 2
+        g_HalfHeight = h // 2
         glViewport(0, 0, w, h)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -207,9 +264,12 @@ def resize(w, h):
         glOrtho(-g_HalfWidth, g_HalfWidth, -g_HalfHeight, g_HalfHeight, -10, 10)
         glMatrixMode(GL_MODELVIEW)
 
+        # 描画する画素数がウィンドウに合わせて変わるので、計算中の描画は最初からやり直す
+        raytracer_gl.cancelProgressive()
+
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
-	global g_AntiAliasing
+	global g_AntiAliasing, g_UseEngine, g_Progressive, g_AdaptiveAA, g_DynamicResolution, g_FloorFilter
 
 	if key in [b'q', b'Q', b'\x1b']:
 		glutDestroyWindow(g_WindowID)
@@ -218,7 +278,28 @@ def keyboard(key, x, y):
 		# アンチエイリアシングの切り替え
 		g_AntiAliasing = not g_AntiAliasing
 		print(f"AntiAliasing: {'ON' if g_AntiAliasing else 'OFF'}")
-
+	elif key in [b'd', b'D']:
+		# 適応的アンチエイリアシングと 3x3 スーパーサンプリングの切り替え
+		g_AdaptiveAA = not g_AdaptiveAA
+		print(f"AdaptiveAA: {'ON' if g_AdaptiveAA else 'OFF'}")
+	elif key in [b'f', b'F']:
+		# 床の格子模様の平均 (箱型フィルタ) の切り替え
+		g_FloorFilter = not g_FloorFilter
+		print(f"FloorFilter: {'ON' if g_FloorFilter else 'OFF'}")
+	elif key in [b'v', b'V']:
+		# ベクトル化エンジンと getPixelColor の切り替え
+		g_UseEngine = not g_UseEngine
+		print(f"UseEngine: {'ON' if g_UseEngine else 'OFF'}")
+	elif key in [b'p', b'P']:
+		# 段階的描画の切り替え
+		g_Progressive = not g_Progressive
+		print(f"Progressive: {'ON' if g_Progressive else 'OFF'}")
+	elif key in [b'r', b'R']:
+		# 解像度の自動調整の切り替え
+		g_DynamicResolution = not g_DynamicResolution
+		print(f"DynamicResolution: {'ON' if g_DynamicResolution else 'OFF'}")
+
+	raytracer_gl.cancelProgressive()	# 計算中の描画を取りやめて最初からやり直す
 	glutPostRedisplay()
 
 if __name__ == "__main__":